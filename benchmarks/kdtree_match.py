@@ -0,0 +1,54 @@
+"""Benchmark `kdtree_match` against the previous per-point loop.
+
+Usage:
+    python benchmarks/kdtree_match.py --n-points 100 1000 10000 100000
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from bliss.reporting import kdtree_match
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "tests"))
+from kdtree_match_reference import kdtree_match_loop  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--n-points", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--density", type=float, default=0.01, help="Points per square pixel.")
+    parser.add_argument("--slack", type=float, default=1.0)
+    parser.add_argument("--max-loop-points", type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f"{'method':>7}{'n_points':>10}{'loop (s)':>12}{'batched (s)':>14}{'speedup':>10}")
+    for method_id in (0, 1):
+        for n_points in args.n_points:
+            slen = np.sqrt(n_points / args.density)
+            locs1 = torch.rand(n_points, 2) * slen
+            locs2 = locs1 + torch.randn(n_points, 2) * args.slack
+
+            tic = time.perf_counter()
+            row_idx, col_idx = kdtree_match(locs1, locs2, args.slack, method_id)
+            batched_time = time.perf_counter() - tic
+
+            loop_time, speedup = np.nan, np.nan
+            if n_points <= args.max_loop_points:
+                tic = time.perf_counter()
+                expected = kdtree_match_loop(locs1, locs2, args.slack, method_id)
+                loop_time = time.perf_counter() - tic
+                speedup = loop_time / batched_time
+                assert np.array_equal(row_idx, expected[0])
+                assert np.array_equal(col_idx, expected[1])
+            print(
+                f"{method_id:>7}{n_points:>10}{loop_time:>12.3f}{batched_time:>14.4f}"
+                f"{speedup:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
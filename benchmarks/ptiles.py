@@ -0,0 +1,100 @@
+"""Benchmark memory and throughput of dividing full images into padded tiles.
+
+Compares the previous `F.unfold` implementation of `get_images_in_tiles` (which materializes every
+padded tile) with the strided view used now, both for flattening all padded tiles at once and for
+lazily iterating over them in batches with `get_ptile_batches` (as done by `Encoder`).
+
+Usage:
+    python benchmarks/ptiles.py --height 1489 --width 2048
+"""
+import argparse
+import time
+
+import torch
+from einops import rearrange
+from torch.nn import functional as F
+
+from bliss.catalog import get_images_in_tiles, get_n_padded_tiles_hw, get_ptile_batches
+
+
+def unfold_ptiles(images, tile_slen, ptile_slen):
+    n_tiles_h, n_tiles_w = get_n_padded_tiles_hw(
+        images.shape[2], images.shape[3], ptile_slen, tile_slen
+    )
+    tiles = F.unfold(images, kernel_size=ptile_slen, stride=tile_slen)
+    tiles = rearrange(
+        tiles,
+        "b (c h w) (nth ntw) -> b nth ntw c h w",
+        nth=n_tiles_h,
+        ntw=n_tiles_w,
+        c=images.shape[1],
+        h=ptile_slen,
+        w=ptile_slen,
+    )
+    return tiles, tiles.numel() * tiles.element_size()
+
+
+def unfold_flat(images, tile_slen, ptile_slen, batch_size):
+    tiles, nbytes = unfold_ptiles(images, tile_slen, ptile_slen)
+    flat = rearrange(tiles, "n nth ntw b h w -> (n nth ntw) b h w")
+    return nbytes + flat.numel() * flat.element_size()
+
+
+def view_flat(images, tile_slen, ptile_slen, batch_size):
+    tiles = get_images_in_tiles(images, tile_slen, ptile_slen)
+    flat = rearrange(tiles, "n nth ntw b h w -> (n nth ntw) b h w")
+    return flat.numel() * flat.element_size()
+
+
+def view_batches(images, tile_slen, ptile_slen, batch_size):
+    peak = 0
+    for ptiles in get_ptile_batches(images, tile_slen, ptile_slen, batch_size):
+        peak = max(peak, ptiles.numel() * ptiles.element_size())
+    return peak
+
+
+def run(fn, images, tile_slen, ptile_slen, batch_size, n_repeats):
+    device = images.device
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    tic = time.perf_counter()
+    for _ in range(n_repeats):
+        nbytes = fn(images, tile_slen, ptile_slen, batch_size)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        nbytes = torch.cuda.max_memory_allocated(device) - images.numel() * images.element_size()
+    elapsed = (time.perf_counter() - tic) / n_repeats
+    return elapsed, nbytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--height", type=int, default=1489)
+    parser.add_argument("--width", type=int, default=2048)
+    parser.add_argument("--n-bands", type=int, default=2, help="image + background channels")
+    parser.add_argument("--tile-slen", type=int, default=4)
+    parser.add_argument("--ptile-slen", type=int, default=52)
+    parser.add_argument("--batch-size", type=int, default=75**2 + 500 * 5)
+    parser.add_argument("--n-repeats", type=int, default=3)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    images = torch.rand(1, args.n_bands, args.height, args.width, device=args.device)
+    image_mb = images.numel() * images.element_size() / 2**20
+    print(f"image: {tuple(images.shape)} ({image_mb:.1f} MB)")
+    print(f"{'method':<20}{'time (s)':>12}{'memory (MB)':>16}")
+    methods = {
+        "unfold (all)": unfold_flat,
+        "view (all)": view_flat,
+        "view (batches)": view_batches,
+    }
+    for name, fn in methods.items():
+        elapsed, nbytes = run(
+            fn, images, args.tile_slen, args.ptile_slen, args.batch_size, args.n_repeats
+        )
+        print(f"{name:<20}{elapsed:>12.3f}{nbytes / 2**20:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
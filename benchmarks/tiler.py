@@ -0,0 +1,62 @@
+"""Benchmark rendering of sources on padded tiles as a function of `max_sources`.
+
+Compares the previous implementation of `Tiler.forward` (one `grid_sample` per source slot)
+with the current one (a single `grid_sample` over all sources followed by a sum per ptile).
+
+Usage:
+    python benchmarks/tiler.py --n-ptiles 2000 --device cuda
+"""
+import argparse
+import time
+
+import torch
+
+from bliss.models.decoder import Tiler
+
+
+def loop_forward(tiler, locs, sources):
+    ptile_shape = (sources.size(0), sources.size(2), tiler.ptile_slen, tiler.ptile_slen)
+    ptile = torch.zeros(ptile_shape, device=locs.device)
+    for n in range(locs.shape[1]):
+        ptile += tiler._render_one_source(locs[:, n, :], sources[:, n])  # noqa: WPS437
+    return ptile
+
+
+def timeit(fn, device, n_repeats):
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    tic = time.perf_counter()
+    for _ in range(n_repeats):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - tic) / n_repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--n-ptiles", type=int, default=2000)
+    parser.add_argument("--n-bands", type=int, default=1)
+    parser.add_argument("--tile-slen", type=int, default=2)
+    parser.add_argument("--ptile-slen", type=int, default=10)
+    parser.add_argument("--n-repeats", type=int, default=5)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    tiler = Tiler(args.tile_slen, args.ptile_slen).to(device)
+    slen = args.ptile_slen + 1 - args.ptile_slen % 2
+    print(f"{'max_sources':>12}{'loop (s)':>12}{'batched (s)':>14}{'speedup':>10}")
+    for max_sources in range(1, 9):
+        locs = torch.rand(args.n_ptiles, max_sources, 2, device=device)
+        sources = torch.rand(args.n_ptiles, max_sources, args.n_bands, slen, slen, device=device)
+        with torch.no_grad():
+            loop_time = timeit(lambda: loop_forward(tiler, locs, sources), device, args.n_repeats)
+            batched_time = timeit(lambda: tiler(locs, sources), device, args.n_repeats)
+        speedup = loop_time / batched_time
+        print(f"{max_sources:>12}{loop_time:>12.4f}{batched_time:>14.4f}{speedup:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
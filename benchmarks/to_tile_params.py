@@ -0,0 +1,76 @@
+"""Benchmark `FullCatalog.to_tile_params` against the previous per-source loop.
+
+Usage:
+    python benchmarks/to_tile_params.py --n-sources 1000 10000 100000
+"""
+import argparse
+import time
+
+import torch
+
+from bliss.catalog import FullCatalog, TileCatalog, get_n_tiles_hw
+
+
+def to_tile_params_loop(full_catalog: FullCatalog, tile_slen: int, max_sources_per_tile: int):
+    # previous implementation (single image only).
+    tile_coords = torch.div(full_catalog.plocs, tile_slen, rounding_mode="trunc")
+    tile_coords = tile_coords.to(torch.int).squeeze(0)
+    n_tiles_h, n_tiles_w = get_n_tiles_hw(full_catalog.height, full_catalog.width, tile_slen)
+    tile_cat_shape = (1, n_tiles_h, n_tiles_w, max_sources_per_tile)
+    tile_locs = torch.zeros((*tile_cat_shape, 2))
+    tile_n_sources = torch.zeros(tile_cat_shape[:3], dtype=torch.int64)
+    tile_params = {k: torch.zeros(*tile_cat_shape, v.shape[-1]) for k, v in full_catalog.items()}
+    for (idx, coords) in enumerate(tile_coords[: int(full_catalog.n_sources[0])]):
+        source_idx = tile_n_sources[0, coords[0], coords[1]]
+        tile_locs[0, coords[0], coords[1], source_idx] = (
+            full_catalog.plocs[0, idx] - coords * tile_slen
+        ) / tile_slen
+        for k, v in tile_params.items():
+            v[0, coords[0], coords[1], source_idx] = full_catalog[k][0, idx]
+        tile_n_sources[0, coords[0], coords[1]] = source_idx + 1
+    tile_params.update({"locs": tile_locs, "n_sources": tile_n_sources})
+    return TileCatalog(tile_slen, tile_params)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--n-sources", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--slen", type=int, default=2048)
+    parser.add_argument("--tile-slen", type=int, default=4)
+    parser.add_argument("--max-sources-per-tile", type=int, default=4)
+    args = parser.parse_args()
+
+    print(f"{'n_sources':>10}{'loop (s)':>12}{'vectorized (s)':>16}{'speedup':>10}")
+    for n_sources in args.n_sources:
+        # keep at most `max_sources_per_tile` sources per tile.
+        n_tiles = (args.slen // args.tile_slen) ** 2
+        tile_indices = torch.randperm(n_tiles * args.max_sources_per_tile)[:n_sources]
+        tile_indices = torch.div(tile_indices, args.max_sources_per_tile, rounding_mode="floor")
+        n_tiles_w = args.slen // args.tile_slen
+        tile_coords = torch.stack((tile_indices // n_tiles_w, tile_indices % n_tiles_w), dim=-1)
+        plocs = (tile_coords + torch.rand(n_sources, 2)) * args.tile_slen
+        full_catalog = FullCatalog(
+            args.slen,
+            args.slen,
+            {
+                "plocs": plocs.unsqueeze(0),
+                "n_sources": torch.tensor([n_sources]),
+                "fluxes": torch.rand(1, n_sources, 1),
+                "galaxy_bools": (torch.rand(1, n_sources, 1) > 0.5).float(),
+            },
+        )
+
+        tic = time.perf_counter()
+        expected = to_tile_params_loop(full_catalog, args.tile_slen, args.max_sources_per_tile)
+        loop_time = time.perf_counter() - tic
+        tic = time.perf_counter()
+        tile_catalog = full_catalog.to_tile_params(args.tile_slen, args.max_sources_per_tile)
+        vectorized_time = time.perf_counter() - tic
+
+        assert torch.equal(tile_catalog.n_sources, expected.n_sources)
+        speedup = loop_time / vectorized_time
+        print(f"{n_sources:>10}{loop_time:>12.3f}{vectorized_time:>16.4f}{speedup:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,11 @@
 import math
 from collections import UserDict
-from typing import Dict, Optional, Tuple
+from typing import Dict, Iterator, Optional, Tuple
 
 import torch
-from einops import rearrange, reduce, repeat
+from einops import rearrange
 from matplotlib.pyplot import Axes
 from torch import Tensor
-from torch.nn import functional as F
 
 
 class TileCatalog(UserDict):
@@ -17,6 +16,7 @@ class TileCatalog(UserDict):
         "mags",
         "galaxy_bools",
         "galaxy_params",
+        "galaxy_indices",
         "galaxy_fluxes",
         "galaxy_probs",
         "galaxy_blends",
@@ -102,77 +102,7 @@ class TileCatalog(UserDict):
             NOTE: The locations (`"locs"`) are between 0 and 1. The output also contains
             pixel locations ("plocs") that are between 0 and slen.
         """
-        plocs = self._get_full_locs_from_tiles()
-        param_names_to_mask = {"plocs"}.union(set(self.keys()))
-        tile_params_to_gather = {"plocs": plocs}
-        tile_params_to_gather.update(self)
-
-        params = {}
-        indices_to_retrieve, is_on_array = self._get_indices_of_on_sources()
-        for param_name, tile_param in tile_params_to_gather.items():
-            k = tile_param.shape[-1]
-            param = rearrange(tile_param, "b nth ntw s k -> b (nth ntw s) k", k=k)
-            indices_for_param = repeat(indices_to_retrieve, "b nth_ntw_s -> b nth_ntw_s k", k=k)
-            param = torch.gather(param, dim=1, index=indices_for_param)
-            if param_name in param_names_to_mask:
-                param = param * is_on_array.unsqueeze(-1)
-            params[param_name] = param
-
-        params["n_sources"] = reduce(self.n_sources, "b nth ntw -> b", "sum")
-        height, width = self.n_tiles_h * self.tile_slen, self.n_tiles_w * self.tile_slen
-        return FullCatalog(height, width, params)
-
-    def _get_full_locs_from_tiles(self) -> Tensor:
-        """Get the full image locations from tile locations.
-
-        Returns:
-            A tuple of two elements, "plocs" and "locs".
-            "plocs" are the pixel coordinates of each source (between 0 and slen).
-            "locs" are the scaled locations of each source (between 0 and 1).
-        """
-        slen = self.n_tiles_h * self.tile_slen
-        wlen = self.n_tiles_w * self.tile_slen
-        # coordinates on tiles.
-        x_coords = torch.arange(0, slen, self.tile_slen, device=self.locs.device).long()
-        y_coords = torch.arange(0, wlen, self.tile_slen, device=self.locs.device).long()
-        tile_coords = torch.cartesian_prod(x_coords, y_coords)
-
-        # recenter and renormalize locations.
-        locs = rearrange(self.locs, "b nth ntw d xy -> (b nth ntw) d xy", xy=2)
-        bias = repeat(tile_coords, "n xy -> (r n) 1 xy", r=self.batch_size).float()
-
-        plocs = locs * self.tile_slen + bias
-        return rearrange(
-            plocs,
-            "(b nth ntw) d xy -> b nth ntw d xy",
-            b=self.batch_size,
-            nth=self.n_tiles_h,
-            ntw=self.n_tiles_w,
-        )
-
-    def _get_indices_of_on_sources(self) -> Tuple[Tensor, Tensor]:
-        """Get the indices of detected sources from each tile.
-
-        Returns:
-            A 2-D tensor of integers with shape `n_samples x max(n_sources)`,
-            where `max(n_sources)` is the maximum number of sources detected across all samples.
-
-            Each element of this tensor is an index of a particular source within a particular tile.
-            For a particular sample i that had N detections,
-            the first N indices of indices_sorted[i. :] will be the detected sources.
-            This is accomplishied by flattening the n_tiles_per_image and max_detections.
-            For example, if we had 3 tiles with a maximum of two sources each,
-            the elements of this tensor would take values from 0 up to and including 5.
-        """
-        tile_is_on_array_sampled = self.is_on_array
-        n_sources = reduce(tile_is_on_array_sampled, "b nth ntw d -> b", "sum")
-        max_sources = int(n_sources.max().int().item())
-        tile_is_on_array = rearrange(tile_is_on_array_sampled, "b nth ntw d -> b (nth ntw d)")
-        indices_sorted = tile_is_on_array.long().argsort(dim=1, descending=True)
-        indices_sorted = indices_sorted[:, :max_sources]
-
-        is_on_array = torch.gather(tile_is_on_array, dim=1, index=indices_sorted)
-        return indices_sorted, is_on_array
+        return SparseTileCatalog.from_tile_catalog(self).to_full_params()
 
     def to_dict(self) -> Dict[str, Tensor]:
         out = {}
@@ -313,37 +243,20 @@ class FullCatalog(UserDict):
         return type(self)(self.height, self.width, d)
 
     def to_tile_params(self, tile_slen: int, max_sources_per_tile: int) -> TileCatalog:
-        assert self.batch_size == 1, "Currently only supported for a single image"
-        tile_coords_fp = torch.div(self.plocs, tile_slen, rounding_mode="trunc")
-        tile_coords = tile_coords_fp.to(torch.int).squeeze(0)
-        n_tiles_h, n_tiles_w = get_n_tiles_hw(self.height, self.width, tile_slen)
-        tile_cat_shape = (self.batch_size, n_tiles_h, n_tiles_w, max_sources_per_tile)
-
-        tile_locs = torch.zeros((*tile_cat_shape, 2), device=self.device)
-        tile_n_sources = torch.zeros(tile_cat_shape[:3], dtype=torch.int64, device=self.device)
-        tile_is_on_array = torch.zeros((*tile_cat_shape, 1), device=self.device)
-        tile_params: Dict[str, Tensor] = {}
-        for k, v in self.items():
-            dtype = torch.int64 if k == "objid" else torch.float
-            size = (self.batch_size, n_tiles_h, n_tiles_w, max_sources_per_tile, v.shape[-1])
-            tile_params[k] = torch.zeros(size, dtype=dtype, device=self.device)
-        n_sources = int(self.n_sources[0].item())
-        for (idx, coords) in enumerate(tile_coords[:n_sources]):
-            source_idx = tile_n_sources[0, coords[0], coords[1]]
-            tile_is_on_array[0, coords[0], coords[1]] = 1
-            tile_locs[0, coords[0], coords[1], source_idx] = (
-                self.plocs[0, idx] - coords * tile_slen
-            ) / tile_slen
-            for k, v in tile_params.items():
-                v[0, coords[0], coords[1], source_idx] = self[k][0, idx]
-            tile_n_sources[0, coords[0], coords[1]] = source_idx + 1
-        tile_params.update(
-            {
-                "locs": tile_locs,
-                "n_sources": tile_n_sources,
-            }
-        )
-        return TileCatalog(tile_slen, tile_params)
+        """Converts the catalog of each image into a catalog in tiles.
+
+        Sources are placed in tiles (and ordered within each tile) in the order in which they
+        appear in the catalog.
+
+        Args:
+            tile_slen: Side length of tiles.
+            max_sources_per_tile: Maximum number of sources in any tile.
+
+        Returns:
+            TileCatalog with the same parameters as this catalog.
+        """
+        sparse_catalog = SparseTileCatalog.from_full_catalog(self, tile_slen, max_sources_per_tile)
+        return sparse_catalog.to_tile_catalog()
 
     def plot_plocs(self, ax: Axes, idx: int, object_type: str, bp: int = 0, **kwargs):
         if object_type == "galaxy":
@@ -359,11 +272,255 @@ class FullCatalog(UserDict):
         ax.scatter(plocs[:, 1], plocs[:, 0], **kwargs)
 
 
+class SparseTileCatalog(UserDict):
+    """Catalog in tiles that only stores the sources that are on.
+
+    This is a sparse (coordinate) format of `TileCatalog`: every on-source is stored along with its
+    `(batch, tile row, tile column, slot)` index in the equivalent `TileCatalog`, with sources
+    sorted by this index. Thus, its memory cost scales with the number of sources rather than with
+    the number of tiles.
+
+    Only the values at on-slots are stored. `from_tile_catalog` drops the values of every
+    parameter at off-slots (including `"n_source_log_probs"`, whose entry for slot `k` is the
+    log-probability of `k + 1` sources in the tile), and `to_tile_catalog` fills them with zeros.
+    So the round trip is exact only for catalogs that are zero at off-slots.
+    """
+
+    allowed_params = TileCatalog.allowed_params
+
+    def __init__(self, tile_slen: int, shape: Tuple[int, int, int, int], d: Dict[str, Tensor]):
+        """Initializes SparseTileCatalog.
+
+        Args:
+            tile_slen: Side length of tiles.
+            shape: Shape `(batch_size, n_tiles_h, n_tiles_w, max_sources)` of the equivalent
+                `TileCatalog`.
+            d: Dictionary with the `"indices"` (n_on x 4) and `"locs"` (n_on x 2) of each on-source
+                along with any other parameters (n_on x k).
+        """
+        self.tile_slen = tile_slen
+        self.batch_size, self.n_tiles_h, self.n_tiles_w, self.max_sources = shape
+        self.indices = d.pop("indices")
+        self.locs = d.pop("locs")
+        self.n_on = self.locs.shape[0]
+        assert self.indices.shape == (self.n_on, 4)
+        assert self.locs.shape == (self.n_on, 2)
+        super().__init__(**d)
+
+    def __setitem__(self, key: str, item: Tensor) -> None:
+        if key not in self.allowed_params:
+            raise ValueError(
+                f"The key '{key}' is not in the allowed parameters for SparseTileCatalog"
+                " (check spelling?)"
+            )
+        self._validate(item)
+        super().__setitem__(key, item)
+
+    def __getitem__(self, key: str) -> Tensor:
+        assert isinstance(key, str)
+        return super().__getitem__(key)
+
+    def _validate(self, x: Tensor):
+        assert isinstance(x, Tensor)
+        assert x.shape[0] == self.n_on and x.dim() == 2
+        assert x.device == self.device
+
+    @classmethod
+    def from_tile_catalog(cls, tile_catalog: TileCatalog):
+        is_on_array = tile_catalog.is_on_array.bool()
+        d = {"indices": is_on_array.nonzero(), "locs": tile_catalog.locs[is_on_array]}
+        for k, v in tile_catalog.items():
+            d[k] = v[is_on_array]
+        shape = (
+            tile_catalog.batch_size,
+            tile_catalog.n_tiles_h,
+            tile_catalog.n_tiles_w,
+            tile_catalog.max_sources,
+        )
+        return cls(tile_catalog.tile_slen, shape, d)
+
+    @classmethod
+    def from_full_catalog(
+        cls, full_catalog: "FullCatalog", tile_slen: int, max_sources_per_tile: int
+    ):
+        """Places the sources of each image of `full_catalog` in tiles.
+
+        Sources are placed in tiles (and ordered within each tile) in the order in which they
+        appear in the catalog. Parameters keep their dtype.
+
+        Args:
+            full_catalog: Catalog of each image.
+            tile_slen: Side length of tiles.
+            max_sources_per_tile: Maximum number of sources in any tile.
+
+        Returns:
+            SparseTileCatalog with the same parameters as `full_catalog`.
+        """
+        batch_size, device = full_catalog.batch_size, full_catalog.device
+        n_tiles_h, n_tiles_w = get_n_tiles_hw(full_catalog.height, full_catalog.width, tile_slen)
+        tile_coords = torch.div(full_catalog.plocs, tile_slen, rounding_mode="trunc").long()
+
+        # only the first `n_sources` entries of each catalog are sources.
+        source_indices = torch.arange(full_catalog.max_sources, device=device)
+        is_on_array = source_indices < full_catalog.n_sources.unsqueeze(-1)
+        batch_indices = torch.arange(batch_size, device=device).unsqueeze(-1)
+        batch_indices = batch_indices.expand(batch_size, full_catalog.max_sources)[is_on_array]
+        tile_coords = tile_coords[is_on_array]
+        tile_indices = (batch_indices * n_tiles_h + tile_coords[:, 0]) * n_tiles_w
+        tile_indices += tile_coords[:, 1]
+
+        # rank sources within each tile with a stable sort by tile.
+        sorted_tile_indices, order = torch.sort(tile_indices, stable=True)
+        first_in_tile = torch.searchsorted(sorted_tile_indices, sorted_tile_indices)
+        ranks = torch.arange(len(order), device=device) - first_in_tile
+        assert len(ranks) == 0 or ranks.max() < max_sources_per_tile, "Too many sources in a tile."
+
+        tile_coords = tile_coords[order]
+        indices = torch.stack((batch_indices[order], *tile_coords.unbind(-1), ranks), dim=-1)
+        d = {"indices": indices}
+        d["locs"] = (full_catalog.plocs[is_on_array][order] - tile_coords * tile_slen) / tile_slen
+        for k, v in full_catalog.items():
+            d[k] = v[is_on_array][order]
+        shape = (batch_size, n_tiles_h, n_tiles_w, max_sources_per_tile)
+        return cls(tile_slen, shape, d)
+
+    @property
+    def shape(self) -> Tuple[int, int, int, int]:
+        return self.batch_size, self.n_tiles_h, self.n_tiles_w, self.max_sources
+
+    @property
+    def device(self):
+        return self.locs.device
+
+    @property
+    def n_sources(self) -> Tensor:
+        """Returns a n x nth x ntw tensor with the number of sources in each tile."""
+        n_tiles = self.batch_size * self.n_tiles_h * self.n_tiles_w
+        n_sources = torch.bincount(self._get_flat_tile_indices(), minlength=n_tiles)
+        return n_sources.view(self.batch_size, self.n_tiles_h, self.n_tiles_w)
+
+    def _get_flat_tile_indices(self) -> Tensor:
+        b_indx, h_indx, w_indx, _ = self.indices.unbind(-1)
+        return (b_indx * self.n_tiles_h + h_indx) * self.n_tiles_w + w_indx
+
+    def cpu(self):
+        return self.to("cpu")
+
+    def to(self, device):
+        out = {}
+        for k, v in self.to_dict().items():
+            out[k] = v.to(device)
+        return type(self)(self.tile_slen, self.shape, out)
+
+    def crop(self, hlims_tile, wlims_tile):
+        """Crops tiles with the same semantics as slicing the tensors of a `TileCatalog`."""
+        h_start, h_end, _ = slice(*hlims_tile).indices(self.n_tiles_h)
+        w_start, w_end, _ = slice(*wlims_tile).indices(self.n_tiles_w)
+        _, h_indx, w_indx, _ = self.indices.unbind(-1)
+        keep = (h_indx >= h_start) & (h_indx < h_end) & (w_indx >= w_start) & (w_indx < w_end)
+        out = {k: v[keep] for k, v in self.to_dict().items()}
+        out["indices"] = out["indices"] - torch.tensor([0, h_start, w_start, 0], device=self.device)
+        shape = (
+            self.batch_size,
+            max(h_end - h_start, 0),
+            max(w_end - w_start, 0),
+            self.max_sources,
+        )
+        return type(self)(self.tile_slen, shape, out)
+
+    def to_tile_catalog(self) -> TileCatalog:
+        n_tiles = self.batch_size * self.n_tiles_h * self.n_tiles_w
+        flat_indices = self._get_flat_tile_indices() * self.max_sources + self.indices[:, 3]
+        tile_params: Dict[str, Tensor] = {}
+        for k, v in self.to_dict().items():
+            if k == "indices":
+                continue
+            tile_param = v.new_zeros(n_tiles * self.max_sources, v.shape[-1])
+            tile_param[flat_indices] = v
+            tile_params[k] = tile_param.view(*self.shape, v.shape[-1])
+        tile_params["n_sources"] = self.n_sources
+        return TileCatalog(self.tile_slen, tile_params)
+
+    def to_full_params(self) -> "FullCatalog":
+        """Converts the sources in tiles into a catalog of each full image.
+
+        Sources of each image are ordered by tile (in row-major order) and by slot within tiles.
+        See `TileCatalog.to_full_params` for the format of the output.
+        """
+        b_indx, h_indx, w_indx, _ = self.indices.unbind(-1)
+        n_sources = torch.bincount(b_indx, minlength=self.batch_size)
+        max_sources = int(n_sources.max().item()) if self.batch_size > 0 else 0
+        first_in_batch = torch.cumsum(n_sources, dim=0) - n_sources
+        source_indx = torch.arange(self.n_on, device=self.device) - first_in_batch[b_indx]
+
+        tile_coords = torch.stack((h_indx, w_indx), dim=-1)
+        params = {"plocs": self.locs * self.tile_slen + (tile_coords * self.tile_slen).float()}
+        params.update(self)
+        full_params: Dict[str, Tensor] = {}
+        for k, v in params.items():
+            param = v.new_zeros(self.batch_size, max_sources, v.shape[-1])
+            param[b_indx, source_indx] = v
+            full_params[k] = param
+        full_params["n_sources"] = n_sources
+        height, width = self.n_tiles_h * self.tile_slen, self.n_tiles_w * self.tile_slen
+        return FullCatalog(height, width, full_params)
+
+    def to_dict(self) -> Dict[str, Tensor]:
+        out = {}
+        out["indices"] = self.indices
+        out["locs"] = self.locs
+        for k, v in self.items():
+            out[k] = v
+        return out
+
+    def get_tile_params_at_coord(self, plocs: torch.Tensor):
+        """Return the parameters of the tiles that contain each of the locations in plocs.
+
+        The output is the same as that of `TileCatalog.get_tile_params_at_coord`.
+        """
+        assert len(plocs.shape) == 2 and plocs.shape[1] == 2
+        assert plocs.device == self.device
+        n_total = len(plocs)
+        slen = self.n_tiles_h * self.tile_slen
+        wlen = self.n_tiles_w * self.tile_slen
+        # coordinates on tiles.
+        x_coords = torch.arange(0, slen, self.tile_slen, device=self.device).long()
+        y_coords = torch.arange(0, wlen, self.tile_slen, device=self.device).long()
+        x_indx = torch.searchsorted(x_coords.contiguous(), plocs[:, 0].contiguous()) - 1
+        y_indx = torch.searchsorted(y_coords.contiguous(), plocs[:, 1].contiguous()) - 1
+        # as with indexing the dense tensors, an index of -1 refers to the last tile.
+        coord_tiles = (x_indx % self.n_tiles_h) * self.n_tiles_w + y_indx % self.n_tiles_w
+
+        # match each source to every coordinate that falls in its tile.
+        b_indx, h_indx, w_indx, s_indx = self.indices.unbind(-1)
+        source_tiles = h_indx * self.n_tiles_w + w_indx
+        sorted_coord_tiles, coord_order = torch.sort(coord_tiles)
+        start = torch.searchsorted(sorted_coord_tiles, source_tiles)
+        n_matches = torch.searchsorted(sorted_coord_tiles, source_tiles, right=True) - start
+        match_sources = torch.repeat_interleave(
+            torch.arange(self.n_on, device=self.device), n_matches
+        )
+        match_offsets = torch.arange(len(match_sources), device=self.device)
+        match_offsets -= torch.repeat_interleave(torch.cumsum(n_matches, 0) - n_matches, n_matches)
+        match_coords = coord_order[start[match_sources] + match_offsets]
+
+        out = {}
+        for k, v in self.items():
+            param = v.new_zeros(self.batch_size, n_total, self.max_sources, v.shape[-1])
+            param[b_indx[match_sources], match_coords, s_indx[match_sources]] = v[match_sources]
+            out[k] = param.reshape(n_total, -1)
+        return out
+
+
 def get_images_in_tiles(images: Tensor, tile_slen: int, ptile_slen: int) -> Tensor:
     """Divides a batch of full images into padded tiles.
 
     This is similar to nn.conv2d, with a sliding window=ptile_slen and stride=tile_slen.
 
+    The padded tiles are a strided view of `images`, so no pixels are copied until the output
+    is reshaped (e.g. flattened into a batch of ptiles). Since the padded tiles overlap,
+    the output should not be modified in-place.
+
     Arguments:
         images: Tensor of images with size (batchsize x n_bands x slen x slen)
         tile_slen: Side length of tile
@@ -373,22 +530,46 @@ def get_images_in_tiles(images: Tensor, tile_slen: int, ptile_slen: int) -> Tens
         A batchsize x n_tiles_h x n_tiles_w x n_bands x tile_weight x tile_width image
     """
     assert len(images.shape) == 4
-    n_bands = images.shape[1]
     window = ptile_slen
     n_tiles_h, n_tiles_w = get_n_padded_tiles_hw(
         images.shape[2], images.shape[3], window, tile_slen
     )
-    tiles = F.unfold(images, kernel_size=window, stride=tile_slen)
-    # b: batch, c: channel, h: tile height, w: tile width, n: num of total tiles for each batch
-    return rearrange(
-        tiles,
-        "b (c h w) (nth ntw) -> b nth ntw c h w",
-        nth=n_tiles_h,
-        ntw=n_tiles_w,
-        c=n_bands,
-        h=window,
-        w=window,
-    )
+    tiles = images.unfold(2, window, tile_slen).unfold(3, window, tile_slen)
+    # b: batch, c: channel, h: tile height, w: tile width
+    tiles = rearrange(tiles, "b c nth ntw h w -> b nth ntw c h w")
+    assert tiles.shape[1:3] == (n_tiles_h, n_tiles_w)
+    return tiles
+
+
+def get_ptile_batches(
+    images: Tensor, tile_slen: int, ptile_slen: int, batch_size: int
+) -> Iterator[Tensor]:
+    """Lazily yields the flattened padded tiles of a batch of images.
+
+    Only the padded tiles in the current batch are copied out of `images`, so the memory cost
+    is that of a single batch rather than that of all (overlapping) padded tiles.
+
+    Arguments:
+        images: Tensor of images with size (batchsize x n_bands x slen x slen)
+        tile_slen: Side length of tile
+        ptile_slen: Side length of padded tile
+        batch_size: Maximum number of padded tiles yielded at a time.
+
+    Yields:
+        Tensors of size (n_ptiles x n_bands x ptile_slen x ptile_slen), where `n_ptiles` is at
+        most `batch_size`. Padded tiles are ordered as in `(batchsize nth ntw)`.
+    """
+    assert batch_size > 0
+    image_ptiles = get_images_in_tiles(images, tile_slen, ptile_slen)
+    n_tiles_h, n_tiles_w = image_ptiles.shape[1:3]
+    n_ptiles = image_ptiles.shape[0] * n_tiles_h * n_tiles_w
+    for start in range(0, n_ptiles, batch_size):
+        end = min(start + batch_size, n_ptiles)
+        indices = torch.arange(start, end, device=images.device)
+        b_indx = torch.div(indices, n_tiles_h * n_tiles_w, rounding_mode="floor")
+        h_indx = torch.div(indices, n_tiles_w, rounding_mode="floor") % n_tiles_h
+        w_indx = indices % n_tiles_w
+        yield image_ptiles[b_indx, h_indx, w_indx]
 
 
 def get_n_tiles_hw(height: int, width: int, tile_slen: int):
@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import Optional, Tuple
 
 import numpy as np
 import torch
@@ -15,7 +15,7 @@ class ConstantBackground(nn.Module):
         bg = rearrange(bg, "c -> 1 c 1 1")
         self.register_buffer("background", bg, persistent=False)
 
-    def sample(self, shape) -> Tensor:
+    def sample(self, shape, generator: Optional[torch.Generator] = None) -> Tensor:
         assert isinstance(self.background, Tensor)
         batch_size, c, hlen, wlen = shape
         return self.background.expand(batch_size, c, hlen, wlen)
@@ -36,12 +36,21 @@ class SimulatedSDSSBackground(nn.Module):
         self.register_buffer("background", background, persistent=False)
         self.height, self.width = self.background.shape[-2:]
 
-    def sample(self, shape) -> Tensor:
+    def sample(self, shape, generator: Optional[torch.Generator] = None) -> Tensor:
         assert isinstance(self.background, Tensor)
         batch_size, c, hlen, wlen = shape
         assert self.background.shape[1] == c
         h_diff, w_diff = self.height - hlen, self.width - wlen
-        h = 0 if h_diff == 0 else np.random.randint(h_diff)
-        w = 0 if w_diff == 0 else np.random.randint(w_diff)
+        h = self._randint(h_diff, generator)
+        w = self._randint(w_diff, generator)
         bg = self.background[:, :, h : (h + hlen), w : (w + wlen)]
         return bg.expand(batch_size, -1, -1, -1)
+
+    def _randint(self, high: int, generator: Optional[torch.Generator] = None) -> int:
+        # without a generator, offsets are drawn from numpy's global RNG.
+        if high == 0:
+            return 0
+        if generator is None:
+            return np.random.randint(high)
+        assert isinstance(self.background, Tensor)
+        return int(torch.randint(high, (1,), device=self.background.device, generator=generator))
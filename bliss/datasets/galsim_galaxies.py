@@ -1,12 +1,16 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple
 
 import galsim
 import numpy as np
 import pytorch_lightning as pl
 import torch
 from torch import Tensor
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import BatchSampler, DataLoader, Dataset, SequentialSampler
+from torch.utils.data.dataloader import default_collate
 
 from bliss.datasets.background import ConstantBackground
 
@@ -153,30 +157,40 @@ class GalsimGalaxyPrior:
         else:
             raise NotImplementedError()
 
-    def sample(self, total_latent, device):
+    def sample(self, total_latent, device, generator: Optional[torch.Generator] = None):
+        # galaxy parameters are always sampled on the cpu.
+        if generator is not None and generator.device.type != "cpu":
+            seed = torch.randint(2**62, (1,), device=generator.device, generator=generator)
+            generator = torch.Generator().manual_seed(int(seed))
+        gen = {"generator": generator}
+
         # create galaxy as mixture of Exponential + DeVacauleurs
         if self.flux_sample == "uniform":
-            total_flux = self._uniform(self.min_flux, self.max_flux, n_samples=total_latent)
+            total_flux = self._uniform(self.min_flux, self.max_flux, total_latent, **gen)
         elif self.flux_sample == "pareto":
-            total_flux = self._draw_pareto_flux(n_samples=total_latent)
+            total_flux = self._draw_pareto_flux(total_latent, **gen)
         else:
             raise NotImplementedError()
-        disk_frac = self._uniform(0, 1, n_samples=total_latent)
-        beta_radians = self._uniform(0, 2 * np.pi, n_samples=total_latent)
-        disk_q = self._uniform(0, 1, n_samples=total_latent)
-        bulge_q = self._uniform(0, 1, n_samples=total_latent)
+        disk_frac = self._uniform(0, 1, total_latent, **gen)
+        beta_radians = self._uniform(0, 2 * np.pi, total_latent, **gen)
+        disk_q = self._uniform(0, 1, total_latent, **gen)
+        bulge_q = self._uniform(0, 1, total_latent, **gen)
         if self.a_sample == "uniform":
-            disk_a = self._uniform(self.min_a_d, self.max_a_d, n_samples=total_latent)
-            bulge_a = self._uniform(self.min_a_b, self.max_a_b, n_samples=total_latent)
+            disk_a = self._uniform(self.min_a_d, self.max_a_d, total_latent, **gen)
+            bulge_a = self._uniform(self.min_a_b, self.max_a_b, total_latent, **gen)
         elif self.a_sample == "gamma":
+            assert self.a_loc is not None
+            assert self.a_scale is not None
+            assert self.a_bulge_disk_ratio is not None
             disk_a = self._gamma(
-                self.a_concentration, self.a_loc, self.a_scale, n_samples=total_latent
+                self.a_concentration, self.a_loc, self.a_scale, total_latent, **gen
             )
             bulge_a = self._gamma(
                 self.a_concentration,
                 self.a_loc / self.a_bulge_disk_ratio,
                 self.a_scale / self.a_bulge_disk_ratio,
-                n_samples=total_latent,
+                total_latent,
+                **gen,
             )
         else:
             raise NotImplementedError()
@@ -185,20 +199,26 @@ class GalsimGalaxyPrior:
         )
 
     @staticmethod
-    def _uniform(a, b, n_samples=1) -> Tensor:
+    def _uniform(a, b, n_samples=1, generator=None) -> Tensor:
         # uses pytorch to return a single float ~ U(a, b)
-        return (a - b) * torch.rand(n_samples) + b
+        return (a - b) * torch.rand(n_samples, generator=generator) + b
 
-    def _draw_pareto_flux(self, n_samples=1) -> Tensor:
+    def _draw_pareto_flux(self, n_samples=1, generator=None) -> Tensor:
         # draw pareto conditioned on being less than f_max
         assert self.alpha is not None
         u_max = 1 - (self.min_flux / self.max_flux) ** self.alpha
-        uniform_samples = torch.rand(n_samples) * u_max
+        uniform_samples = torch.rand(n_samples, generator=generator) * u_max
         return self.min_flux / (1.0 - uniform_samples) ** (1 / self.alpha)
 
     @staticmethod
-    def _gamma(concentration, loc, scale, n_samples=1):
-        x = torch.distributions.Gamma(concentration, rate=1.0).sample((n_samples,))
+    def _gamma(concentration, loc, scale, n_samples=1, generator=None):
+        if generator is None:
+            x = torch.distributions.Gamma(concentration, rate=1.0).sample((n_samples,))
+        else:
+            # torch cannot draw gamma variates from a generator, so seed numpy from it.
+            seed = int(torch.randint(2**62, (1,), generator=generator))
+            x = np.random.default_rng(seed).standard_gamma(concentration, n_samples)
+            x = torch.from_numpy(x).float()
         return x * scale + loc
 
 
@@ -209,23 +229,81 @@ class GalsimGalaxyDecoder:
         n_bands,
         pixel_scale,
         psf_image_file: str,
+        n_workers: int = 0,
     ) -> None:
-
+        """Renders galaxies from their galsim parameters.
+
+        Args:
+            slen: Side-length of rendered galaxies.
+            n_bands: Number of bands (only 1 is supported).
+            pixel_scale: Pixel scale in arcseconds.
+            psf_image_file: Path to numpy file with PSF image.
+            n_workers: If positive, batches of galaxies are rendered by a pool of this many
+                processes, each with its own copy of the PSF, which write into a shared-memory
+                buffer. The pool is not used from daemonic processes (e.g. `DataLoader` workers).
+        """
         self.slen = slen
         assert n_bands == 1, "Only 1 band is supported"
         self.n_bands = 1
         self.pixel_scale = pixel_scale
+        self.psf_image_file = psf_image_file
         self.psf = load_psf_from_file(psf_image_file, self.pixel_scale)
+        self.n_workers = n_workers
+        self._pool: Optional[ProcessPoolExecutor] = None
 
     def __call__(self, z: Tensor) -> Tensor:
         if z.shape[0] == 0:
             return torch.zeros(0, 1, self.slen, self.slen, device=z.device)
+        if self.n_workers > 0 and not multiprocessing.current_process().daemon:
+            return self._render_galaxies_in_pool(z).to(z.device)
         images = []
         for latent in z:
             image = self.render_galaxy(latent)
             images.append(image)
         return torch.stack(images, dim=0).to(z.device)
 
+    def __getstate__(self):
+        # process pools cannot be pickled (e.g. when sent to `DataLoader` workers).
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
+
+    def close(self) -> None:
+        """Shuts down the pool of rendering processes (if any)."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _render_galaxies_in_pool(self, z: Tensor) -> Tensor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                self.n_workers,
+                initializer=_init_render_worker,
+                initargs=(self.slen, self.pixel_scale, self.psf_image_file),
+            )
+        galaxy_params = z.cpu().detach().numpy()
+        shape = (len(galaxy_params), 1, self.slen, self.slen)
+        shm = SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(np.float32).itemsize)
+        try:
+            # a few chunks per worker to balance the load.
+            chunks = np.array_split(np.arange(len(galaxy_params)), self.n_workers * 4)
+            futures = [
+                self._pool.submit(
+                    _render_galaxies_into, shm.name, shape, chunk[0], galaxy_params[chunk]
+                )
+                for chunk in chunks
+                if len(chunk) > 0
+            ]
+            for future in futures:
+                future.result()
+            shared_images = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+            images = torch.from_numpy(shared_images.copy())
+            del shared_images  # noqa: WPS420
+        finally:
+            shm.close()
+            shm.unlink()
+        return images
+
     def render_galaxy(self, galaxy_params) -> Tensor:
         if isinstance(galaxy_params, Tensor):
             galaxy_params = galaxy_params.cpu().detach()
@@ -260,6 +338,29 @@ class GalsimGalaxyDecoder:
         return torch.from_numpy(image.array).reshape(1, self.slen, self.slen)
 
 
+_worker_decoder: Optional[GalsimGalaxyDecoder] = None
+
+
+def _init_render_worker(slen: int, pixel_scale: float, psf_image_file: str) -> None:
+    # each worker loads the PSF once and reuses it for all galaxies it renders.
+    global _worker_decoder  # noqa: WPS420
+    _worker_decoder = GalsimGalaxyDecoder(slen, 1, pixel_scale, psf_image_file)
+
+
+def _render_galaxies_into(
+    shm_name: str, shape: Tuple[int, ...], start: int, galaxy_params: np.ndarray
+) -> None:
+    assert _worker_decoder is not None
+    shm = SharedMemory(name=shm_name)
+    try:
+        images = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        for i, params in enumerate(galaxy_params):
+            images[start + i] = _worker_decoder.render_galaxy(torch.from_numpy(params)).numpy()
+        del images  # noqa: WPS420
+    finally:
+        shm.close()
+
+
 class SDSSGalaxies(pl.LightningDataModule, Dataset):
     def __init__(
         self,
@@ -279,8 +380,17 @@ class SDSSGalaxies(pl.LightningDataModule, Dataset):
         self.background = background
 
     def __getitem__(self, idx):
+        if isinstance(idx, list):
+            # a whole batch (see `_get_dataloader`), whose galaxies are rendered at once.
+            galaxy_params = self.prior.sample(len(idx), "cpu")
+            galaxy_images = self.decoder(galaxy_params)
+            items = [self._make_item(*args) for args in zip(galaxy_params, galaxy_images)]
+            return default_collate(items)
         galaxy_params = self.prior.sample(1, "cpu")
         galaxy_image = self.decoder.render_galaxy(galaxy_params[0])
+        return self._make_item(galaxy_params[0], galaxy_image)
+
+    def _make_item(self, galaxy_params, galaxy_image):
         background = self.background.sample((1, *galaxy_image.shape)).squeeze(1)
         galaxy_with_background = galaxy_image + background
         noise = galaxy_with_background.sqrt() * torch.randn_like(galaxy_with_background)
@@ -290,7 +400,7 @@ class SDSSGalaxies(pl.LightningDataModule, Dataset):
             "images": galaxy_with_noise,
             "background": background,
             "noiseless": galaxy_image,
-            "params": galaxy_params[0],
+            "params": galaxy_params,
             "snr": snr,
         }
 
@@ -298,10 +408,15 @@ class SDSSGalaxies(pl.LightningDataModule, Dataset):
         return self.batch_size * self.n_batches
 
     def train_dataloader(self):
-        return DataLoader(self, batch_size=self.batch_size, num_workers=self.num_workers)
+        return self._get_dataloader()
 
     def val_dataloader(self):
-        return DataLoader(self, batch_size=self.batch_size, num_workers=self.num_workers)
+        return self._get_dataloader()
 
     def test_dataloader(self):
-        return DataLoader(self, batch_size=self.batch_size, num_workers=self.num_workers)
+        return self._get_dataloader()
+
+    def _get_dataloader(self):
+        # the dataset is indexed with the list of indices of each batch.
+        sampler = BatchSampler(SequentialSampler(range(len(self))), self.batch_size, False)
+        return DataLoader(self, batch_size=None, sampler=sampler, num_workers=self.num_workers)
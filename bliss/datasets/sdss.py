@@ -1,12 +1,15 @@
+import json
+import os
+import shutil
+import tempfile
 import warnings
 from pathlib import Path
+from typing import Optional
 
 import numpy as np
 import torch
 from astropy.io import fits
 from astropy.wcs import WCS, FITSFixedWarning
-from einops import rearrange
-from scipy.interpolate import RegularGridInterpolator
 from torch.utils.data import Dataset
 
 from bliss.catalog import FullCatalog
@@ -22,6 +25,11 @@ def convert_flux_to_mag(flux, nelec_per_nmgy=987.31):
     return 22.5 - 2.5 * np.log10(flux / nelec_per_nmgy)
 
 
+def _get_default_cache_dir() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "bliss" / "sdss"
+
+
 class SloanDigitalSkySurvey(Dataset):
     def __init__(
         self,
@@ -30,10 +38,31 @@ class SloanDigitalSkySurvey(Dataset):
         camcol=6,
         fields=(269,),
         bands=(0, 1, 2, 3, 4),
+        use_cache: bool = False,
+        cache_dir: Optional[str] = None,
+        sky_interp: str = "nearest",
     ):
+        """Loads SDSS frames (in electrons) of the given fields and bands.
+
+        Args:
+            sdss_dir: Directory with the SDSS data, organized as `run/camcol/field`.
+            run: SDSS run.
+            camcol: SDSS camcol.
+            fields: Fields of the run and camcol to load (all if empty).
+            bands: Indices of bands (in "ugriz") to load.
+            use_cache: If True, decoded frames are stored in an on-disk cache and subsequently
+                loaded from it as memory-mapped arrays (see `read_frame_for_band`).
+            cache_dir: Directory of the cache (if `use_cache`). Defaults to `bliss/sdss` in the
+                user's cache directory (`$XDG_CACHE_HOME`, or `~/.cache` if it is not set).
+            sky_interp: Interpolation ("nearest" or "linear") of the sky background of each frame
+                from its coarse grid (see `expand_sky`).
+        """
         super().__init__()
 
         self.sdss_path = Path(sdss_dir)
+        self.use_cache = use_cache
+        self.sky_interp = sky_interp
+        self.cache_path = Path(cache_dir) if cache_dir is not None else _get_default_cache_dir()
         self.rcfgcs = []
         self.bands = bands
         pf_file = f"photoField-{run:06d}-{camcol:d}.fits"
@@ -76,7 +105,10 @@ class SloanDigitalSkySurvey(Dataset):
         ret = {}
         for k in frame_list[0]:
             data_per_band = [frame[k] for frame in frame_list]
-            if isinstance(data_per_band[0], np.ndarray):
+            if isinstance(data_per_band[0], np.ndarray) and len(data_per_band) == 1:
+                # a view avoids copying (memory-mapped) frames.
+                ret[k] = data_per_band[0][np.newaxis]
+            elif isinstance(data_per_band[0], np.ndarray):
                 ret[k] = np.stack(data_per_band)
             else:
                 ret[k] = data_per_band
@@ -84,8 +116,41 @@ class SloanDigitalSkySurvey(Dataset):
         return ret
 
     def read_frame_for_band(self, bl, field_dir, run, camcol, field, gain):
-        frame_name = f"frame-{bl}-{run:06d}-{camcol:d}-{field:04d}.fits"
-        frame_path = str(field_dir.joinpath(frame_name))
+        """Reads the frame of a band in electrons, through the on-disk cache if `use_cache`.
+
+        The decoded arrays of each frame (e.g. `image` and `background`) are saved as `.npy`
+        files, along with the FITS header of the frame (for its WCS), the gain, and the
+        modification time and size of the FITS file, under `run/camcol/field` of the cache
+        directory. They are loaded as copy-on-write memory maps, so repeated loads (by any process)
+        are near-instant and share the pages of the cache until modified. A cache entry is rebuilt
+        when the FITS file, the gain, or `sky_interp` changes.
+        """
+        frame_name = f"frame-{bl}-{run:06d}-{camcol:d}-{field:04d}"
+        frame_path = field_dir.joinpath(f"{frame_name}.fits")
+        if not self.use_cache:
+            return self._decode_frame(frame_path, gain, self.sky_interp)[0]
+
+        cache_path = self.cache_path.joinpath(str(run), str(camcol), str(field), frame_name)
+        stat = frame_path.stat()
+        key = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "gain": float(gain),
+            "sky_interp": self.sky_interp,
+        }
+        meta_path = cache_path / "meta.json"
+        if meta_path.exists():
+            with open(meta_path, encoding="utf-8") as fp:
+                meta = json.load(fp)
+            if meta["key"] == key:
+                return self._load_cached_frame(cache_path, meta)
+
+        frame, header = self._decode_frame(frame_path, gain, self.sky_interp)
+        self._save_cached_frame(cache_path, frame, header, key)
+        return frame
+
+    @staticmethod
+    def _decode_frame(frame_path, gain, sky_interp="nearest"):
         frame = fits.open(frame_path)
         calibration = frame[1].data  # pylint: disable=maybe-no-member
         nelec_per_nmgy = gain / calibration
@@ -94,34 +159,114 @@ class SloanDigitalSkySurvey(Dataset):
         sky_x = frame[2].data["XINTERP"][0]  # pylint: disable=maybe-no-member
         sky_y = frame[2].data["YINTERP"][0]  # pylint: disable=maybe-no-member
 
-        small_rows = np.mgrid[0 : sky_small.shape[0]]
-        small_cols = np.mgrid[0 : sky_small.shape[1]]
-        small_rcs = (small_rows, small_cols)
-        sky_interp = RegularGridInterpolator(small_rcs, sky_small, method="nearest")
-
-        sky_y = sky_y.clip(0, sky_small.shape[0] - 1)
-        sky_x = sky_x.clip(0, sky_small.shape[1] - 1)
-        large_points = rearrange(np.meshgrid(sky_y, sky_x), "n x y -> y x n")
-        large_sky = sky_interp(large_points)
+        large_sky = expand_sky(sky_small, sky_y, sky_x, method=sky_interp)
         large_sky_nelec = large_sky * gain
 
         pixels_ss_nmgy = frame[0].data  # pylint: disable=maybe-no-member
         pixels_ss_nelec = pixels_ss_nmgy * nelec_per_nmgy
         pixels_nelec = pixels_ss_nelec + large_sky_nelec
 
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore", category=FITSFixedWarning)
-            wcs = WCS(frame[0])
-
+        header = frame[0].header  # pylint: disable=maybe-no-member
         frame.close()
-        return {
+        decoded_frame = {
             "image": pixels_nelec,
             "background": large_sky_nelec,
             "gain": np.array(gain),
             "nelec_per_nmgy_list": nelec_per_nmgy,
             "calibration": calibration,
-            "wcs": wcs,
+            "wcs": _get_wcs(header),
         }
+        return decoded_frame, header
+
+    @staticmethod
+    def _load_cached_frame(cache_path: Path, meta: dict):
+        frame = {k: np.load(cache_path / f"{k}.npy", mmap_mode="c") for k in _CACHED_ARRAYS}
+        frame["wcs"] = _get_wcs(fits.Header.fromstring(meta["header"]))
+        return frame
+
+    @staticmethod
+    def _save_cached_frame(cache_path: Path, frame: dict, header: fits.Header, key: dict):
+        # written to a temporary directory first, so that other processes never read partial files.
+        tmp_path = None
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = Path(tempfile.mkdtemp(dir=cache_path.parent, prefix=".tmp-"))
+            for k in _CACHED_ARRAYS:
+                # native byte order (FITS data is big-endian).
+                np.save(tmp_path / f"{k}.npy", frame[k].astype(frame[k].dtype.newbyteorder("=")))
+            with open(tmp_path / "meta.json", "w", encoding="utf-8") as fp:
+                json.dump({"key": key, "header": header.tostring()}, fp)
+            shutil.rmtree(cache_path, ignore_errors=True)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            warnings.warn(f"Could not write SDSS frame cache at {cache_path}: {e}")
+        finally:
+            if tmp_path is not None:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def read_frame_metadata(sdss_dir, run: int, camcol: int, field: int, band: int):
+    """Reads the WCS and size of an SDSS frame from its FITS header, without any pixel data.
+
+    Args:
+        sdss_dir: Directory with the SDSS data, organized as `run/camcol/field`.
+        run: SDSS run.
+        camcol: SDSS camcol.
+        field: SDSS field.
+        band: Index of band (in "ugriz").
+
+    Returns:
+        Dictionary with the `"wcs"` of the frame and its `"height"` and `"width"` in pixels.
+    """
+    frame_name = f"frame-{'ugriz'[band]}-{run:06d}-{camcol:d}-{field:04d}.fits"
+    frame_path = Path(sdss_dir).joinpath(str(run), str(camcol), str(field), frame_name)
+    header = fits.getheader(frame_path, 0)
+    return {"wcs": _get_wcs(header), "height": header["NAXIS2"], "width": header["NAXIS1"]}
+
+
+_CACHED_ARRAYS = ("image", "background", "gain", "nelec_per_nmgy_list", "calibration")
+
+
+def _get_wcs(header):
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=FITSFixedWarning)
+        return WCS(header)
+
+
+def expand_sky(sky_small: np.ndarray, sky_y: np.ndarray, sky_x: np.ndarray, method="nearest"):
+    """Interpolates the coarse sky grid of an SDSS frame at every pixel of the frame.
+
+    Since the interpolation points form a grid (`sky_y` x `sky_x`), the indices and weights are
+    computed once per axis and the sky is gathered (and combined) with broadcasting.
+
+    Args:
+        sky_small: The `ALLSKY` array, of shape `(h_small x w_small)`.
+        sky_y: The `YINTERP` array of coordinates of the frame rows in `sky_small`.
+        sky_x: The `XINTERP` array of coordinates of the frame columns in `sky_small`.
+        method: Either "nearest" (the same as `scipy.interpolate.RegularGridInterpolator` with
+            `method="nearest"`, i.e. ties are rounded down) or "linear" (bilinear interpolation).
+            Coordinates are clipped to the grid in both cases.
+
+    Returns:
+        Array of shape `(len(sky_y) x len(sky_x))` with the sky at each pixel.
+    """
+    assert method in {"nearest", "linear"}
+    (iy, wy), (ix, wx) = (
+        _get_interp_indices(coords, n) for coords, n in zip((sky_y, sky_x), sky_small.shape)
+    )
+    if method == "nearest":
+        iy, ix = iy + (wy > 0.5), ix + (wx > 0.5)
+        return sky_small[iy[:, None], ix[None, :]]
+    # interpolate the coarse grid along rows first, then expand along columns.
+    sky_rows = sky_small[iy] * (1 - wy[:, None]) + sky_small[iy + 1] * wy[:, None]
+    return sky_rows[:, ix] * (1 - wx) + sky_rows[:, ix + 1] * wx
+
+
+def _get_interp_indices(coords: np.ndarray, n: int):
+    """Lower grid index (of a cell of `n` points) and offset from it of each coordinate."""
+    coords = np.clip(coords.astype(np.float64), 0, n - 1)
+    indices = np.clip(np.floor(coords).astype(np.int64), 0, max(n - 2, 0))
+    return indices, coords - indices
 
 
 class PhotoFullCatalog(FullCatalog):
@@ -158,17 +303,10 @@ class PhotoFullCatalog(FullCatalog):
         fluxes = fluxes[keep][:, band]
         mags = mags[keep][:, band]
 
-        sdss = SloanDigitalSkySurvey(sdss_path, run, camcol, fields=(field,), bands=(band,))
-        wcs: WCS = sdss[0]["wcs"][0]
-
-        pts = []
-        prs = []
-        for ra, dec in zip(ras, decs):
-            pt, pr = wcs.wcs_world2pix(ra, dec, 0)
-            pts.append(float(pt))
-            prs.append(float(pr))
-        pts = torch.tensor(pts) + 0.5  # For consistency with BLISS
-        prs = torch.tensor(prs) + 0.5
+        frame_metadata = read_frame_metadata(sdss_path, run, camcol, field, band)
+        pts, prs = frame_metadata["wcs"].wcs_world2pix(ras.numpy(), decs.numpy(), 0)
+        pts = torch.from_numpy(pts).float() + 0.5  # For consistency with BLISS
+        prs = torch.from_numpy(prs).float() + 0.5
         plocs = torch.stack((prs, pts), dim=-1)
         nobj = plocs.shape[0]
 
@@ -181,10 +319,7 @@ class PhotoFullCatalog(FullCatalog):
             "mags": mags.reshape(1, nobj, 1),
         }
 
-        height = sdss[0]["image"].shape[1]
-        width = sdss[0]["image"].shape[2]
-
-        return cls(height, width, d)
+        return cls(frame_metadata["height"], frame_metadata["width"], d)
 
 
 def column_to_tensor(table, colname):
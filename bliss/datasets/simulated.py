@@ -1,23 +1,225 @@
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import queue
+import shutil
+import threading
+import time
 import warnings
-from typing import Dict, List, Optional, Tuple, Union
+from collections import deque
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
+import numpy as np
 import pytorch_lightning as pl
 import torch
 from torch import Tensor
-from torch.utils.data import DataLoader, Dataset, IterableDataset
+from torch import distributed as dist
+from torch import nn
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
 from tqdm import tqdm
 
 from bliss.catalog import TileCatalog
 from bliss.datasets.background import ConstantBackground, SimulatedSDSSBackground
 from bliss.datasets.galsim_galaxies import GalsimGalaxyPrior
 from bliss.models.decoder import ImageDecoder
-from bliss.models.prior import ImagePrior
+from bliss.models.prior import GalaxyPrior, ImagePrior
 
 # prevent pytorch_lightning warning for num_workers = 0 in dataloaders with IterableDataset
 warnings.filterwarnings(
     "ignore", ".*does not have many workers which may be a bottleneck.*", UserWarning
 )
 
+_MASK64 = (1 << 64) - 1
+
+# streams of simulated images, so that training, validation and test images never coincide.
+TRAIN_STREAM, VALID_STREAM, TEST_STREAM = 0, 1, 2
+
+
+def _splitmix64(x: int) -> int:
+    x = (x + 0x9E3779B97F4A7C15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+def get_image_seed(*counters: int) -> int:
+    """Hashes integer counters (e.g. seed, stream, epoch and image index) into a 63-bit seed.
+
+    The seed of each image only depends on its own counters, so any image can be regenerated
+    without replaying the images before it.
+    """
+    h = 0
+    for counter in counters:
+        h = _splitmix64(h ^ (counter & _MASK64))
+    return h >> 1
+
+
+def _get_shard_info() -> Tuple[int, int]:
+    # index and number of shards over (distributed rank, dataloader worker).
+    rank, world_size = 0, 1
+    if dist.is_available() and dist.is_initialized():
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+    worker_id, num_workers = 0, 1
+    worker_info = get_worker_info()
+    if worker_info is not None:
+        worker_id, num_workers = worker_info.id, worker_info.num_workers
+    return rank * num_workers + worker_id, world_size * num_workers
+
+
+def _hash_config(h, obj, seen: set):
+    # updates `h` with the content of `obj`: its tensors and public attributes, recursively.
+    # tensor attributes of modules that are not parameters or buffers (e.g. caches) are skipped.
+    if isinstance(obj, Tensor):
+        obj = obj.detach().cpu().numpy()
+    if isinstance(obj, np.ndarray):
+        h.update(f"{obj.dtype}{obj.shape}".encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (int, float, str, bool, type(None))):
+        h.update(repr(obj).encode())
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"[")
+        for x in obj:
+            _hash_config(h, x, seen)
+        h.update(b"]")
+    elif isinstance(obj, dict):
+        for k in sorted(obj, key=str):
+            h.update(str(k).encode())
+            _hash_config(h, obj[k], seen)
+    elif isinstance(obj, nn.Module):
+        tensors: Dict[str, Tensor] = {**dict(obj.named_parameters()), **dict(obj.named_buffers())}
+        _hash_config(h, tensors, seen)
+        for module in obj.modules():
+            h.update(type(module).__name__.encode())
+            attrs = {k: v for k, v in _public_attrs(module).items() if not isinstance(v, Tensor)}
+            _hash_config(h, attrs, seen)
+    else:
+        h.update(type(obj).__name__.encode())
+        if id(obj) not in seen:
+            seen.add(id(obj))
+            _hash_config(h, _public_attrs(obj), seen)
+
+
+def _public_attrs(obj) -> dict:
+    return {k: v for k, v in getattr(obj, "__dict__", {}).items() if not k.startswith("_")}
+
+
+class SharedBatchRing:
+    """Reusable shared-memory slots into which dataloader workers write their batches.
+
+    The buffers are allocated once in the main process and inherited by the workers. Each
+    worker copies its batches into its own `n_slots` slots in turn and returns views of them,
+    which are sent to the main process as handles of the (already mapped) shared storage instead
+    of new shared-memory segments. A worker only reuses a slot once the consumer has released the
+    batch in it (see `release` and `_RingDataLoader`), so `n_slots` must exceed the number of
+    batches prefetched per worker plus the number of batches held by the consumer.
+    """
+
+    def __init__(self, template: Dict[str, Tensor], n_workers: int, n_slots: int):
+        self.n_workers = n_workers
+        self.n_slots = n_slots
+        self.buffers = {
+            k: torch.empty((n_workers, n_slots, *v.shape), dtype=v.dtype).share_memory_()
+            for k, v in template.items()
+        }
+        self._next_slot = 0
+        self.reset()
+
+    def reset(self):
+        """Marks all slots as free, e.g. before workers are started for a new epoch."""
+        self._free_slots = [multiprocessing.Semaphore(self.n_slots) for _ in range(self.n_workers)]
+
+    def matches(self, batch: Dict[str, Tensor]) -> bool:
+        if batch.keys() != self.buffers.keys():
+            return False
+        return all(v.shape == self.buffers[k].shape[2:] for k, v in batch.items())
+
+    def put(self, worker_id: int, batch: Dict[str, Tensor]) -> Dict[str, Tensor]:
+        """Copies `batch` into the next slot of `worker_id` and returns views of that slot.
+
+        Waits until the consumer has released the batch previously returned in that slot.
+        """
+        self._free_slots[worker_id].acquire()
+        slot = self._next_slot
+        self._next_slot = (slot + 1) % self.n_slots
+        out = {}
+        for k, v in batch.items():
+            out[k] = self.buffers[k][worker_id, slot]
+            out[k].copy_(v)
+        return out
+
+    def release(self, batch: Dict[str, Tensor]):
+        """Frees the slot of a batch returned by `put` (as received by the consumer)."""
+        k, v = next(iter(batch.items()))
+        slot_numel = self.buffers[k][0, 0].numel()
+        worker_id = v.storage_offset() // (self.n_slots * slot_numel)
+        self._free_slots[worker_id].release()
+
+
+class PrefetchStats:
+    """Statistics of the batches simulated ahead of time by the producers of `SimulatedDataset`.
+
+    Statistics are gathered in the process iterating over the dataset. If the dataloader has
+    workers, each worker updates its own copy, so the statistics of the main process (and those
+    logged by `PrefetchStatsLogger`) are only gathered if `num_workers` is 0.
+
+    Attributes:
+        n_batches: Number of batches consumed.
+        queue_depth: Sum over consumed batches of the number of ready batches when requested.
+        stall_time: Total time (in seconds) spent waiting for batches to be simulated.
+        produce_time: Total time (in seconds) spent by the producers simulating batches.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_lock")
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.n_batches = 0
+            self.queue_depth = 0
+            self.stall_time = 0.0
+            self.produce_time = 0.0
+
+    def add_produced(self, produce_time: float):
+        with self._lock:
+            self.produce_time += produce_time
+
+    def add_consumed(self, queue_depth: int, stall_time: float):
+        with self._lock:
+            self.n_batches += 1
+            self.queue_depth += queue_depth
+            self.stall_time += stall_time
+
+    def as_dict(self) -> Dict[str, float]:
+        n_batches = max(self.n_batches, 1)
+        return {
+            "prefetch/queue_depth": self.queue_depth / n_batches,
+            "prefetch/stall_time": self.stall_time,
+            "prefetch/stall_time_per_batch": self.stall_time / n_batches,
+            "prefetch/produce_time_per_batch": self.produce_time / n_batches,
+        }
+
+
+class PrefetchStatsLogger(pl.Callback):
+    """Logs (and resets) the `PrefetchStats` of the training batches at the end of each epoch."""
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        stats = trainer.datamodule.prefetch_stats
+        pl_module.log_dict(stats.as_dict())
+        stats.reset()
+
 
 class SimulatedDataset(pl.LightningDataModule, IterableDataset):
     def __init__(
@@ -34,7 +236,42 @@ class SimulatedDataset(pl.LightningDataModule, IterableDataset):
         num_workers: int = 0,
         fix_validation_set: bool = False,
         valid_n_batches: Optional[int] = None,
+        galaxy_stamp_bank: bool = False,
+        seed: Optional[int] = None,
+        n_producers: int = 0,
+        prefetch_batches: int = 2,
+        pin_memory: bool = False,
+        valid_cache_dir: Optional[str] = None,
     ):
+        """Initializes SimulatedDataset.
+
+        Args:
+            prior: Prior from which catalogs are sampled.
+            decoder: Decoder rendering the catalogs into images.
+            background: Background added to the rendered images.
+            n_tiles_h: Number of tiles height-wise.
+            n_tiles_w: Number of tiles width-wise.
+            n_batches: Number of batches per epoch.
+            batch_size: Number of images per batch.
+            generate_device: Device on which images are simulated.
+            testing_file: Optional file (or sharded directory) of simulated test images.
+            num_workers: Number of workers of the dataloaders.
+            fix_validation_set: If True, the same validation images are used every epoch.
+            valid_n_batches: Number of batches of the fixed validation set.
+            galaxy_stamp_bank: If True, decode all galaxy latents of the prior once.
+            seed: If given, the randomness of each image is derived from
+                `(seed, stream, epoch, image_index)` (see `get_image_seed`) instead of the
+                global RNG state. Batches are then split across dataloader workers and
+                distributed ranks, and any image can be regenerated with `get_batch`.
+            n_producers: Number of threads simulating batches ahead of the training loop into
+                a bounded queue (see `prefetch_stats`, which is only gathered if `num_workers`
+                is 0). If 0, batches are simulated on request.
+            prefetch_batches: Maximum number of ready batches queued by the producers.
+            pin_memory: If True, batches simulated on the cpu are returned in pinned memory.
+            valid_cache_dir: If given (and `fix_validation_set` is True), the validation set
+                is generated once, saved as shards in a subdirectory named after
+                `get_valid_cache_key`, and memory-mapped from there on later runs and reloads.
+        """
         super().__init__()
 
         self.n_batches = n_batches
@@ -55,6 +292,20 @@ class SimulatedDataset(pl.LightningDataModule, IterableDataset):
         self.num_workers = num_workers
         self.fix_validation_set = fix_validation_set
         self.valid_n_batches = n_batches if valid_n_batches is None else valid_n_batches
+        self.seed = seed
+        self.n_producers = n_producers
+        self.prefetch_batches = prefetch_batches
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.prefetch_stats = PrefetchStats()
+        self._ring: Optional[SharedBatchRing] = None
+        self.valid_cache_dir = valid_cache_dir
+        self._valid_dataset: Optional["ShardedBlissDataset"] = None
+
+        # decode all galaxy latents of the prior once, instead of for every batch.
+        self.galaxy_stamp_bank = galaxy_stamp_bank
+        if self.galaxy_stamp_bank:
+            assert isinstance(self.image_prior.galaxy_prior, GalaxyPrior)
+            self.image_decoder.set_galaxy_stamp_bank(self.image_prior.galaxy_prior.latents)
 
         # check training will work.
         total_ptiles = self.batch_size * self.n_tiles_h * self.n_tiles_w
@@ -70,25 +321,52 @@ class SimulatedDataset(pl.LightningDataModule, IterableDataset):
             generate_device
         )
 
-    def sample_prior(self, batch_size: int, n_tiles_h: int, n_tiles_w: int) -> TileCatalog:
-        return self.image_prior.sample_prior(self.tile_slen, batch_size, n_tiles_h, n_tiles_w)
+    def sample_prior(
+        self,
+        batch_size: int,
+        n_tiles_h: int,
+        n_tiles_w: int,
+        generators: Optional[Sequence[torch.Generator]] = None,
+    ) -> TileCatalog:
+        return self.image_prior.sample_prior(
+            self.tile_slen,
+            batch_size,
+            n_tiles_h,
+            n_tiles_w,
+            galaxy_indices=self.galaxy_stamp_bank,
+            generators=generators,
+        )
 
-    def simulate_image_from_catalog(self, tile_catalog: TileCatalog) -> Tuple[Tensor, Tensor]:
+    def simulate_image_from_catalog(
+        self, tile_catalog: TileCatalog, generators: Optional[Sequence[torch.Generator]] = None
+    ) -> Tuple[Tensor, Tensor]:
         images = self.image_decoder.render_images(tile_catalog)
-        background = self.background.sample(images.shape)
+        if generators is None:
+            background = self.background.sample(images.shape)
+        else:
+            assert len(generators) == len(images)
+            shape = (1, *images.shape[1:])
+            background = torch.cat([self.background.sample(shape, gen) for gen in generators])
         images += background
-        images = self._apply_noise(images)
+        images = self._apply_noise(images, generators)
         return images, background
 
     @staticmethod
-    def _apply_noise(images_mean):
+    def _apply_noise(images_mean, generators: Optional[Sequence[torch.Generator]] = None):
         # add noise to images.
 
         if torch.any(images_mean <= 0):
             warnings.warn("image mean less than 0")
             images_mean = images_mean.clamp(min=1.0)
 
-        images = torch.sqrt(images_mean) * torch.randn_like(images_mean)
+        if generators is None:
+            noise = torch.randn_like(images_mean)
+        else:
+            shape, device = images_mean.shape[1:], images_mean.device
+            noise = torch.stack(
+                [torch.randn(shape, device=device, generator=gen) for gen in generators]
+            )
+        images = torch.sqrt(images_mean) * noise
         images += images_mean
 
         return images
@@ -98,37 +376,291 @@ class SimulatedDataset(pl.LightningDataModule, IterableDataset):
         return self.image_decoder.tile_slen
 
     def __iter__(self):
-        for _ in range(self.n_batches):
-            yield self.get_batch()
-
-    def get_batch(self) -> Dict[str, Tensor]:
+        return self._iter_stream(self.n_batches, TRAIN_STREAM)
+
+    def _iter_stream(self, n_batches: int, stream: int):
+        # inside dataloader workers, training batches are returned through the ring.
+        batches = self.iter_batches(n_batches, stream)
+        worker_info = get_worker_info()
+        ring = self._ring if stream == TRAIN_STREAM else None
+        if worker_info is None or ring is None:
+            yield from batches
+            return
+        for batch in batches:
+            yield ring.put(worker_info.id, batch) if ring.matches(batch) else batch
+
+    def iter_batches(self, n_batches: int, stream: int, epoch: Optional[int] = None):
+        """Yields `n_batches` batches, split across workers and ranks if `self.seed` is set."""
+        jobs: List[Optional[range]] = [None] * n_batches
+        if self.seed is not None:
+            if epoch is None:
+                epoch = 0 if self.trainer is None else self.trainer.current_epoch
+            shard_id, n_shards = _get_shard_info()
+            bsize = self.batch_size
+            batch_indices = range(shard_id, n_batches, n_shards)
+            jobs = [range(b * bsize, (b + 1) * bsize) for b in batch_indices]
+        epoch = 0 if epoch is None else epoch
+
+        if self.n_producers > 0:
+            stats = self.prefetch_stats if stream == TRAIN_STREAM else PrefetchStats()
+            yield from self._prefetch(jobs, epoch, stream, stats)
+        else:
+            for job in jobs:
+                yield self.get_batch(job, epoch, stream)
+
+    def _prefetch(self, jobs, epoch: int, stream: int, stats: PrefetchStats):
+        # producer i simulates jobs i, i + n_producers, ... into its own queue, so that batches
+        # are yielded in the order of `jobs`.
+        if not jobs:
+            return
+        n_producers = min(self.n_producers, len(jobs))
+        maxsize = max(1, math.ceil(self.prefetch_batches / n_producers))
+        queues: List[queue.Queue] = [queue.Queue(maxsize) for _ in range(n_producers)]
+        stop = threading.Event()
+
+        # without a seed, each producer draws its batches from its own generator (instead of
+        # sharing the global RNG), seeded from the global RNG and the id of the producer.
+        generators: List[Optional[torch.Generator]] = [None] * n_producers
+        if self.seed is None:
+            base_seed = int(torch.randint(2**62, (1,)))
+            device = self.image_prior.device
+            assert isinstance(device, torch.device)
+            generators = [
+                torch.Generator(device=device).manual_seed(get_image_seed(base_seed, i))
+                for i in range(n_producers)
+            ]
+        producers = [
+            threading.Thread(
+                target=self._produce,
+                args=(jobs[i::n_producers], epoch, stream, queues[i], stop, stats, generators[i]),
+                daemon=True,
+            )
+            for i in range(n_producers)
+        ]
+        for producer in producers:
+            producer.start()
+        try:
+            for i in range(len(jobs)):
+                queue_depth = sum(q.qsize() for q in queues)
+                tic = time.perf_counter()
+                batch, error = queues[i % n_producers].get()
+                stats.add_consumed(queue_depth, time.perf_counter() - tic)
+                if error is not None:
+                    raise error
+                yield batch
+        finally:
+            stop.set()
+            for producer in producers:
+                producer.join()
+
+    def _produce(
+        self, jobs, epoch, stream, out: queue.Queue, stop: threading.Event, stats, generator=None
+    ):
+        item: Tuple[Optional[Dict[str, Tensor]], Optional[Exception]]
+        for job in jobs:
+            tic = time.perf_counter()
+            try:
+                batch = self.get_batch(job, epoch, stream, generator)
+                if self.pin_memory:
+                    batch = {k: v.pin_memory() if v.is_cpu else v for k, v in batch.items()}
+                item = (batch, None)
+            except Exception as error:  # pylint: disable=broad-except
+                item = (None, error)
+            stats.add_produced(time.perf_counter() - tic)
+            while not stop.is_set():
+                try:
+                    out.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if stop.is_set() or item[1] is not None:
+                return
+
+    def get_batch(
+        self,
+        image_indices: Optional[Sequence[int]] = None,
+        epoch: int = 0,
+        stream: int = TRAIN_STREAM,
+        generator: Optional[torch.Generator] = None,
+    ) -> Dict[str, Tensor]:
+        """Simulates a batch of images with their catalogs.
+
+        Args:
+            image_indices: Indices of the images to simulate. Requires `self.seed` to be set,
+                the randomness of each image is then derived from
+                `(self.seed, stream, epoch, image_index)`. If None, a batch of
+                `self.batch_size` images is drawn from `generator`.
+            epoch: Epoch of the images to simulate.
+            stream: Stream of the images (e.g. `TRAIN_STREAM` or `VALID_STREAM`).
+            generator: Generator (on the device of the prior) from which a batch without
+                `image_indices` is drawn. If None, the global RNG is used.
+
+        Returns:
+            Dictionary with the tile catalog parameters, images and background.
+        """
         with torch.no_grad():
-            tile_catalog = self.sample_prior(self.batch_size, self.n_tiles_h, self.n_tiles_w)
-            images, background = self.simulate_image_from_catalog(tile_catalog)
+            generators: Optional[List[torch.Generator]] = None
+            if image_indices is not None:
+                assert self.seed is not None, "Images can only be indexed if a seed is given."
+                generators = self._get_generators(image_indices, epoch, stream)
+            elif generator is not None:
+                generators = [generator] * self.batch_size
+            n_images = self.batch_size if generators is None else len(generators)
+            tile_catalog = self.sample_prior(n_images, self.n_tiles_h, self.n_tiles_w, generators)
+            images, background = self.simulate_image_from_catalog(tile_catalog, generators)
             return {**tile_catalog.to_dict(), "images": images, "background": background}
 
+    def _get_generators(self, image_indices, epoch: int, stream: int):
+        # one generator per image, on the device of the prior.
+        assert self.seed is not None
+        device = self.image_prior.device
+        assert isinstance(device, torch.device)
+        generators = []
+        for i in image_indices:
+            generator = torch.Generator(device=device)
+            generators.append(generator.manual_seed(get_image_seed(self.seed, stream, epoch, i)))
+        return generators
+
+    def _get_dataloader(self, dataset: IterableDataset, stream: int) -> DataLoader:
+        if self.num_workers == 0:
+            return DataLoader(dataset, batch_size=None)
+        self._share_memory()
+
+        # only training batches on the cpu go through the ring, when consumed by a trainer.
+        # it has one slot per prefetched batch and per batch held by the consumer, plus one.
+        prefetch_factor = 2
+        if stream == TRAIN_STREAM:
+            ring = self._ring
+            if self.trainer is None or self.image_prior.device.type != "cpu":
+                ring = None
+            elif ring is None or ring.n_workers != self.num_workers:
+                with torch.random.fork_rng(devices=[]):
+                    template = self.get_batch()
+                n_slots = prefetch_factor + _RingDataLoader.n_held + 1
+                ring = SharedBatchRing(template, self.num_workers, n_slots)
+            self._ring = ring
+            if ring is not None:
+                return _RingDataLoader(
+                    ring,
+                    dataset,
+                    batch_size=None,
+                    num_workers=self.num_workers,
+                    prefetch_factor=prefetch_factor,
+                )
+        return DataLoader(
+            dataset,
+            batch_size=None,
+            num_workers=self.num_workers,
+            prefetch_factor=prefetch_factor,
+        )
+
+    def _share_memory(self):
+        # workers then map the tensors of the prior and decoder instead of copying them.
+        for module in (self.image_prior, self.image_decoder, self.background):
+            module.share_memory()
+        galaxy_prior = self.image_prior.galaxy_prior
+        if isinstance(galaxy_prior, GalaxyPrior) and galaxy_prior.latents.is_cpu:
+            galaxy_prior.latents.share_memory_()
+
     def train_dataloader(self):
-        return DataLoader(self, batch_size=None, num_workers=self.num_workers)
+        return self._get_dataloader(self, TRAIN_STREAM)
+
+    def get_valid_cache_key(self) -> str:
+        """Hash of the prior, decoder and background and of the validation set parameters."""
+        h = hashlib.sha256()
+        params = (self.n_tiles_h, self.n_tiles_w, self.batch_size, self.valid_n_batches)
+        _hash_config(h, (params, self.seed, self.galaxy_stamp_bank), set())
+        for module in (self.image_prior, self.image_decoder, self.background):
+            _hash_config(h, module, set())
+        return h.hexdigest()[:32]
+
+    def _get_cached_valid_dataset(self) -> "ShardedBlissDataset":
+        if self._valid_dataset is None:
+            assert self.valid_cache_dir is not None
+            dirpath = Path(self.valid_cache_dir) / self.get_valid_cache_key()
+            if not (dirpath / ShardedDatasetWriter.manifest_name).exists():
+                self._write_valid_set(dirpath)
+            self._valid_dataset = ShardedBlissDataset(dirpath)
+        return self._valid_dataset
+
+    def _write_valid_set(self, dirpath: Path):
+        # write to a temporary directory first, so that concurrent runs never read partial sets.
+        tmp_dirpath = dirpath.with_name(f"{dirpath.name}.tmp-{os.getpid()}")
+        with ShardedDatasetWriter(tmp_dirpath, self.batch_size, global_params=()) as writer:
+            for b in tqdm(range(self.valid_n_batches), desc="Generating fixed validation set"):
+                indices = None
+                if self.seed is not None:
+                    indices = range(b * self.batch_size, (b + 1) * self.batch_size)
+                writer.add(self.get_batch(indices, 0, VALID_STREAM))
+        try:
+            os.replace(tmp_dirpath, dirpath)
+        except OSError:
+            # another run saved the same validation set first.
+            shutil.rmtree(tmp_dirpath)
 
     def val_dataloader(self):
+        if self.fix_validation_set and self.valid_cache_dir is not None:
+            valid_dataset = self._get_cached_valid_dataset()
+            return DataLoader(valid_dataset, batch_size=self.batch_size, num_workers=0)
         if self.fix_validation_set:
             valid: List[Dict[str, Tensor]] = []
-            for _ in tqdm(range(self.valid_n_batches), desc="Generating fixed validation set"):
-                valid.append(self.get_batch())
-            num_workers = 0
-        else:
-            valid = self
-            num_workers = self.num_workers
-        return DataLoader(valid, batch_size=None, num_workers=num_workers)
+            batches = self.iter_batches(self.valid_n_batches, VALID_STREAM, epoch=0)
+            for batch in tqdm(
+                batches, desc="Generating fixed validation set", total=self.valid_n_batches
+            ):
+                valid.append(batch)
+            return DataLoader(valid, batch_size=None, num_workers=0)
+        return self._get_dataloader(_SimulatedStream(self, VALID_STREAM), VALID_STREAM)
 
     def test_dataloader(self):
-        dl = DataLoader(self, batch_size=None, num_workers=self.num_workers)
+        if self.testing_file is None:
+            return self._get_dataloader(_SimulatedStream(self, TEST_STREAM), TEST_STREAM)
 
-        if self.testing_file is not None:
+        if Path(self.testing_file).is_dir():
+            test_dataset = ShardedBlissDataset(self.testing_file)
+        else:
             test_dataset = BlissDataset(self.testing_file)
-            dl = DataLoader(test_dataset, batch_size=self.batch_size, num_workers=0)
+        return DataLoader(test_dataset, batch_size=self.batch_size, num_workers=0)
+
 
-        return dl
+class _RingDataLoader(DataLoader):
+    """DataLoader that returns the batches of a `SharedBatchRing` and releases their slots.
+
+    Batches are returned without copies, and their slot is released once `n_held` more batches
+    have been requested (as a trainer may fetch the next batch before it uses the current one).
+    Batches kept for longer must be copied.
+    """
+
+    n_held = 2
+
+    def __init__(self, ring: SharedBatchRing, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ring = ring
+
+    def __iter__(self):
+        # batches of the workers of a previous iteration are never released.
+        self.ring.reset()
+        held = deque()
+        try:
+            for batch in super().__iter__():
+                held.append(batch)
+                if len(held) > self.n_held:
+                    self.ring.release(held.popleft())
+                yield batch
+        finally:
+            while held:
+                self.ring.release(held.popleft())
+
+
+class _SimulatedStream(IterableDataset):
+    # iterates over the batches of a `SimulatedDataset` in a given stream.
+    def __init__(self, dataset: SimulatedDataset, stream: int):
+        super().__init__()
+        self.dataset = dataset
+        self.stream = stream
+
+    def __iter__(self):
+        return self.dataset._iter_stream(self.dataset.n_batches, self.stream)  # noqa: WPS437
 
 
 def cpu(d: Dict[str, Tensor]):
@@ -160,3 +692,144 @@ class BlissDataset(Dataset):
         d = {k: v[idx] for k, v in self.data.items()}
         d.update({"background": self.background, "slen": self.slen})
         return d
+
+
+class ShardedDatasetWriter:
+    """Writes simulated batches incrementally to a directory of fixed-size `.npy` shards.
+
+    Each non-global key of the batches is stored as one `.npy` file per shard of `shard_size`
+    images (the last shard may be smaller), global parameters are stored once, and a
+    `manifest.json` describing the shards is written by `close`. The manifest is only written
+    once all shards are on disk, so a directory with a manifest is always complete.
+    """
+
+    manifest_name = "manifest.json"
+
+    def __init__(self, dirpath, shard_size: int, global_params=("background", "slen")):
+        assert shard_size > 0, "Shards need at least one image."
+        self.dirpath = Path(dirpath)
+        self.shard_size = shard_size
+        self.global_params = set(global_params)
+
+        self.dirpath.mkdir(parents=True, exist_ok=True)
+        manifest_path = self.dirpath / self.manifest_name
+        if manifest_path.exists():
+            manifest_path.unlink()
+
+        self.shards: List[Dict] = []
+        self.global_files: Dict[str, str] = {}
+        self.n_images = 0
+        self._pending: Dict[str, List[np.ndarray]] = {}
+        self._n_pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def add(self, batch: Dict[str, Tensor]):
+        """Adds a batch of images, writing every shard that is complete."""
+        if not self._pending and not self.global_files:
+            for key, val in batch.items():
+                if key in self.global_params:
+                    fname = f"global-{key}.npy"
+                    np.save(self.dirpath / fname, val[0].cpu().numpy())
+                    self.global_files[key] = fname
+                else:
+                    self._pending[key] = []
+        n_batch = len(batch["images"])
+        for key, chunks in self._pending.items():
+            val = batch[key]
+            assert len(val) == n_batch, f"Key '{key}' has inconsistent batch size."
+            chunks.append(val.cpu().numpy())
+        self._n_pending += n_batch
+        while self._n_pending >= self.shard_size:
+            self._write_shard(self.shard_size)
+
+    def close(self) -> Path:
+        """Writes the last (partial) shard and the manifest. Returns the manifest path."""
+        if self._n_pending > 0:
+            self._write_shard(self._n_pending)
+        manifest = {
+            "n_images": self.n_images,
+            "shard_size": self.shard_size,
+            "shards": self.shards,
+            "global_params": self.global_files,
+        }
+        manifest_path = self.dirpath / self.manifest_name
+        tmp_path = manifest_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as fp:
+            json.dump(manifest, fp, indent=2)
+        os.replace(tmp_path, manifest_path)
+        return manifest_path
+
+    def _write_shard(self, n_images: int):
+        shard_idx = len(self.shards)
+        files = {}
+        for key, chunks in self._pending.items():
+            arr = np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+            fname = f"shard-{shard_idx:05d}-{key}.npy"
+            np.save(self.dirpath / fname, arr[:n_images])
+            files[key] = fname
+            self._pending[key] = [arr[n_images:]] if len(arr) > n_images else []
+        self.shards.append({"n_images": n_images, "files": files})
+        self.n_images += n_images
+        self._n_pending -= n_images
+
+
+class ShardedBlissDataset(Dataset):
+    """A dataset of simulated images read from shards written by `ShardedDatasetWriter`.
+
+    Shards are memory-mapped, so images are only read from disk when indexed and datasets
+    larger than memory can be used. The memory maps are opened lazily and are not pickled,
+    hence each DataLoader worker opens its own maps instead of receiving a copy of the data.
+    Items have the same keys as those of `BlissDataset`.
+    """
+
+    def __init__(self, dirpath: Union[str, Path]):
+        super().__init__()
+        self.dirpath = Path(dirpath)
+        with open(self.dirpath / ShardedDatasetWriter.manifest_name, encoding="utf-8") as fp:
+            manifest = json.load(fp)
+        self.size = manifest["n_images"]
+        self.shard_size = manifest["shard_size"]
+        self.shard_files = [shard["files"] for shard in manifest["shards"]]
+        self.global_files = manifest["global_params"]
+        self._shards: Optional[List[Dict[str, np.ndarray]]] = None
+        self._global: Optional[Dict[str, Tensor]] = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        state["_global"] = None
+        return state
+
+    def __len__(self):
+        """Get the number of images saved in the shards."""
+        return self.size
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.size
+        if not 0 <= idx < self.size:
+            raise IndexError(f"Index {idx} out of range for dataset of size {self.size}.")
+        if self._shards is None:
+            self._open()
+        shard = self._shards[idx // self.shard_size]
+        local_idx = idx % self.shard_size
+        d = {k: torch.from_numpy(np.asarray(v[local_idx])) for k, v in shard.items()}
+        d.update(self._global)
+        return d
+
+    def _open(self):
+        # copy-on-write maps, so that tensors can be created without copying or warnings.
+        self._shards = [
+            {k: np.load(self.dirpath / fname, mmap_mode="c") for k, fname in files.items()}
+            for files in self.shard_files
+        ]
+        self._global = {
+            k: torch.from_numpy(np.load(self.dirpath / fname))
+            for k, fname in self.global_files.items()
+        }
@@ -5,7 +5,12 @@ import torch
 from torch import Tensor, nn
 from tqdm import tqdm
 
-from bliss.catalog import TileCatalog, get_images_in_tiles, get_is_on_from_n_sources
+from bliss.catalog import (
+    TileCatalog,
+    get_images_in_tiles,
+    get_is_on_from_n_sources,
+    get_ptile_batches,
+)
 from bliss.models.binary import BinaryEncoder
 from bliss.models.galaxy_encoder import GalaxyEncoder
 from bliss.models.location_encoder import LocationEncoder
@@ -35,6 +40,8 @@ class Encoder(nn.Module):
         galaxy_encoder: Optional[GalaxyEncoder] = None,
         map_n_source_weights: Optional[Tuple[float, ...]] = None,
         batch_size: Optional[int] = None,
+        sparse: bool = True,
+        frame_encoding: bool = False,
     ):
         """Initializes Encoder.
 
@@ -55,6 +62,14 @@ class Encoder(nn.Module):
                 sources on/off.
             batch_size: How many padded tiles can be rendered at a time on the GPU?
                 If not specified, defaults to an amount known to fit on my GPU.
+            sparse: If True (default), the binary and galaxy encoders only process the padded tiles
+                where the location encoder detected at least one source. Their output on all
+                other tiles is zero (as in the dense mode), so results are unchanged.
+            frame_encoding: If True, the location encoder runs its convolutional network once
+                over the full images instead of on each padded tile (see
+                `LocationEncoder.encode_frame`). This is much faster, but its output differs from
+                that of the location encoder on padded tiles, which it was trained on. Defaults
+                to False.
         """
         super().__init__()
         self._dummy_param = nn.Parameter(torch.empty(0))
@@ -69,7 +84,10 @@ class Encoder(nn.Module):
             map_n_source_weights_tnsr = torch.tensor(map_n_source_weights)
 
         self.batch_size = batch_size if batch_size is not None else 75**2 + 500 * 5
+        self.sparse = sparse
+        self.frame_encoding = frame_encoding
         self.register_buffer("map_n_source_weights", map_n_source_weights_tnsr, persistent=False)
+        self._cache: Optional[Dict] = None
 
     def forward(self, x):
         raise NotImplementedError("Unavailable. Use .variational_mode() or .sample() instead.")
@@ -77,7 +95,9 @@ class Encoder(nn.Module):
     def sample(self, image_ptiles, n_samples):
         raise NotImplementedError("Sampling from Encoder not yet available.")
 
-    def variational_mode(self, image: Tensor, background: Tensor) -> TileCatalog:
+    def variational_mode(
+        self, image: Tensor, background: Tensor, cache_dist_params: bool = False
+    ) -> TileCatalog:
         """Get maximum a posteriori of catalog from image padded tiles.
 
         Note that, strictly speaking, this is not the true MAP of the variational
@@ -92,6 +112,10 @@ class Encoder(nn.Module):
                 with shape `n * n_bands * h * w`.
             background: Background associated with image,
                 with shape `n * n_bands * h * w`.
+            cache_dist_params: If True, keep the image, the per-tile distributional parameters
+                of the location encoder and the resulting MAP on the encoder, so that the
+                catalog can be recomputed for other `map_n_source_weights` with `rethreshold`.
+                Otherwise (default), any previous cache is cleared.
 
         Returns:
             A dictionary of the maximum a posteriori
@@ -102,48 +126,128 @@ class Encoder(nn.Module):
         """
         n_tiles_h = (image.shape[2] - 2 * self.border_padding) // self.location_encoder.tile_slen
         n_tiles_w = (image.shape[3] - 2 * self.border_padding) // self.location_encoder.tile_slen
-        ptile_loader = self._make_ptile_loader(image, background, n_tiles_h, n_tiles_w)
+        ptile_loader = self._make_ptile_loader(image, background)
         tile_map_list: List[Dict[str, Tensor]] = []
         with torch.no_grad():
+            encode = self.location_encoder.encode_image
+            if self.frame_encoding:
+                encode = self.location_encoder.encode_frame
+            dist_params = encode(image.to(self.device), background.to(self.device), self.batch_size)
+            start = 0
             for ptiles in tqdm(ptile_loader, desc="Encoding ptiles"):
                 assert isinstance(ptiles, Tensor)
-                out_ptiles = self._encode_ptiles(ptiles)
+                end = start + len(ptiles)
+                ptiles_dist_params = {k: v[start:end] for k, v in dist_params.items()}
+                out_ptiles = self._encode_ptiles(ptiles, ptiles_dist_params)
                 tile_map_list.append(out_ptiles)
+                start = end
         tile_map_dict = self._collate(tile_map_list)
+        self._cache = None
+        if cache_dist_params:
+            self._cache = {
+                "image": image,
+                "background": background,
+                "dist_params": dist_params,
+                "tile_map": tile_map_dict,
+                "n_tiles": (n_tiles_h, n_tiles_w),
+            }
         return TileCatalog.from_flat_dict(
             self.location_encoder.tile_slen, n_tiles_h, n_tiles_w, tile_map_dict
         )
 
-    def _make_ptile_loader(self, image: Tensor, background: Tensor, n_tiles_h: int, n_tiles_w: int):
-        img_bg = torch.cat((image, background), dim=1).to(self.device)
-        n_rows_per_batch = self.batch_size // n_tiles_w
-        for row in range(0, n_tiles_h, n_rows_per_batch):
-            end_row = row + n_rows_per_batch
-            start_h = row * self.location_encoder.tile_slen
-            end_h = end_row * self.location_encoder.tile_slen + 2 * self.border_padding
-            img_bg_cropped = img_bg[:, :, start_h:end_h, :]
-            image_ptiles = get_images_in_tiles(
-                img_bg_cropped, self.location_encoder.tile_slen, self.location_encoder.ptile_slen
+    def rethreshold(self, map_n_source_weights: Tuple[float, ...]) -> TileCatalog:
+        """Recompute the MAP catalog of the last cached image for other `map_n_source_weights`.
+
+        The location encoder is not run again; its MAP is recomputed from the cached
+        distributional parameters. The binary and galaxy encoders are only run on the padded tiles
+        whose number of sources changed (and is still positive), since their output is conditioned
+        on the locations. The output on all other padded tiles is taken from the cached catalog.
+
+        Args:
+            map_n_source_weights: Weights of the argmax in MAP estimation of the number of sources,
+                as in `__init__`.
+
+        Returns:
+            The same catalog as `variational_mode` of an `Encoder` with these weights.
+        """
+        assert self._cache is not None, "Call `variational_mode` with `cache_dist_params=True`."
+        cache = self._cache
+        weights = torch.as_tensor(map_n_source_weights, dtype=torch.float, device=self.device)
+        with torch.no_grad():
+            tile_map_dict = self.location_encoder.variational_mode(
+                cache["dist_params"], n_source_weights=weights
             )
-            image_ptiles = image_ptiles.view(-1, *image_ptiles.shape[-3:])
-            yield image_ptiles
+            n_sources = tile_map_dict["n_sources"]
+            changed = n_sources != cache["tile_map"]["n_sources"]
+            for k, v in cache["tile_map"].items():
+                if k not in tile_map_dict:
+                    tile_map_dict[k] = v.clone()
+                    tile_map_dict[k][changed] = 0
+
+            is_new_ptile = changed & (n_sources > 0)
+            has_conditional = self.binary_encoder is not None or self.galaxy_encoder is not None
+            if has_conditional and is_new_ptile.any():
+                start = 0
+                for ptiles in self._make_ptile_loader(cache["image"], cache["background"]):
+                    end = start + len(ptiles)
+                    is_new = is_new_ptile[start:end]
+                    if is_new.any():
+                        ptiles_map = {k: v[start:end] for k, v in tile_map_dict.items()}
+                        out_ptiles = self._encode_conditional(ptiles, ptiles_map, is_new)
+                        for k, v in out_ptiles.items():
+                            tile_map_dict[k][start:end][is_new] = v[is_new]
+                    start = end
+        n_tiles_h, n_tiles_w = cache["n_tiles"]
+        return TileCatalog.from_flat_dict(
+            self.location_encoder.tile_slen, n_tiles_h, n_tiles_w, tile_map_dict
+        )
+
+    def _make_ptile_loader(self, image: Tensor, background: Tensor):
+        img_bg = torch.cat((image, background), dim=1).to(self.device)
+        yield from get_ptile_batches(
+            img_bg,
+            self.location_encoder.tile_slen,
+            self.location_encoder.ptile_slen,
+            self.batch_size,
+        )
 
-    def _encode_ptiles(self, image_ptiles: Tensor):
+    def _encode_ptiles(self, image_ptiles: Tensor, dist_params: Dict[str, Tensor]):
         assert isinstance(self.map_n_source_weights, Tensor)
-        dist_params = self.location_encoder.encode(image_ptiles)
         tile_map_dict = self.location_encoder.variational_mode(
             dist_params, n_source_weights=self.map_n_source_weights
         )
+        is_on_ptile = tile_map_dict["n_sources"] > 0 if self.sparse else None
+        tile_map_dict.update(self._encode_conditional(image_ptiles, tile_map_dict, is_on_ptile))
+        return tile_map_dict
+
+    def _encode_conditional(
+        self,
+        image_ptiles: Tensor,
+        tile_map_dict: Dict[str, Tensor],
+        is_on_ptile: Optional[Tensor] = None,
+    ) -> Dict[str, Tensor]:
+        """Runs the binary and galaxy encoders conditioned on the location MAP.
+
+        If `is_on_ptile` is given, only the padded tiles where it is True are processed and
+        the output on all other padded tiles is zero.
+        """
         locs = tile_map_dict["locs"]
         n_sources = tile_map_dict["n_sources"]
         is_on_array = get_is_on_from_n_sources(n_sources, self.location_encoder.max_detections)
+        if is_on_ptile is not None:
+            image_ptiles = image_ptiles[is_on_ptile]
+            locs = locs[is_on_ptile]
+            n_sources = n_sources[is_on_ptile]
+            is_on_array = is_on_array[is_on_ptile]
+
+        out: Dict[str, Tensor] = {}
         if self.binary_encoder is not None:
             assert not self.binary_encoder.training
-            galaxy_probs = self.binary_encoder.forward(image_ptiles, locs)
+            galaxy_probs = self._run_on_ptiles(self.binary_encoder.forward, image_ptiles, locs)
             galaxy_probs *= is_on_array.unsqueeze(-1)
             galaxy_bools = (galaxy_probs > 0.5).float() * is_on_array.unsqueeze(-1)
             star_bools = get_star_bools(n_sources, galaxy_bools)
-            tile_map_dict.update(
+            out.update(
                 {
                     "galaxy_bools": galaxy_bools,
                     "star_bools": star_bools,
@@ -152,11 +256,24 @@ class Encoder(nn.Module):
             )
 
         if self.galaxy_encoder is not None:
-            galaxy_params = self.galaxy_encoder.variational_mode(image_ptiles, locs)
+            galaxy_params = self._run_on_ptiles(
+                self.galaxy_encoder.variational_mode, image_ptiles, locs
+            )
             galaxy_params *= is_on_array.unsqueeze(-1) * galaxy_bools
-            tile_map_dict.update({"galaxy_params": galaxy_params})
+            out.update({"galaxy_params": galaxy_params})
 
-        return tile_map_dict
+        if is_on_ptile is not None:
+            out = {k: _scatter_ptiles(v, is_on_ptile) for k, v in out.items()}
+        return out
+
+    @staticmethod
+    def _run_on_ptiles(encode, image_ptiles: Tensor, locs: Tensor) -> Tensor:
+        # avoids running modules (e.g. batch norm) on an empty batch of padded tiles.
+        if image_ptiles.shape[0] == 0:
+            dummy_ptiles = image_ptiles.new_zeros(1, *image_ptiles.shape[1:])
+            dummy_locs = locs.new_zeros(1, *locs.shape[1:])
+            return encode(dummy_ptiles, dummy_locs)[:0]
+        return encode(image_ptiles, locs)
 
     @staticmethod
     def _collate(tile_map_list: List[Dict[str, Tensor]]) -> Dict[str, Tensor]:
@@ -188,3 +305,10 @@ def get_star_bools(n_sources, galaxy_bools):
     is_on_array = get_is_on_from_n_sources(n_sources, max_sources)
     is_on_array = is_on_array.view(*galaxy_bools.shape)
     return (1 - galaxy_bools) * is_on_array
+
+
+def _scatter_ptiles(x_on: Tensor, is_on_ptile: Tensor) -> Tensor:
+    """Scatters output on the padded tiles in `is_on_ptile` back into all padded tiles."""
+    x = x_on.new_zeros(is_on_ptile.shape[0], *x_on.shape[1:])
+    x[is_on_ptile] = x_on
+    return x
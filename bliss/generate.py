@@ -1,9 +1,10 @@
 import math
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
 import torch
 from matplotlib import pyplot as plt
 
+from bliss.datasets.simulated import ShardedBlissDataset, ShardedDatasetWriter
 from bliss.reporting import plot_image
 
 
@@ -26,24 +27,48 @@ def visualize(batch, path, n_samples, figsize=(12, 12)):
     fig.savefig(path, bbox_inches="tight")
 
 
-def generate(dataset, filepath, imagepath, n_plots: int, global_params=("background", "slen")):
-    # setup
+def generate(
+    dataset,
+    filepath,
+    imagepath,
+    n_plots: int,
+    global_params=("background", "slen"),
+    shard_size: Optional[int] = None,
+):
+    """Simulates all batches of `dataset.train_dataloader()` and saves them to disk.
+
+    Args:
+        dataset: Dataset whose training dataloader yields the simulated batches.
+        filepath: Output file, or output directory if `shard_size` is given.
+        imagepath: Where to save a figure with the first `n_plots` images.
+        n_plots: Number of images to plot (must be a square number).
+        global_params: Parameters common to all batches, saved only once (not stacked).
+        shard_size: If given, batches are written incrementally to `.npy` shards of
+            `shard_size` images each (see `ShardedDatasetWriter`) instead of a single `.pt` file.
+            The output can then be read with `ShardedBlissDataset`.
+    """
+    if shard_size is not None:
+        with ShardedDatasetWriter(filepath, shard_size, global_params) as writer:
+            for batch in dataset.train_dataloader():
+                writer.add(batch)
+        sharded = ShardedBlissDataset(filepath)
+        images = torch.stack([sharded[i]["images"] for i in range(n_plots)])
+        visualize({"images": images}, imagepath, n_plots)
+        return
 
     # params common to all batches (do not stack).
     global_params = set(global_params)
 
-    # get batches and combine them
+    # collect batches and combine them once at the end.
     fbatch: Dict[str, Any] = {}
+    batches: Dict[str, List[torch.Tensor]] = {}
     for batch in dataset.train_dataloader():
         if not bool(fbatch):  # dict is empty
-            fbatch = batch
-            for key, val in fbatch.items():
-                if key in global_params:
-                    fbatch[key] = val[0]
-        else:
-            for key, val in fbatch.items():
-                if key not in global_params:
-                    fbatch[key] = torch.vstack((val, batch[key]))
+            fbatch = {k: v[0] for k, v in batch.items() if k in global_params}
+            batches = {k: [] for k in batch if k not in global_params}
+        for key, vals in batches.items():
+            vals.append(batch[key].cpu())
+    fbatch.update({k: torch.cat(v) for k, v in batches.items()})
 
     # make sure in CPU by default.
     # assumes all data are tensors (including metadata).
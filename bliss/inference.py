@@ -8,8 +8,12 @@ from einops import rearrange, reduce
 from torch import Tensor
 from torch.nn import functional as F
 
-from bliss.catalog import FullCatalog, TileCatalog
-from bliss.datasets.sdss import SloanDigitalSkySurvey, convert_flux_to_mag
+from bliss.catalog import FullCatalog, SparseTileCatalog, TileCatalog
+from bliss.datasets.sdss import (
+    SloanDigitalSkySurvey,
+    convert_flux_to_mag,
+    read_frame_metadata,
+)
 from bliss.datasets.simulated import SimulatedDataset
 from bliss.encoder import Encoder
 from bliss.models.decoder import ImageDecoder
@@ -25,6 +29,7 @@ def reconstruct_scene_at_coordinates(
     w_range: Tuple[int, int],
     slen: int = 300,
     device=None,
+    cache_dist_params: bool = False,
 ) -> Tuple[Tensor, TileCatalog]:
     """Reconstruct all objects contained within a scene, padding as needed.
 
@@ -50,6 +55,9 @@ def reconstruct_scene_at_coordinates(
             Device used for rendering each chunk (i.e. a torch.device). Note
             that chunks are moved onto and off the device to allow for rendering
             larger images.
+        cache_dist_params:
+            If True, the encoder caches its distributional parameters on the padded scene, so
+            that `encoder.rethreshold` can recompute the MAP catalog with other weights.
 
     Returns:
         A tuple of two items:
@@ -72,7 +80,7 @@ def reconstruct_scene_at_coordinates(
     assert scene.shape[2] == h_range_pad[1] - h_range_pad[0]
     assert scene.shape[3] == w_range_pad[1] - w_range_pad[0]
     with torch.no_grad():
-        tile_map_scene = encoder.variational_mode(scene, bg_scene)
+        tile_map_scene = encoder.variational_mode(scene, bg_scene, cache_dist_params)
         tile_map_scene["galaxy_fluxes"] = decoder.get_galaxy_fluxes(
             tile_map_scene["galaxy_bools"], tile_map_scene["galaxy_params"]
         )
@@ -151,14 +159,19 @@ class SimulatedFrame:
             sim_frame_path = None
         if sim_frame_path and sim_frame_path.exists():
             tile_catalog, image, background = torch.load(sim_frame_path)
+            if isinstance(tile_catalog, TileCatalog):
+                tile_catalog = SparseTileCatalog.from_tile_catalog(tile_catalog)
         else:
             print("INFO: started generating frame")
             tile_catalog = dataset.sample_prior(1, n_tiles_h, n_tiles_w)
             tile_catalog["galaxy_fluxes"] = dataset.image_decoder.get_galaxy_fluxes(
-                tile_catalog["galaxy_bools"], tile_catalog["galaxy_params"]
+                tile_catalog["galaxy_bools"],
+                tile_catalog["galaxy_params"],
+                tile_catalog.get("galaxy_indices"),
             )
             image, background = dataset.simulate_image_from_catalog(tile_catalog)
             print("INFO: done generating frame")
+            tile_catalog = SparseTileCatalog.from_tile_catalog(tile_catalog)
             if sim_frame_path:
                 torch.save((tile_catalog, image, background), sim_frame_path)
 
@@ -175,11 +188,7 @@ class SimulatedFrame:
         w, w_end = wlims[0] - self.bp, wlims[1] - self.bp
         hlims_tile = int(np.floor(h / self.tile_slen)), int(np.ceil(h_end / self.tile_slen))
         wlims_tile = int(np.floor(w / self.tile_slen)), int(np.ceil(w_end / self.tile_slen))
-        tile_dict = {}
-        for k, v in self.tile_catalog.to_dict().items():
-            tile_dict[k] = v[:, hlims_tile[0] : hlims_tile[1], wlims_tile[0] : wlims_tile[1]]
-        tile_cat = TileCatalog(self.tile_slen, tile_dict)
-        full_cat = tile_cat.to_full_params()
+        full_cat = self.tile_catalog.crop(hlims_tile, wlims_tile).to_full_params()
         full_cat["fluxes"] = (
             full_cat["galaxy_bools"] * full_cat["galaxy_fluxes"]
             + full_cat["star_bools"] * full_cat["fluxes"]
@@ -205,22 +214,17 @@ class SemiSyntheticFrame:
         run = 94
         camcol = 1
         field = 12
-        bands = (2,)
-        sdss_data = SloanDigitalSkySurvey(
-            sdss_dir=self.sdss_dir,
-            run=run,
-            camcol=camcol,
-            fields=(field,),
-            bands=bands,
-        )
-        wcs = sdss_data[0]["wcs"][0]
+        band = 2
+        wcs = read_frame_metadata(self.sdss_dir, run, camcol, field, band)["wcs"]
         if cache_dir is not None:
             sim_frame_path = Path(cache_dir) / "simulated_frame.pt"
         else:
             sim_frame_path = None
         if sim_frame_path and sim_frame_path.exists():
-            tile_catalog_dict, image, background = torch.load(sim_frame_path)
-            tile_catalog = TileCatalog(self.tile_slen, tile_catalog_dict)
+            tile_catalog, image, background = torch.load(sim_frame_path)
+            if isinstance(tile_catalog, dict):
+                tile_catalog = TileCatalog(self.tile_slen, tile_catalog)
+                tile_catalog = SparseTileCatalog.from_tile_catalog(tile_catalog)
         else:
             hlim = (self.bp, self.bp + n_tiles_h * self.tile_slen)
             wlim = (self.bp, self.bp + n_tiles_w * self.tile_slen)
@@ -230,6 +234,10 @@ class SemiSyntheticFrame:
                     full_coadd_cat.n_sources, "cpu"
                 ).unsqueeze(0)
             full_coadd_cat.plocs = full_coadd_cat.plocs + 0.5
+            # the coadd catalog has boolean and double-precision columns.
+            for k, v in list(full_coadd_cat.items()):
+                if k != "objid":
+                    full_coadd_cat[k] = v.float()
             max_sources = dataset.image_prior.max_sources
             tile_catalog = full_coadd_cat.to_tile_params(self.tile_slen, max_sources)
             tile_catalog["galaxy_fluxes"] = dataset.image_decoder.get_galaxy_fluxes(
@@ -252,8 +260,9 @@ class SemiSyntheticFrame:
             print("INFO: started generating frame")
             image, background = dataset.simulate_image_from_catalog(tile_catalog)
             print("INFO: done generating frame")
+            tile_catalog = SparseTileCatalog.from_tile_catalog(tile_catalog)
             if sim_frame_path:
-                torch.save((tile_catalog.to_dict(), image, background), sim_frame_path)
+                torch.save((tile_catalog, image, background), sim_frame_path)
 
         self.tile_catalog = tile_catalog
         self.image = image
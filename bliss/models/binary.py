@@ -84,6 +84,9 @@ class BinaryEncoder(pl.LightningModule):
     def encode(self, image_ptiles: Tensor, locs: Tensor) -> Tensor:
         """Runs the binary encoder on centered_ptiles."""
         centered_tiles = self._get_images_in_centered_tiles(image_ptiles, locs)
+        return self._encode_centered_tiles(centered_tiles)
+
+    def _encode_centered_tiles(self, centered_tiles: Tensor) -> Tensor:
         assert centered_tiles.shape[-1] == centered_tiles.shape[-2] == self.slen
 
         # forward to layer shared by all n_sources
@@ -97,13 +100,14 @@ class BinaryEncoder(pl.LightningModule):
 
         galaxy_bools = batch["galaxy_bools"].reshape(-1)
         locs = rearrange(batch["locs"], "n nth ntw ns hw -> (n nth ntw) ns hw")
-        image_ptiles = get_images_in_tiles(
-            torch.cat((batch["images"], batch["background"]), dim=1),
-            self.tile_slen,
-            self.ptile_slen,
+        # transform the full images, so that only the transformed padded tiles are copied.
+        transformed_images = self.input_transform(
+            torch.cat((batch["images"], batch["background"]), dim=1)
         )
+        image_ptiles = get_images_in_tiles(transformed_images, self.tile_slen, self.ptile_slen)
         image_ptiles = rearrange(image_ptiles, "n nth ntw b h w -> (n nth ntw) b h w")
-        galaxy_probs = self.forward(image_ptiles, locs)
+        centered_tiles = self._center_ptiles(image_ptiles, locs)
+        galaxy_probs = self._encode_centered_tiles(centered_tiles)
         galaxy_probs = galaxy_probs.reshape(-1)
 
         tile_is_on_array = get_is_on_from_n_sources(batch["n_sources"], self.max_sources)
@@ -132,6 +136,9 @@ class BinaryEncoder(pl.LightningModule):
 
     def _get_images_in_centered_tiles(self, image_ptiles: Tensor, tile_locs: Tensor) -> Tensor:
         log_image_ptiles = self.input_transform(image_ptiles)
+        return self._center_ptiles(log_image_ptiles, tile_locs)
+
+    def _center_ptiles(self, log_image_ptiles: Tensor, tile_locs: Tensor) -> Tensor:
         assert log_image_ptiles.shape[-1] == log_image_ptiles.shape[-2] == self.ptile_slen
         # in each padded tile we need to center the corresponding galaxy/star
         return center_ptiles(
@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple, Union
 
 import numpy as np
 import pytorch_lightning as pl
@@ -9,7 +9,7 @@ from einops import rearrange, reduce
 from torch import Tensor, nn
 from torch.nn import functional as F
 
-from bliss.catalog import TileCatalog, get_is_on_from_n_sources
+from bliss.catalog import SparseTileCatalog, TileCatalog
 from bliss.datasets.galsim_galaxies import GalsimGalaxyDecoder
 from bliss.models import galaxy_net
 
@@ -78,9 +78,13 @@ class ImageDecoder(pl.LightningModule):
             self.autodecoder = galaxy_ae.get_decoder()
         else:
             self.autodecoder = None
+        self.register_buffer("galaxy_stamp_bank", None, persistent=False)
+        self.register_buffer("galaxy_flux_bank", None, persistent=False)
         self.set_decoder_type("autoencoder")
 
     def set_decoder_type(self, mode):
+        self.galaxy_stamp_bank = None
+        self.galaxy_flux_bank = None
         if mode == "galsim":
             galaxy_decoder = self.galsim_galaxy_decoder
         elif mode == "autoencoder":
@@ -101,22 +105,100 @@ class ImageDecoder(pl.LightningModule):
             return None
         return self.galaxy_tile_decoder.galaxy_decoder
 
-    def render_images(self, tile_catalog: TileCatalog) -> Tensor:
+    def set_galaxy_stamp_bank(self, latents: Tensor, batch_size: int = 1000) -> None:
+        """Decodes all galaxy latents once, so that galaxies can be rendered from their indices.
+
+        Afterwards, for tile catalogs containing `"galaxy_indices"` into `latents` (see
+        `ImagePrior.sample_prior`), `render_images` and `get_galaxy_fluxes` gather the stamps
+        (already sized to the padded tiles) and fluxes of galaxies from the bank instead of running
+        the galaxy decoder.
+
+        Args:
+            latents: Galaxy latents with shape `n_latents x latent_dim`.
+            batch_size: Number of latents to decode at a time.
+        """
+        assert self.galaxy_tile_decoder is not None
+        stamps = []
+        fluxes = []
+        with torch.no_grad():
+            for z in torch.split(latents.to(self.device), batch_size):
+                galaxies = self.galaxy_tile_decoder.galaxy_decoder(z)
+                fluxes.append(reduce(galaxies, "n 1 h w -> n", "sum"))
+                stamps.append(self.galaxy_tile_decoder.size_galaxy(galaxies))
+        self.galaxy_stamp_bank = torch.cat(stamps)
+        self.galaxy_flux_bank = torch.cat(fluxes)
+
+    def render_images(self, tile_catalog: Union[TileCatalog, SparseTileCatalog]) -> Tensor:
         """Renders tile catalog latent variables into a full astronomical image.
 
         Args:
             tile_catalog: Tile catalog of astronomical image, comprising tensors
                 of size (batch_size x n_tiles_h x n_tiles_w x max_sources). The only
                 exception is 'n_sources`, which is size batch_size x n_tiles_h x n_tiles_w.
+                Alternatively, the equivalent `SparseTileCatalog`.
+
+        Only sources that are on are rendered, each on the padded tile of the tile it belongs to,
+        and these padded tiles are added directly into the full image. Thus, the cost scales with
+        the number of sources rather than with the number of tiles. The output is the same as
+        rendering every padded tile and overlapping them with `reconstruct_image_from_ptiles`.
 
         Returns:
             The **full** image in shape (batch_size x n_bands x slen x slen).
         """
-        image_ptiles = self._render_ptiles(tile_catalog)
-        return reconstruct_image_from_ptiles(image_ptiles, self.tile_slen, self.border_padding)
+        if isinstance(tile_catalog, TileCatalog):
+            assert (tile_catalog.n_sources <= tile_catalog.max_sources).all()
+            sparse_catalog = SparseTileCatalog.from_tile_catalog(tile_catalog)
+        else:
+            sparse_catalog = tile_catalog
+        height = sparse_catalog.n_tiles_h * self.tile_slen + 2 * self.border_padding
+        width = sparse_catalog.n_tiles_w * self.tile_slen + 2 * self.border_padding
+        images = torch.zeros(
+            sparse_catalog.batch_size, self.n_bands, height, width, device=sparse_catalog.device
+        )
+        tile_indices = sparse_catalog.indices[:, :3]
+
+        # each source is rendered as a padded tile with a single source.
+        galaxy_bools = sparse_catalog["galaxy_bools"]
+        star_bools = 1 - galaxy_bools
+        is_star = star_bools.squeeze(-1) > 0
+        stars = self.star_tile_decoder(
+            sparse_catalog.locs[is_star].unsqueeze(1),
+            sparse_catalog["fluxes"][is_star].unsqueeze(1),
+            star_bools[is_star].unsqueeze(1),
+        )
+        images = add_ptiles_to_images(
+            images, stars, tile_indices[is_star], self.tile_slen, self.border_padding
+        )
+
+        if self.galaxy_tile_decoder is not None:
+            is_galaxy = galaxy_bools.squeeze(-1) == 1
+            galaxy_locs = sparse_catalog.locs[is_galaxy].unsqueeze(1)
+            if self._use_galaxy_stamp_bank(sparse_catalog):
+                assert self.galaxy_stamp_bank is not None
+                bank_indices = sparse_catalog["galaxy_indices"][is_galaxy].squeeze(-1)
+                stamps = self.galaxy_stamp_bank[bank_indices]
+                galaxies = self.galaxy_tile_decoder.tiler(galaxy_locs, stamps.unsqueeze(1))
+            else:
+                galaxies = self.galaxy_tile_decoder(
+                    galaxy_locs,
+                    sparse_catalog["galaxy_params"][is_galaxy].unsqueeze(1),
+                    galaxy_bools[is_galaxy].unsqueeze(1),
+                )
+            images = add_ptiles_to_images(
+                images, galaxies, tile_indices[is_galaxy], self.tile_slen, self.border_padding
+            )
+
+        return images
 
-    def get_galaxy_fluxes(self, galaxy_bools: Tensor, galaxy_params_in: Tensor):
+    def get_galaxy_fluxes(
+        self,
+        galaxy_bools: Tensor,
+        galaxy_params_in: Tensor,
+        galaxy_indices: Optional[Tensor] = None,
+    ):
         assert self.galaxy_tile_decoder is not None
+        if self.galaxy_flux_bank is not None and galaxy_indices is not None:
+            return self.galaxy_flux_bank[galaxy_indices] * galaxy_bools
         galaxy_bools_flat = rearrange(galaxy_bools, "b nth ntw s d -> (b nth ntw s) d")
         galaxy_params = rearrange(galaxy_params_in, "b nth ntw s d -> (b nth ntw s) d")
         galaxy_shapes = self.galaxy_tile_decoder.galaxy_decoder(
@@ -143,47 +225,8 @@ class ImageDecoder(pl.LightningModule):
         """Decodes latent representation into an image."""
         return self.star_tile_decoder.psf_forward()
 
-    def _render_ptiles(self, tile_catalog: TileCatalog) -> Tensor:
-        # n_sources: is (batch_size x n_tiles_h x n_tiles_w)
-        # locs: is (batch_size x n_tiles_h x n_tiles_w x max_sources x 2)
-        # galaxy_bools: Is (batch_size x n_tiles_h x n_tiles_w x max_sources)
-        # galaxy_params : is (batch_size x n_tiles_h x n_tiles_w x max_sources x latent_dim)
-        # fluxes: Is (batch_size x n_tiles_h x n_tiles_w x max_sources x 2)
-
-        # returns the ptiles with shape =
-        # (batch_size x n_tiles_h x n_tiles_w x n_bands x ptile_slen x ptile_slen)
-
-        batch_size, n_tiles_h, n_tiles_w, max_sources, _ = tile_catalog.locs.shape
-
-        # view parameters being explicit about shapes
-        n_sources = rearrange(tile_catalog.n_sources, "b nth ntw -> (b nth ntw)")
-        assert (n_sources <= max_sources).all()
-        locs = rearrange(tile_catalog.locs, "b nth ntw s xy -> (b nth ntw) s xy", xy=2)
-        galaxy_bools = rearrange(tile_catalog["galaxy_bools"], "b nth ntw s 1 -> (b nth ntw) s 1")
-        fluxes = rearrange(tile_catalog["fluxes"], "b nth ntw s band -> (b nth ntw) s band")
-
-        # draw stars and galaxies
-        is_on_array = get_is_on_from_n_sources(n_sources, max_sources)
-        is_on_array = rearrange(is_on_array, "b_nth_ntw s -> b_nth_ntw s 1")
-        star_bools = (1 - galaxy_bools) * is_on_array
-
-        # final shapes of images.
-        img_shape = (
-            batch_size,
-            n_tiles_h,
-            n_tiles_w,
-            self.n_bands,
-            self.ptile_slen,
-            self.ptile_slen,
-        )
-
-        # draw stars and galaxies
-        stars = self.star_tile_decoder(locs, fluxes, star_bools)
-        galaxies = torch.zeros(img_shape, device=locs.device)
-        if self.galaxy_tile_decoder is not None:
-            galaxies = self.galaxy_tile_decoder(locs, tile_catalog["galaxy_params"], galaxy_bools)
-
-        return galaxies.view(img_shape) + stars.view(img_shape)
+    def _use_galaxy_stamp_bank(self, tile_catalog: Union[TileCatalog, SparseTileCatalog]) -> bool:
+        return self.galaxy_stamp_bank is not None and "galaxy_indices" in tile_catalog
 
     def _validate_border_padding(self, border_padding):
         # Border Padding
@@ -249,6 +292,49 @@ def reconstruct_image_from_ptiles(
     return folded_image[:, :, crop_idx : (-crop_idx or None), crop_idx : (-crop_idx or None)]
 
 
+def add_ptiles_to_images(
+    images: Tensor,
+    image_ptiles: Tensor,
+    tile_indices: Tensor,
+    tile_slen: int,
+    border_padding: int,
+) -> Tensor:
+    """Adds padded tiles of individual tiles directly into the full images they overlap.
+
+    Equivalent to `reconstruct_image_from_ptiles` on padded tiles that are zero everywhere except at
+    the given tiles, without having to allocate (or fold) those empty padded tiles.
+
+    Args:
+        images: Tensor of size (batch_size x n_bands x height x width).
+        image_ptiles: Tensor of size (n x n_bands x ptile_slen x ptile_slen).
+        tile_indices: Tensor of size (n x 3) with the batch, tile row, and tile column indices
+            of each padded tile.
+        tile_slen: Size of the original (non-overlapping) tiles.
+        border_padding: Amount of border padding in the full images.
+
+    Returns:
+        Tensor of size (batch_size x n_bands x height x width) with the padded tiles added.
+    """
+    batch_size, n_bands, height, width = images.shape
+    ptile_slen = image_ptiles.shape[-1]
+    assert image_ptiles.shape[1] == n_bands
+    b_indx, h_indx, w_indx = tile_indices.unbind(-1)
+
+    # pixel coordinates of each padded tile in the full images (some may be out of bounds).
+    crop_idx = (ptile_slen - tile_slen) // 2 - border_padding
+    ptile_coords = torch.arange(ptile_slen, device=images.device)
+    rows = rearrange(h_indx * tile_slen - crop_idx, "n -> n 1 1 1") + ptile_coords.view(-1, 1)
+    cols = rearrange(w_indx * tile_slen - crop_idx, "n -> n 1 1 1") + ptile_coords
+    bands = torch.arange(n_bands, device=images.device).view(1, -1, 1, 1)
+    in_bounds = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    in_bounds = in_bounds.expand_as(image_ptiles)
+
+    indices = (rearrange(b_indx, "n -> n 1 1 1") * n_bands + bands) * height + rows
+    indices = indices * width + cols
+    images_flat = images.reshape(-1).index_add(0, indices[in_bounds], image_ptiles[in_bounds])
+    return images_flat.view(batch_size, n_bands, height, width)
+
+
 class Tiler(nn.Module):
     """This class creates an image tile from multiple sources."""
 
@@ -276,19 +362,13 @@ class Tiler(nn.Module):
             ptile = (n_ptiles x n_bands x slen x slen)
         """
         max_sources = locs.shape[1]
-        ptile_shape = (
-            sources.size(0),
-            sources.size(2),
-            self.ptile_slen,
-            self.ptile_slen,
-        )
-        ptile = torch.zeros(ptile_shape, device=locs.device)
+        assert sources.shape[:2] == locs.shape[:2]
 
-        for n in range(max_sources):
-            one_star = self._render_one_source(locs[:, n, :], sources[:, n])
-            ptile += one_star
-
-        return ptile
+        # all sources of all ptiles are shifted at once, then summed within each ptile.
+        locs_flat = rearrange(locs, "np ms xy -> (np ms) xy")
+        sources_flat = rearrange(sources, "np ms nb h w -> (np ms) nb h w")
+        rendered_sources = self._render_one_source(locs_flat, sources_flat)
+        return reduce(rendered_sources, "(np ms) nb h w -> np nb h w", "sum", ms=max_sources)
 
     def fit_source_to_ptile(self, source: Tensor):
         if self.ptile_slen >= source.shape[-1]:
@@ -301,13 +381,13 @@ class Tiler(nn.Module):
         """Renders one source at a location from shape.
 
         Arguments:
-            locs: is n_ptiles x len((x,y))
-            source: is a (n_ptiles, n_bands, slen, slen) tensor, which could either be a
+            locs: is n_sources x len((x,y))
+            source: is a (n_sources, n_bands, slen, slen) tensor, which could either be a
                         `expanded_psf` (psf repeated multiple times) for the case of of stars.
                         Or multiple galaxies in the case of galaxies.
 
         Returns:
-            Tensor with shape = (n_ptiles x n_bands x slen x slen)
+            Tensor with shape = (n_sources x n_bands x slen x slen)
         """
         assert isinstance(self.swap, Tensor)
         assert isinstance(self.cached_grid, Tensor)
@@ -410,11 +490,12 @@ class StarTileDecoder(nn.Module):
         self.register_buffer("cached_radii_grid", (grid**2).sum(2).sqrt())
 
         # get psf normalization_constant
-        self.normalization_constant = torch.zeros(self.n_bands)
-        for i in range(self.n_bands):
-            psf_i = self._get_psf_single_band(i)
-            self.normalization_constant[i] = 1 / psf_i.sum()
-        self.normalization_constant = self.normalization_constant.detach()
+        with torch.no_grad():
+            normalization_constant = 1 / reduce(self._get_psf_unnormalized(), "n m k -> n", "sum")
+        self.register_buffer("normalization_constant", normalization_constant, persistent=False)
+
+        # fitted psf for each (device, dtype), with the version of `params` it was computed at.
+        self._psf_cache: Dict[Tuple[torch.device, torch.dtype], Tuple[Tuple, Tensor]] = {}
 
     def forward(self, locs, fluxes, star_bools):
         """Renders star tile from locations and fluxes."""
@@ -465,12 +546,8 @@ class StarTileDecoder(nn.Module):
         return psf_params
 
     def _get_psf(self):
-        psf_list = []
-        for i in range(self.n_bands):
-            band_psf = self._get_psf_single_band(i)
-            band_psf *= self.normalization_constant[i]
-            psf_list.append(band_psf.unsqueeze(0))
-        psf = torch.cat(psf_list)
+        psf = self._get_psf_unnormalized()
+        psf *= rearrange(self.normalization_constant, "n -> n 1 1")
 
         assert (psf > 0).all()
         return psf
@@ -482,8 +559,9 @@ class StarTileDecoder(nn.Module):
         term3 = p0 * (1 + r**2 / (beta * sigmap)) ** (-beta / 2)
         return (term1 + term2 + term3) / (1 + b + p0)
 
-    def _get_psf_single_band(self, band_idx):
-        psf_params = torch.exp(self.params[band_idx])
+    def _get_psf_unnormalized(self):
+        # evaluates the psf of all bands at once, with shape (n_bands, psf_slen, psf_slen).
+        psf_params = rearrange(torch.exp(self.params), "n p -> p n 1 1")
         return self._psf_fun(
             self.cached_radii_grid,
             psf_params[0],
@@ -495,6 +573,18 @@ class StarTileDecoder(nn.Module):
         )
 
     def _adjust_psf(self):
+        # the fitted psf only depends on `params`, so it is cached unless gradients are needed.
+        if torch.is_grad_enabled() and self.params.requires_grad:
+            return self._fit_psf()
+        cache_key = (self.params.device, self.params.dtype)
+        params_version = (self.params.data_ptr(), self.params._version)  # noqa: WPS437
+        cached_version, psf = self._psf_cache.get(cache_key, (None, None))
+        if cached_version != params_version:
+            psf = self._fit_psf()
+            self._psf_cache[cache_key] = (params_version, psf)
+        return psf
+
+    def _fit_psf(self):
         # use power_law_psf and current psf parameters to forward and obtain fresh psf model.
         # first dimension of psf is number of bands
         # dimension of the psf/slen should be odd
@@ -553,7 +643,7 @@ class GalaxyTileDecoder(nn.Module):
         gal_on = self.galaxy_decoder(z[b == 1])
 
         # size the galaxy (either trims or crops to the size of ptile)
-        gal_on = self._size_galaxy(gal_on)
+        gal_on = self.size_galaxy(gal_on)
 
         # set galaxies
         gal[b == 1] = gal_on
@@ -562,7 +652,7 @@ class GalaxyTileDecoder(nn.Module):
         gal_shape = (batchsize, -1, self.n_bands, gal.shape[-1], gal.shape[-1])
         return gal.view(gal_shape)
 
-    def _size_galaxy(self, galaxy):
+    def size_galaxy(self, galaxy):
         # galaxy should be shape n_galaxies x n_bands x galaxy_slen x galaxy_slen
         assert len(galaxy.shape) == 4
         assert galaxy.shape[2] == galaxy.shape[3]
@@ -76,8 +76,12 @@ class GalaxyEncoder(pl.LightningModule):
 
     def encode(self, image_ptiles: Tensor, tile_locs: Tensor) -> Tuple[Tensor, Tensor]:
         """Runs galaxy encoder on input image ptiles (with bg substracted)."""
-        max_sources = tile_locs.shape[1]
         centered_ptiles = self._get_images_in_centered_tiles(image_ptiles, tile_locs)
+        return self._encode_centered_ptiles(centered_ptiles, tile_locs.shape[1])
+
+    def _encode_centered_ptiles(
+        self, centered_ptiles: Tensor, max_sources: int
+    ) -> Tuple[Tensor, Tensor]:
         assert centered_ptiles.shape[-1] == centered_ptiles.shape[-2] == self.slen
         galaxy_params_flat, pq_divergence_flat = self.enc(centered_ptiles)
         galaxy_params = rearrange(
@@ -122,18 +126,14 @@ class GalaxyEncoder(pl.LightningModule):
     def _get_loss(self, batch):
         images: Tensor = batch["images"]
         background: Tensor = batch["background"]
+        # galaxies are rendered from the estimated galaxy_params, not the true galaxy_indices.
+        not_params = {"images", "background", "galaxy_indices"}
         tile_catalog = TileCatalog(
-            self.tile_slen, {k: v for k, v in batch.items() if k not in {"images", "background"}}
+            self.tile_slen, {k: v for k, v in batch.items() if k not in not_params}
         )
 
-        image_ptiles = get_images_in_tiles(
-            torch.cat((images, background), dim=1),
-            self.tile_slen,
-            self.ptile_slen,
-        )
-        image_ptiles = rearrange(image_ptiles, "n nth ntw b h w -> (n nth ntw) b h w")
         locs = rearrange(tile_catalog.locs, "n nth ntw ns hw -> (n nth ntw) ns hw")
-        galaxy_params, pq_divergence = self.encode(image_ptiles, locs)
+        galaxy_params, pq_divergence = self._encode_image(images, background, locs)
         # draw fully reconstructed image.
         # NOTE: Assume recon_mean = recon_var per poisson approximation.
         tile_catalog["galaxy_params"] = rearrange(
@@ -194,15 +194,9 @@ class GalaxyEncoder(pl.LightningModule):
         tile_locs = batch["locs"]
 
         # obtain map estimates
-        image_ptiles = get_images_in_tiles(
-            torch.cat((images, background), dim=1),
-            self.tile_slen,
-            self.ptile_slen,
-        )
-        _, n_tiles_h, n_tiles_w, _, _, _ = image_ptiles.shape
-        image_ptiles = rearrange(image_ptiles, "n nth ntw b h w -> (n nth ntw) b h w")
+        _, n_tiles_h, n_tiles_w, _, _ = tile_locs.shape
         locs = rearrange(tile_locs, "n nth ntw ns hw -> (n nth ntw) ns hw")
-        z, _ = self.encode(image_ptiles, locs)
+        z, _ = self._encode_image(images, background, locs)
 
         tile_est = TileCatalog(
             self.tile_slen,
@@ -297,11 +291,24 @@ class GalaxyEncoder(pl.LightningModule):
             )
         plt.close(fig)
 
+    def _encode_image(
+        self, images: Tensor, background: Tensor, tile_locs: Tensor
+    ) -> Tuple[Tensor, Tensor]:
+        # subtract the background from the full images, so that only the background-subtracted
+        # padded tiles are copied out of them (instead of images and background).
+        image_ptiles = get_images_in_tiles(images - background, self.tile_slen, self.ptile_slen)
+        image_ptiles = rearrange(image_ptiles, "n nth ntw b h w -> (n nth ntw) b h w")
+        centered_ptiles = self._center_ptiles(image_ptiles, tile_locs)
+        return self._encode_centered_ptiles(centered_ptiles, tile_locs.shape[1])
+
     def _get_images_in_centered_tiles(self, image_ptiles: Tensor, tile_locs: Tensor) -> Tensor:
         n_bands = image_ptiles.shape[1] // 2
         img, bg = torch.split(image_ptiles, (n_bands, n_bands), dim=1)
+        return self._center_ptiles(img - bg, tile_locs)
+
+    def _center_ptiles(self, image_ptiles: Tensor, tile_locs: Tensor) -> Tensor:
         return center_ptiles(
-            img - bg,
+            image_ptiles,
             tile_locs,
             self.tile_slen,
             self.ptile_slen,
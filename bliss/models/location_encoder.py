@@ -1,6 +1,7 @@
+import copy
 import itertools
 import math
-from typing import Dict, Optional, Union
+from typing import Dict, Optional, Tuple, Union
 
 import pytorch_lightning as pl
 import torch
@@ -10,9 +11,15 @@ from mpl_toolkits.axes_grid1 import make_axes_locatable
 from torch import Tensor, nn
 from torch.distributions import Categorical, Normal, Poisson
 from torch.nn import functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from torch.optim import Adam
 
-from bliss.catalog import TileCatalog, get_images_in_tiles, get_is_on_from_n_sources
+from bliss.catalog import (
+    TileCatalog,
+    get_is_on_from_n_sources,
+    get_n_padded_tiles_hw,
+    get_ptile_batches,
+)
 from bliss.reporting import DetectionMetrics
 
 
@@ -115,13 +122,13 @@ class LocationEncoder(pl.LightningModule):
         # the total number of distributional parameters per tile
         self.dim_out_all = n_source_params + count_simplex_dim
 
-        dim_enc_conv_out = ((self.ptile_slen + 1) // 2 + 1) // 2
+        self.dim_enc_conv_out = ((self.ptile_slen + 1) // 2 + 1) // 2
 
         # networks to be trained
         n_bands_in = self.input_transform.output_channels(n_bands)
         self.enc_conv = EncoderCNN(n_bands_in, channel, spatial_dropout)
         self.enc_final = make_enc_final(
-            channel * 4 * dim_enc_conv_out**2,
+            channel * 4 * self.dim_enc_conv_out**2,
             hidden,
             self.dim_out_all,
             dropout,
@@ -161,7 +168,110 @@ class LocationEncoder(pl.LightningModule):
                 the log-probabilities of the number of sources present in each tile.
         """
         transformed_ptiles = self.input_transform(image_ptiles)
-        enc_conv_output = self.enc_conv(transformed_ptiles)
+        return self._encode_transformed_ptiles(transformed_ptiles, self.enc_conv)
+
+    def encode_image(
+        self, image: Tensor, background: Tensor, batch_size: Optional[int] = None
+    ) -> Dict[str, Tensor]:
+        """Encodes distributional parameters of all padded tiles in a batch of full images.
+
+        This is equivalent to `self.encode` on the output of `get_images_in_tiles` (flattened),
+        but the input transform is applied only once to the full images. In evaluation mode, the
+        batch norm layers of the convolutional network are also folded into the convolutions (in
+        training mode, the network is used as is). Since each padded tile is zero-padded at every
+        convolution, features cannot be shared between overlapping padded tiles without changing
+        the output, so these are encoded in batches. Since the input transform is applied before
+        tiling, only the (transformed) padded tiles of each batch are copied out of `image`.
+
+        Args:
+            image: Astronomical images with shape `n * n_bands * h * w`.
+            background: Background associated with image, with shape `n * n_bands * h * w`.
+            batch_size: Number of padded tiles to encode at a time. If None, all padded tiles
+                are encoded at once (e.g. in training, where the loss needs all of them).
+
+        Returns:
+            Same as `self.encode`, for all `n * n_tiles_h * n_tiles_w` padded tiles.
+        """
+        transformed_image = self.input_transform(torch.cat((image, background), dim=1))
+        enc_conv = self.enc_conv if self.enc_conv.training else self.enc_conv.fuse()
+        if batch_size is None:
+            n_tiles_h, n_tiles_w = get_n_padded_tiles_hw(
+                image.shape[2], image.shape[3], self.ptile_slen, self.tile_slen
+            )
+            batch_size = max(image.shape[0] * n_tiles_h * n_tiles_w, 1)
+        ptile_batches = get_ptile_batches(
+            transformed_image, self.tile_slen, self.ptile_slen, batch_size
+        )
+        dist_params_list = [
+            self._encode_transformed_ptiles(ptiles, enc_conv) for ptiles in ptile_batches
+        ]
+        return {k: torch.cat([d[k] for d in dist_params_list]) for k in dist_params_list[0]}
+
+    def encode_frame(
+        self, image: Tensor, background: Tensor, batch_size: Optional[int] = None
+    ) -> Dict[str, Tensor]:
+        """Encodes distributional parameters of all padded tiles from whole-image features.
+
+        The convolutional network is run once over the full images (in bands of tile rows) rather
+        than on each overlapping padded tile, and `enc_final` is evaluated on the window of the
+        shared feature map corresponding to each padded tile. Since the padded tiles are not
+        zero-padded separately, the output is that of a fully convolutional network and differs
+        from `self.encode`, whose features near the borders of each padded tile see zeros instead
+        of the neighboring pixels. Each band of tile rows is extended by the receptive field of
+        the network and cropped, so the output does not depend on the size of the bands.
+
+        Args:
+            image: Astronomical images with shape `n * n_bands * h * w`.
+            background: Background associated with image, with shape `n * n_bands * h * w`.
+            batch_size: Approximate number of padded tiles to encode at a time, which determines
+                the number of tile rows in each band. If None, the full images are encoded at once.
+
+        Returns:
+            Same as `self.encode`, for all `n * n_tiles_h * n_tiles_w` padded tiles.
+        """
+        stride, radius = self.enc_conv.get_receptive_field()
+        assert self.tile_slen % stride == 0, "tiles must be aligned with the features."
+        tile_fslen = self.tile_slen // stride
+        halo = math.ceil(radius / stride) * stride
+
+        transformed_image = self.input_transform(torch.cat((image, background), dim=1))
+        enc_conv = self.enc_conv if self.enc_conv.training else self.enc_conv.fuse()
+        n, _, h, w = transformed_image.shape
+        n_tiles_h, n_tiles_w = get_n_padded_tiles_hw(h, w, self.ptile_slen, self.tile_slen)
+        band_n_tiles_h = n_tiles_h
+        if batch_size is not None:
+            band_n_tiles_h = max(batch_size // max(n * n_tiles_w, 1), 1)
+
+        dist_params_list = []
+        for start in range(0, n_tiles_h, band_n_tiles_h):
+            end = min(start + band_n_tiles_h, n_tiles_h)
+            # rows of the feature map used by the tiles in this band and the image rows they see.
+            fstart = start * tile_fslen
+            fend = (end - 1) * tile_fslen + self.dim_enc_conv_out
+            top = max(fstart * stride - halo, 0)
+            bottom = min((fend - 1) * stride + halo + 1, h)
+            features = enc_conv(transformed_image[:, :, top:bottom])
+            features = features[:, :, (fstart - top // stride) : (fend - top // stride)]
+            windows = features.unfold(2, self.dim_enc_conv_out, tile_fslen)
+            windows = windows.unfold(3, self.dim_enc_conv_out, tile_fslen)[:, :, :, :n_tiles_w]
+            windows = rearrange(windows, "n c nth ntw h w -> n nth ntw c h w")
+            assert windows.shape[1] == end - start
+            dist_params = self._get_dist_params(windows.reshape(-1, *windows.shape[3:]))
+            dist_params_list.append(
+                {
+                    k: v.reshape(n, end - start, n_tiles_w, *v.shape[1:])
+                    for k, v in dist_params.items()
+                }
+            )
+        return {
+            k: torch.cat([d[k] for d in dist_params_list], dim=1).flatten(0, 2)
+            for k in dist_params_list[0]
+        }
+
+    def _encode_transformed_ptiles(self, transformed_ptiles: Tensor, enc_conv: nn.Module):
+        return self._get_dist_params(enc_conv(transformed_ptiles))
+
+    def _get_dist_params(self, enc_conv_output: Tensor) -> Dict[str, Tensor]:
         enc_final_output = self.enc_final(enc_conv_output)
 
         dim_out_all = enc_final_output.shape[1]
@@ -369,13 +479,7 @@ class LocationEncoder(pl.LightningModule):
         true_catalog["is_on_array"] = get_is_on_from_n_sources(
             true_catalog["n_sources"], self.max_detections
         )
-        image_ptiles = get_images_in_tiles(
-            torch.cat((batch["images"], batch["background"]), dim=1),
-            self.tile_slen,
-            self.ptile_slen,
-        )
-        image_ptiles = rearrange(image_ptiles, "n nth ntw b h w -> (n nth ntw) b h w")
-        dist_params = self.encode(image_ptiles)
+        dist_params = self.encode_image(batch["images"], batch["background"])
         nslp_flat = rearrange(dist_params["n_source_log_probs"], "n_ptiles ns -> n_ptiles ns")
         counter_loss = F.nll_loss(
             nslp_flat, true_catalog["n_sources"].reshape(-1), reduction="none"
@@ -432,13 +536,7 @@ class LocationEncoder(pl.LightningModule):
         }
         true_tile_catalog = TileCatalog(self.tile_slen, catalog_dict)
         true_full_catalog = true_tile_catalog.to_full_params()
-        image_ptiles = get_images_in_tiles(
-            torch.cat((batch["images"], batch["background"]), dim=1),
-            self.tile_slen,
-            self.ptile_slen,
-        )
-        image_ptiles = rearrange(image_ptiles, "n nth ntw b h w -> (n nth ntw) b h w")
-        dist_params = self.encode(image_ptiles)
+        dist_params = self.encode_image(batch["images"], batch["background"])
         est_catalog_dict = self.variational_mode(dist_params)
         est_tile_catalog = TileCatalog.from_flat_dict(
             true_tile_catalog.tile_slen,
@@ -474,13 +572,7 @@ class LocationEncoder(pl.LightningModule):
         true_tile_catalog = TileCatalog(self.tile_slen, catalog_dict)
         true_cat = true_tile_catalog.to_full_params()
 
-        image_ptiles = get_images_in_tiles(
-            torch.cat((batch["images"], batch["background"]), dim=1),
-            self.tile_slen,
-            self.ptile_slen,
-        )
-        image_ptiles = rearrange(image_ptiles, "n nth ntw b h w -> (n nth ntw) b h w")
-        dist_params = self.encode(image_ptiles)
+        dist_params = self.encode_image(batch["images"], batch["background"])
 
         est_catalog_dict = self.variational_mode(dist_params)
         est_tile_catalog = TileCatalog.from_flat_dict(
@@ -556,13 +648,7 @@ class LocationEncoder(pl.LightningModule):
         true_tile_catalog = TileCatalog(self.tile_slen, catalog_dict)
         true_full_catalog = true_tile_catalog.to_full_params()
 
-        image_ptiles = get_images_in_tiles(
-            torch.cat((batch["images"], batch["background"]), dim=1),
-            self.tile_slen,
-            self.ptile_slen,
-        )
-        image_ptiles = rearrange(image_ptiles, "n nth ntw b h w -> (n nth ntw) b h w")
-        dist_params = self.encode(image_ptiles)
+        dist_params = self.encode_image(batch["images"], batch["background"])
 
         est_catalog_dict = self.variational_mode(dist_params)
         est_tile_catalog = TileCatalog.from_flat_dict(
@@ -615,6 +701,26 @@ class EncoderCNN(nn.Module):
         """Runs encoder CNN on inputs."""
         return self.layer(x)
 
+    def fuse(self) -> "EncoderCNN":
+        """Returns a copy for inference with batch norm layers folded into the convolutions."""
+        assert not self.training
+        fused = copy.deepcopy(self)
+        fused.layer[0] = fuse_conv_bn_eval(fused.layer[0], fused.layer[1])
+        fused.layer[1] = nn.Identity()
+        for block in fused.layer[3:]:
+            block.fuse_()
+        return fused
+
+    def get_receptive_field(self) -> Tuple[int, int]:
+        """Returns the total stride and the receptive field radius (in input pixels)."""
+        stride, radius = 1, 0
+        for module in self.modules():
+            # skip 1x1 (shortcut) convolutions, which run in parallel to the strided 3x3 ones.
+            if isinstance(module, nn.Conv2d) and module.kernel_size[0] > 1:
+                radius += (module.kernel_size[0] // 2) * stride
+                stride *= module.stride[0]
+        return stride, radius
+
     def _make_layer(self, n_bands, channel, dropout):
         layers = [
             nn.Conv2d(n_bands, channel, 3, padding=1),
@@ -655,12 +761,24 @@ class ConvBlock(nn.Module):
         if self.downsample:
             stride = 2
             self.sc_conv = nn.Conv2d(in_channel, out_channel, kernel_size=1, stride=stride)
-            self.sc_bn = nn.BatchNorm2d(out_channel)
+            self.sc_bn: nn.Module = nn.BatchNorm2d(out_channel)
         self.conv1 = nn.Conv2d(in_channel, out_channel, kernel_size=3, padding=1, stride=stride)
-        self.bn1 = nn.BatchNorm2d(out_channel)
+        self.bn1: nn.Module = nn.BatchNorm2d(out_channel)
         self.drop1 = nn.Dropout2d(dropout)
         self.conv2 = nn.Conv2d(out_channel, out_channel, kernel_size=3, padding=1)
-        self.bn2 = nn.BatchNorm2d(out_channel)
+        self.bn2: nn.Module = nn.BatchNorm2d(out_channel)
+
+    def fuse_(self) -> None:
+        """Folds batch norm layers into the preceding convolutions in-place (for inference)."""
+        assert isinstance(self.bn1, nn.BatchNorm2d) and isinstance(self.bn2, nn.BatchNorm2d)
+        self.conv1 = fuse_conv_bn_eval(self.conv1, self.bn1)
+        self.bn1 = nn.Identity()
+        self.conv2 = fuse_conv_bn_eval(self.conv2, self.bn2)
+        self.bn2 = nn.Identity()
+        if self.downsample:
+            assert isinstance(self.sc_bn, nn.BatchNorm2d)
+            self.sc_conv = fuse_conv_bn_eval(self.sc_conv, self.sc_bn)
+            self.sc_bn = nn.Identity()
 
     def forward(self, x: Tensor) -> Tensor:
         """Runs convolutional block on inputs."""
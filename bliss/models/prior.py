@@ -1,18 +1,33 @@
 from pathlib import Path
-from typing import Optional, Union
+from typing import Callable, Optional, Sequence, Union
 from warnings import warn
 
 import pytorch_lightning as pl
 import torch
 from einops import rearrange
 from torch import Tensor
-from torch.distributions import Poisson
 
 from bliss.catalog import TileCatalog, get_is_on_from_n_sources
 from bliss.datasets.galsim_galaxies import SDSSGalaxies, ToyGaussian
 from bliss.models.galaxy_net import OneCenteredGalaxyAE
 
 
+def _sample_per_image(
+    sample: Callable[[int, Optional[torch.Generator]], Tensor],
+    batch_size: int,
+    generators: Optional[Sequence[torch.Generator]] = None,
+) -> Tensor:
+    """Draws `sample(n_images, generator)` for a batch, image by image if `generators` are given.
+
+    Only the random draws are done image by image (each from its own generator), so that every
+    image is the same as if it was sampled on its own, and the rest of the sampling is batched.
+    """
+    if generators is None:
+        return sample(batch_size, None)
+    assert len(generators) == batch_size
+    return torch.cat([sample(1, generator) for generator in generators])
+
+
 class GalaxyPrior:
     def __init__(
         self,
@@ -57,11 +72,17 @@ class GalaxyPrior:
             torch.save(latents, latents_path)
         self.latents = latents
 
-    def sample(self, total_latent, device):
-        self.latents = self.latents.to(device)
-        indices = torch.randint(0, len(self.latents), (total_latent,), device=device)
+    def sample(self, total_latent, device, generator: Optional[torch.Generator] = None):
+        indices = self.sample_indices(total_latent, device, generator)
         return self.latents[indices]
 
+    def sample_indices(self, total_latent, device, generator: Optional[torch.Generator] = None):
+        """Samples indices of galaxy latents in `self.latents` (moved to `device`)."""
+        self.latents = self.latents.to(device)
+        return torch.randint(
+            0, len(self.latents), (total_latent,), device=device, generator=generator
+        )
+
 
 class ImagePrior(pl.LightningModule):
     """Prior distribution of objects in an astronomical image.
@@ -122,7 +143,13 @@ class ImagePrior(pl.LightningModule):
             assert self.galaxy_prior is not None
 
     def sample_prior(
-        self, tile_slen: int, batch_size: int, n_tiles_h: int, n_tiles_w: int
+        self,
+        tile_slen: int,
+        batch_size: int,
+        n_tiles_h: int,
+        n_tiles_w: int,
+        galaxy_indices: bool = False,
+        generators: Optional[Sequence[torch.Generator]] = None,
     ) -> TileCatalog:
         """Samples latent variables from the prior of an astronomical image.
 
@@ -131,6 +158,11 @@ class ImagePrior(pl.LightningModule):
             batch_size: The number of samples to draw.
             n_tiles_h: Number of tiles height-wise.
             n_tiles_w: Number of tiles width-wise.
+            galaxy_indices: If True, also return the indices of the sampled galaxy latents
+                within the `GalaxyPrior` as `"galaxy_indices"` (e.g. to render galaxies from a
+                stamp bank, see `ImageDecoder.set_galaxy_stamp_bank`).
+            generators: Optional generators (on the device of the prior), one per image, from
+                which all quantities of each image are drawn instead of the global RNG.
 
         Returns:
             A dictionary of tensors. Each tensor is a particular per-tile quantity; i.e.
@@ -140,28 +172,29 @@ class ImagePrior(pl.LightningModule):
         """
         assert n_tiles_h > 0
         assert n_tiles_w > 0
-        n_sources = self._sample_n_sources(batch_size, n_tiles_h, n_tiles_w)
+        n_sources = self._sample_n_sources(batch_size, n_tiles_h, n_tiles_w, generators)
         is_on_array = get_is_on_from_n_sources(n_sources, self.max_sources)
-        locs = self._sample_locs(is_on_array)
+        locs = self._sample_locs(is_on_array, generators)
 
-        galaxy_bools, star_bools = self._sample_n_galaxies_and_stars(is_on_array)
-        galaxy_params = self._sample_galaxy_params(galaxy_bools)
-        fluxes = self._sample_fluxes(star_bools)
+        galaxy_bools, star_bools = self._sample_n_galaxies_and_stars(is_on_array, generators)
+        galaxy_params, galaxy_latent_indices = self._sample_galaxy_params(galaxy_bools, generators)
+        fluxes = self._sample_fluxes(star_bools, generators)
         log_fluxes = self._get_log_fluxes(fluxes)
 
         # per tile quantities.
-        return TileCatalog(
-            tile_slen,
-            {
-                "n_sources": n_sources,
-                "locs": locs,
-                "galaxy_bools": galaxy_bools,
-                "star_bools": star_bools,
-                "galaxy_params": galaxy_params,
-                "fluxes": fluxes,
-                "log_fluxes": log_fluxes,
-            },
-        )
+        tile_params = {
+            "n_sources": n_sources,
+            "locs": locs,
+            "galaxy_bools": galaxy_bools,
+            "star_bools": star_bools,
+            "galaxy_params": galaxy_params,
+            "fluxes": fluxes,
+            "log_fluxes": log_fluxes,
+        }
+        if galaxy_indices:
+            assert galaxy_latent_indices is not None, "Galaxy latents were not sampled."
+            tile_params["galaxy_indices"] = galaxy_latent_indices
+        return TileCatalog(tile_slen, tile_params)
 
     @staticmethod
     def _get_log_fluxes(fluxes):
@@ -170,56 +203,65 @@ class ImagePrior(pl.LightningModule):
         )  # prevent log(0) errors.
         return torch.log(log_fluxes)
 
-    def _sample_n_sources(self, batch_size, n_tiles_h, n_tiles_w):
+    def _sample_n_sources(self, batch_size, n_tiles_h, n_tiles_w, generators=None):
         # returns number of sources for each batch x tile
         # output dimension is batch_size x n_tiles_h x n_tiles_w
 
         # always poisson distributed.
-        p = torch.full((1,), self.mean_sources, device=self.device, dtype=torch.float)
-        m = Poisson(p)
-        n_sources = m.sample([batch_size, n_tiles_h, n_tiles_w])
+        shape = (n_tiles_h, n_tiles_w, 1)
+        n_sources = _sample_per_image(
+            lambda n, gen: torch.poisson(
+                torch.full((n, *shape), self.mean_sources, device=self.device, dtype=torch.float),
+                generator=gen,
+            ),
+            batch_size,
+            generators,
+        )
 
         # long() here is necessary because used for indexing and one_hot encoding.
         n_sources = n_sources.clamp(max=self.max_sources, min=self.min_sources)
         return rearrange(n_sources.long(), "b nth ntw 1 -> b nth ntw")
 
-    def _sample_locs(self, is_on_array):
+    def _sample_locs(self, is_on_array, generators=None):
         # output dimension is batch_size x n_tiles_h x n_tiles_w x max_sources x 2
 
         # 2 = (x,y)
         batch_size, n_tiles_h, n_tiles_w, max_sources = is_on_array.shape
-        shape = (batch_size, n_tiles_h, n_tiles_w, max_sources, 2)
-        locs = torch.rand(*shape, device=is_on_array.device)
+        shape = (n_tiles_h, n_tiles_w, max_sources, 2)
+        locs = _sample_per_image(
+            lambda n, gen: torch.rand(n, *shape, device=is_on_array.device, generator=gen),
+            batch_size,
+            generators,
+        )
         locs *= is_on_array.unsqueeze(-1)
 
         return locs
 
-    def _sample_n_galaxies_and_stars(self, is_on_array):
+    def _sample_n_galaxies_and_stars(self, is_on_array, generators=None):
         # the counts returned (n_galaxies, n_stars) are of
         # shape (batch_size x n_tiles_h x n_tiles_w)
         # the booleans returned (galaxy_bools, star_bools) are of shape
         # (batch_size x n_tiles_h x n_tiles_w x max_sources x 1)
         # this last dimension is so it is consistent with other catalog values.
         batch_size, n_tiles_h, n_tiles_w, max_sources = is_on_array.shape
-        uniform = torch.rand(
+        shape = (n_tiles_h, n_tiles_w, max_sources, 1)
+        uniform = _sample_per_image(
+            lambda n, gen: torch.rand(n, *shape, device=is_on_array.device, generator=gen),
             batch_size,
-            n_tiles_h,
-            n_tiles_w,
-            max_sources,
-            1,
-            device=is_on_array.device,
+            generators,
         )
         galaxy_bools = uniform < self.prob_galaxy
         galaxy_bools = (galaxy_bools * is_on_array.unsqueeze(-1)).float()
         star_bools = (1 - galaxy_bools) * is_on_array.unsqueeze(-1)
         return galaxy_bools, star_bools
 
-    def _sample_fluxes(self, star_bools: Tensor):
+    def _sample_fluxes(self, star_bools: Tensor, generators=None):
         """Samples fluxes.
 
         Arguments:
             star_bools: Tensor indicating whether each object is a star or not.
                 Has shape (batch_size x n_tiles_h x n_tiles_w x max_sources x 1)
+            generators: Optional generators (one per image) for the random draws.
 
         Returns:
             fluxes, tensor shape
@@ -227,18 +269,20 @@ class ImagePrior(pl.LightningModule):
         """
         device = star_bools.device
         batch_size, n_tiles_h, n_tiles_w, max_sources, _ = star_bools.shape
-        shape = (batch_size, n_tiles_h, n_tiles_w, max_sources, 1)
-        base_fluxes = self._draw_pareto_maxed(shape, device)
+        shape = (n_tiles_h, n_tiles_w, max_sources, 1)
+        base_fluxes = _sample_per_image(
+            lambda n, gen: self._draw_pareto_maxed((n, *shape), device, gen),
+            batch_size,
+            generators,
+        )
 
         if self.n_bands > 1:
-            shape = (
+            shape = (n_tiles_h, n_tiles_w, max_sources, self.n_bands - 1)
+            colors = _sample_per_image(
+                lambda n, gen: torch.randn(n, *shape, device=device, generator=gen),
                 batch_size,
-                n_tiles_h,
-                n_tiles_w,
-                max_sources,
-                self.n_bands - 1,
+                generators,
             )
-            colors = torch.randn(*shape, device=device)
             fluxes = 10 ** (colors / 2.5) * base_fluxes
             fluxes = torch.cat((base_fluxes, fluxes), dim=-1)
             fluxes *= star_bools.float()
@@ -247,22 +291,37 @@ class ImagePrior(pl.LightningModule):
 
         return fluxes
 
-    def _draw_pareto_maxed(self, shape, device):
+    def _draw_pareto_maxed(self, shape, device, generator=None):
         # draw pareto conditioned on being less than f_max
 
         u_max = self._pareto_cdf(self.f_max)
-        uniform_samples = torch.rand(*shape, device=device) * u_max
+        uniform_samples = torch.rand(*shape, device=device, generator=generator) * u_max
         return self.f_min / (1.0 - uniform_samples) ** (1 / self.alpha)
 
     def _pareto_cdf(self, x):
         return 1 - (self.f_min / x) ** self.alpha
 
-    def _sample_galaxy_params(self, galaxy_bools):
-        """Sample latent galaxy params from GalaxyPrior object."""
+    def _sample_galaxy_params(self, galaxy_bools, generators=None):
+        """Sample latent galaxy params (and their indices, if any) from GalaxyPrior object."""
         batch_size, n_tiles_h, n_tiles_w, max_sources, _ = galaxy_bools.shape
         total_latent = batch_size * n_tiles_h * n_tiles_w * max_sources
-        if self.prob_galaxy > 0.0:
-            samples = self.galaxy_prior.sample(total_latent, galaxy_bools.device)
+        latent_per_image = n_tiles_h * n_tiles_w * max_sources
+        device = galaxy_bools.device
+        indices = None
+        if self.prob_galaxy > 0.0 and isinstance(self.galaxy_prior, GalaxyPrior):
+            galaxy_prior = self.galaxy_prior
+            indices = _sample_per_image(
+                lambda n, gen: galaxy_prior.sample_indices(n * latent_per_image, device, gen),
+                batch_size,
+                generators,
+            )
+            samples = self.galaxy_prior.latents[indices]
+        elif self.prob_galaxy > 0.0:
+            samples = _sample_per_image(
+                lambda n, gen: self.galaxy_prior.sample(n * latent_per_image, device, gen),
+                batch_size,
+                generators,
+            )
         else:
             samples = torch.zeros((total_latent, 1), device=galaxy_bools.device)
         galaxy_params = rearrange(
@@ -273,4 +332,6 @@ class ImagePrior(pl.LightningModule):
             ntw=n_tiles_w,
             s=max_sources,
         )
-        return galaxy_params * galaxy_bools
+        if indices is not None:
+            indices = indices.view(*galaxy_bools.shape) * galaxy_bools.long()
+        return galaxy_params * galaxy_bools, indices
@@ -1,3 +1,5 @@
+from typing import Optional
+
 import pytorch_lightning as pl
 import torch
 from matplotlib import pyplot as plt
@@ -37,8 +39,15 @@ class CenteredGalaxyLatentFlow(pl.LightningModule):
         loss = -log_prob
         return loss, latent
 
-    def sample(self, n_samples):
-        return self.flow.sample(n_samples)
+    def sample(self, n_samples, generator: Optional[torch.Generator] = None):
+        if generator is None:
+            return self.flow.sample(n_samples)
+        # same as `Flow.sample` with a standard normal base distribution, but using `generator`.
+        noise = torch.randn(
+            n_samples, self.latent_dim, device=generator.device, generator=generator
+        )
+        samples, _ = self.flow._transform.inverse(noise)  # noqa: WPS437
+        return samples
 
     def log_prob(self, x):
         return self.flow.log_prob(x)
@@ -22,10 +22,12 @@ class GalaxyVAEPrior:
             self.flow.requires_grad_(False)
             self.flow.load_state_dict(torch.load(vae_flow_ckpt, map_location=vae_flow.device))
 
-    def sample(self, n_latent_samples, device):
+    def sample(self, n_latent_samples, device, generator: Optional[torch.Generator] = None):
         if self.flow is None:
-            samples = torch.randn((n_latent_samples, self.latent_dim), device=device)
+            samples = torch.randn(
+                (n_latent_samples, self.latent_dim), device=device, generator=generator
+            )
         else:
             self.flow = self.flow.to(device=device)
-            samples = self.flow.sample(n_latent_samples)
+            samples = self.flow.sample(n_latent_samples, generator)
         return samples
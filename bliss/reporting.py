@@ -1,24 +1,32 @@
 """Functions to evaluate the performance of BLISS predictions."""
-from typing import Dict, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Dict, Optional, Tuple, Union
 
 import galsim
 import matplotlib as mpl
 import numpy as np
 import torch
-import tqdm
 from astropy.table import Table
 from astropy.wcs import WCS
-from einops import rearrange, reduce
+from einops import rearrange
 from matplotlib.figure import Figure
 from matplotlib.pyplot import Axes
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from scipy import optimize as sp_optim
-from sklearn.metrics import confusion_matrix
+from scipy import sparse as sp_sparse
+from scipy.sparse import csgraph as sp_csgraph
+from scipy.spatial import cKDTree
 from sklearn.neighbors import NearestNeighbors
 from torch import Tensor
 from torchmetrics import Metric
 
-from bliss.catalog import FullCatalog
+from bliss.catalog import (
+    FullCatalog,
+    SparseTileCatalog,
+    TileCatalog,
+    get_is_on_from_n_sources,
+)
 from bliss.datasets.sdss import column_to_tensor, convert_flux_to_mag, convert_mag_to_flux
 
 
@@ -69,24 +77,18 @@ class DetectionMetrics(Metric):
         assert isinstance(est, FullCatalog)
         assert true.batch_size == est.batch_size
 
-        count = 0
-        for b in range(true.batch_size):
-            ntrue, nest = true.n_sources[b].int().item(), est.n_sources[b].int().item()
-            tlocs, elocs = true.plocs[b], est.plocs[b]
-            if ntrue > 0 and nest > 0:
-                mtrue, mest, dkeep, avg_distance = match_by_locs(tlocs, elocs, self.slack)
-                tp = len(elocs[mest][dkeep])  # n_matches
-                true_galaxy_bools = true["galaxy_bools"][b][mtrue][dkeep]
-                tp_gal = true_galaxy_bools.bool().sum()
-                fp = nest - tp
-                assert fp >= 0
-                self.tp += tp
-                self.tp_gal += tp_gal
-                self.fp += fp
-                self.avg_distance += avg_distance
-                self.total_true_n_sources += ntrue
-                count += 1
-        self.avg_distance /= count
+        batch_indx, row_indx, _, dist_keep, avg_distance = match_by_locs_batched(
+            true, est, self.slack
+        )
+        has_sources = (true.n_sources > 0) & (est.n_sources > 0)
+        tp = torch.bincount(batch_indx[dist_keep], minlength=true.batch_size)
+        true_galaxy_bools = true["galaxy_bools"][batch_indx, row_indx, 0][dist_keep]
+        self.tp += tp.sum()
+        self.tp_gal += true_galaxy_bools.bool().sum()
+        self.fp += (est.n_sources - tp)[has_sources].sum()
+        self.avg_distance += avg_distance[has_sources].sum()
+        self.total_true_n_sources += true.n_sources[has_sources].sum()
+        self.avg_distance /= has_sources.sum()
 
     def compute(self) -> Dict[str, Tensor]:
         precision = self.tp / (self.tp + self.fp)  # = PPV = positive predictive value
@@ -143,18 +145,15 @@ class ClassificationMetrics(Metric):
         assert isinstance(true, FullCatalog)
         assert isinstance(est, FullCatalog)
         assert true.batch_size == est.batch_size
-        for b in range(true.batch_size):
-            ntrue, nest = true.n_sources[b].int().item(), est.n_sources[b].int().item()
-            tlocs, elocs = true.plocs[b], est.plocs[b]
-            tgbool, egbool = true["galaxy_bools"][b].reshape(-1), est["galaxy_bools"][b].reshape(-1)
-            if ntrue > 0 and nest > 0:
-                mtrue, mest, dkeep, _ = match_by_locs(tlocs, elocs, self.slack)
-                tgbool = tgbool[mtrue][dkeep].reshape(-1)
-                egbool = egbool[mest][dkeep].reshape(-1)
-                self.total_n_matches += len(egbool)
-                self.total_coadd_gal_matches += tgbool.sum().int().item()
-                self.total_correct_class += tgbool.eq(egbool).sum().int()
-                self.conf_matrix += confusion_matrix(tgbool, egbool, labels=[1, 0])
+        batch_indx, row_indx, col_indx, dist_keep, _ = match_by_locs_batched(true, est, self.slack)
+        tgbool = true["galaxy_bools"][batch_indx, row_indx, 0][dist_keep].long()
+        egbool = est["galaxy_bools"][batch_indx, col_indx, 0][dist_keep].long()
+        self.total_n_matches += dist_keep.sum()
+        self.total_coadd_gal_matches += tgbool.sum()
+        self.total_correct_class += tgbool.eq(egbool).sum()
+        # same layout as `confusion_matrix(tgbool, egbool, labels=[1, 0])`.
+        conf_indx = 2 * (1 - tgbool) + (1 - egbool)
+        self.conf_matrix += torch.bincount(conf_indx, minlength=4).reshape(2, 2)
 
     # pylint: disable=no-member
     def compute(self) -> Dict[str, Tensor]:
@@ -170,11 +169,15 @@ class ClassificationMetrics(Metric):
 def match_by_locs(true_locs, est_locs, slack=1.0):
     """Match true and estimated locations and returned indices to match.
 
-    Permutes `est_locs` to find minimal error between `true_locs` and `est_locs`.
-    The matching is done with `scipy.optimize.linear_sum_assignment`, which implements
-    the Hungarian algorithm.
+    Finds the largest set of pairs of true and estimated objects less than `slack` apart (in
+    l-infinity distance) and, among all such sets, the one with minimal total l1 error.
+    Pairs within `slack` are found with a KD-tree, and the assignment is solved with
+    `scipy.optimize.linear_sum_assignment` (the Hungarian algorithm) separately within each
+    connected component of the graph of these pairs, which is exact and takes near-linear time
+    in the number of objects. The remaining objects (which have no pair within `slack`) are
+    then assigned to each other with minimal total l1 error, and are not kept.
 
-    Automatically discards matches where at least one location has coordinates **exactly** (0, 0).
+    Automatically discards objects with coordinates **exactly** (0, 0), which are never assigned.
 
     Args:
         slack: Threshold for matching objects a `slack` l-infinity distance away (in pixels).
@@ -185,9 +188,9 @@ def match_by_locs(true_locs, est_locs, slack=1.0):
 
     Returns:
         A tuple of the following objects:
-        - row_indx: Indicies of true objects matched to estimated objects.
+        - row_indx: Indicies of true objects matched to estimated objects (sorted).
         - col_indx: Indicies of estimated objects matched to true objects.
-        - dist_keep: Matched objects to keep based on l1 distances.
+        - dist_keep: Matched objects to keep based on l-infinity distances.
         - avg_distance: Average l-infinity distance over matched objects.
     """
     assert len(true_locs.shape) == len(est_locs.shape) == 2
@@ -196,149 +199,240 @@ def match_by_locs(true_locs, est_locs, slack=1.0):
 
     locs1 = true_locs.view(-1, 2)
     locs2 = est_locs.view(-1, 2)
+    row_indx, col_indx = _match_within_slack(
+        locs1.detach().cpu().numpy(), locs2.detach().cpu().numpy(), slack
+    )
 
-    locs_abs_diff = (rearrange(locs1, "i j -> i 1 j") - rearrange(locs2, "i j -> 1 i j")).abs()
-    locs_err = reduce(locs_abs_diff, "i j k -> i j", "sum")
-    locs_err_l_infty = reduce(locs_abs_diff, "i j k -> i j", "max")
-
-    # Penalize all pairs which are greater than slack apart to favor valid matches.
-    locs_err = locs_err + (locs_err_l_infty > slack) * locs_err.max()
-
-    # find minimal permutation and return matches
-    row_indx, col_indx = sp_optim.linear_sum_assignment(locs_err.detach().cpu())
-
-    # we match objects based on distance too.
-    # only match objects that satisfy threshold on l-infinity distance.
-    # do not match fake objects with locs = (0, 0)
     dist = (locs1[row_indx] - locs2[col_indx]).abs().max(1)[0]
-    origin_dist = torch.min(locs1[row_indx].pow(2).sum(1), locs2[col_indx].pow(2).sum(1))
-    cond1 = (dist < slack).bool()
-    cond2 = (origin_dist > 0).bool()
-    dist_keep = torch.logical_and(cond1, cond2)
-    avg_distance = dist[cond2].mean()  # average l-infinity distance over matched objects.
+    dist_keep = dist < slack
+    avg_distance = dist.mean()  # average l-infinity distance over matched objects.
     if dist_keep.sum() > 0:
         assert dist[dist_keep].max() <= slack
     return row_indx, col_indx, dist_keep, avg_distance
 
 
-def find_match(idx, mdic):
-    """Recursion function to find matches."""
-
-    num_match = len(idx)
+def match_by_locs_batched(true_params: FullCatalog, est_params: FullCatalog, slack=1.0):
+    """Match true and estimated locations of all images of a batch together.
 
-    if num_match > 0:
-        dic_key = idx[0][1]
+    Gives the same matches as `match_by_locs` on each image, but the pairs within `slack` are
+    found and assigned for the whole batch at once and the output stays on the device of the
+    catalogs. The matching itself runs on the CPU (with scipy), so the locations of the batch
+    are copied to the host in a single transfer, which synchronizes with the device.
 
-        # if there is no match, fill it
-        if mdic[dic_key] is None:
-            mdic[dic_key] = idx
+    Args:
+        true_params: True catalog of a batch of images.
+        est_params: Estimated catalog of the same batch of images.
+        slack: Threshold for matching objects a `slack` l-infinity distance away (in pixels).
 
-        # if first match has larger distance, check the second match
-        elif idx[0][0] >= mdic[dic_key][0][0]:
-            del idx[0]
-            mdic = find_match(idx, mdic)
+    Returns:
+        A tuple of the following tensors:
+        - batch_indx: Image of each matched pair.
+        - row_indx: Indices of true objects (within their image) of each matched pair.
+        - col_indx: Indices of estimated objects (within their image) of each matched pair.
+        - dist_keep: Matched objects to keep based on l-infinity distances.
+        - avg_distance: Average l-infinity distance over matched objects of each image.
+    """
+    assert true_params.batch_size == est_params.batch_size
+    batch_size = true_params.batch_size
+    true_is_on = get_is_on_from_n_sources(true_params.n_sources, true_params.max_sources)
+    est_is_on = get_is_on_from_n_sources(est_params.n_sources, est_params.max_sources)
+    true_batch, true_indx = true_is_on.nonzero(as_tuple=True)
+    est_batch, est_indx = est_is_on.nonzero(as_tuple=True)
+    locs1 = true_params.plocs[true_batch, true_indx]
+    locs2 = est_params.plocs[est_batch, est_indx]
+
+    # locations and images of all objects are copied to the host together.
+    host_locs = torch.cat((locs1, locs2)).detach()
+    host_batch = torch.cat((true_batch, est_batch)).to(host_locs.dtype).unsqueeze(1)
+    host = torch.cat((host_locs, host_batch), dim=1).cpu().numpy()
+    points, batch = host[:, :2], host[:, 2].astype(np.int64)
+    n1 = len(locs1)
+    rows_np, cols_np = _match_within_slack(points[:n1], points[n1:], slack, batch[:n1], batch[n1:])
+    rows = torch.from_numpy(rows_np).to(true_params.device)
+    cols = torch.from_numpy(cols_np).to(true_params.device)
+    batch_indx = true_batch[rows]
+
+    dist = (locs1[rows] - locs2[cols]).abs().max(1)[0]
+    dist_keep = dist < slack
+    n_matches = torch.bincount(batch_indx, minlength=batch_size)
+    dist_sum = dist.new_zeros(batch_size).index_add_(0, batch_indx, dist)
+    return batch_indx, true_indx[rows], est_indx[cols], dist_keep, dist_sum / n_matches
+
+
+def _match_within_slack(
+    points1: np.ndarray,
+    points2: np.ndarray,
+    slack: float,
+    batch1: Optional[np.ndarray] = None,
+    batch2: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Assignment of `points1` to `points2` maximizing the number of pairs within `slack`.
+
+    If `batch1` and `batch2` are given (as the image index of each object), objects are only
+    assigned to objects of the same image.
 
-        # if new match has smaller distance, replace the former match
-        # then check the second match for replaced point
-        else:
-            new_idx = mdic[dic_key]
-            mdic[dic_key] = idx
-            del new_idx[0]
-            mdic = find_match(new_idx, mdic)
+    Returns:
+        Indices of `points1` (sorted) and of `points2` of each assigned pair.
+    """
+    batch1 = np.zeros(len(points1), dtype=np.int64) if batch1 is None else batch1
+    batch2 = np.zeros(len(points2), dtype=np.int64) if batch2 is None else batch2
+    rows, cols, locs_err = _get_pairs_within_slack(points1, points2, slack, batch1, batch2)
+    rows, cols = _assign_pairs(rows, cols, locs_err, slack)
+
+    # remaining objects have no pair within `slack`, they are assigned by l1 error alone.
+    is_left1 = (points1**2).sum(1) > 0
+    is_left2 = (points2**2).sum(1) > 0
+    is_left1[rows], is_left2[cols] = False, False
+    rows_list, cols_list = [rows], [cols]
+    for b in np.intersect1d(batch1[is_left1], batch2[is_left2]):
+        left_rows = np.flatnonzero(is_left1 & (batch1 == b))
+        left_cols = np.flatnonzero(is_left2 & (batch2 == b))
+        left_err = np.abs(points1[left_rows, None] - points2[None, left_cols]).sum(-1)
+        left_row_indx, left_col_indx = sp_optim.linear_sum_assignment(left_err)
+        rows_list.append(left_rows[left_row_indx])
+        cols_list.append(left_cols[left_col_indx])
+    rows, cols = np.concatenate(rows_list), np.concatenate(cols_list)
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+
+def _get_pairs_within_slack(
+    points1: np.ndarray,
+    points2: np.ndarray,
+    slack: float,
+    batch1: np.ndarray,
+    batch2: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Pairs of points (not at the origin) less than `slack` apart and their l1 distance."""
+    # images are set farther than `slack` apart along an additional coordinate.
+    # the radius is padded for rounding errors, distances are then computed as in torch.
+    tree1 = cKDTree(np.concatenate((points1, batch1[:, None] * (2 * slack + 1.0)), axis=1))
+    tree2 = cKDTree(np.concatenate((points2, batch2[:, None] * (2 * slack + 1.0)), axis=1))
+    pairs = tree1.sparse_distance_matrix(tree2, slack + 1e-3, p=np.inf, output_type="ndarray")
+    rows, cols = pairs["i"].astype(np.int64), pairs["j"].astype(np.int64)
+    locs_abs_diff = np.abs(points1[rows] - points2[cols])
+    is_real1, is_real2 = (points1**2).sum(1) > 0, (points2**2).sum(1) > 0
+    keep = (locs_abs_diff.max(1) < slack) & is_real1[rows] & is_real2[cols]
+    return rows[keep], cols[keep], locs_abs_diff[keep].sum(1, dtype=np.float64)
+
+
+def _assign_pairs(
+    rows: np.ndarray, cols: np.ndarray, locs_err: np.ndarray, slack: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Largest matching among the pairs (`rows`, `cols`) with minimal total error `locs_err`.
+
+    Each error is assumed to be less than `2 * slack`. The matching is found separately within
+    each connected component of the bipartite graph of pairs.
 
-    return mdic
+    Returns:
+        Indices in `rows` (sorted) and in `cols` of the matched pairs.
+    """
+    if len(rows) == 0:
+        return rows, cols
+    n1, n2 = rows.max() + 1, cols.max() + 1
+    graph = sp_sparse.coo_matrix((np.ones(len(rows)), (rows, n1 + cols)), shape=(n1 + n2, n1 + n2))
+    _, labels = sp_csgraph.connected_components(graph, directed=False)
+    order = np.argsort(labels[rows], kind="stable")
+    rows, cols, locs_err = rows[order], cols[order], locs_err[order]
+    _, starts, n_pairs = np.unique(labels[rows], return_index=True, return_counts=True)
+
+    # components with a single pair are matched directly.
+    is_single = np.repeat(n_pairs == 1, n_pairs)
+    row_indx_list, col_indx_list = [rows[is_single]], [cols[is_single]]
+    for start, n in zip(starts[n_pairs > 1], n_pairs[n_pairs > 1]):
+        comp_rows, comp_cols = rows[start : start + n], cols[start : start + n]
+        row_ids, rows_inv = np.unique(comp_rows, return_inverse=True)
+        col_ids, cols_inv = np.unique(comp_cols, return_inverse=True)
+        # each pair gains more than the total error of any matching, so that the assignment
+        # (which may use entries that are not pairs) first maximizes the number of pairs.
+        gain = 2 * float(slack) * min(len(row_ids), len(col_ids)) + 1.0
+        cost = np.zeros((len(row_ids), len(col_ids)))
+        is_pair = np.zeros((len(row_ids), len(col_ids)), dtype=bool)
+        cost[rows_inv, cols_inv] = locs_err[start : start + n] - gain
+        is_pair[rows_inv, cols_inv] = True
+        comp_row_indx, comp_col_indx = sp_optim.linear_sum_assignment(cost)
+        keep = is_pair[comp_row_indx, comp_col_indx]
+        row_indx_list.append(row_ids[comp_row_indx[keep]])
+        col_indx_list.append(col_ids[comp_col_indx[keep]])
+    row_indx, col_indx = np.concatenate(row_indx_list), np.concatenate(col_indx_list)
+    order = np.argsort(row_indx)
+    return row_indx[order], col_indx[order]
 
 
 def kdtree_match(locs1, locs2, slack=1, method_id=1):
     """Match points of locs1 and locs2 and return indices to match.
 
+    Both methods run a single (batched) neighbor query for all points of locs2.
+
     Args:
         locs1: Tensor of shape `(n1 x 2)`
         locs2: Tensor of shape `(n2 x 2)`
         slack: Threshold for matching objects
         method_id: 0 or 1, corresponding two different match methods:
             - radius search(method_id=0):
-                Find neighbors in a given radius and return optimal permutation result
+                Find neighbors in a given radius and return optimal permutation result,
+                i.e. repeatedly match the closest pair of points that are still unmatched.
             - nearest neighbor research(method_id=1): Default
                 Find nearest neighbor for each point in locs2
                 Return match with cloest distance of None for each point in locs1
 
     Returns:
-        - row_indx: Indicies of locs1 matched to locs2.
+        - row_indx: Indicies of locs1 matched to locs2 (sorted).
         - col_indx: Indicies of locs2 matched to locs1.
     """
-
-    n1 = len(locs1)
-    n2 = len(locs2)
-
-    # dict for permutation test
-    # the elements of tuple correspond to index, k-th neighbor and distance
-    mdic = {k: None for k in range(n1)}
-
-    # Indicies of match
     row_idx = np.array([], dtype="int")
     col_idx = np.array([], dtype="int")
+    if len(locs1) == 0 or len(locs2) == 0:
+        return row_idx, col_idx
 
     # radius search
     if method_id == 0:
-
-        # set up kdtree
         neigh = NearestNeighbors(algorithm="kd_tree", radius=slack)
         neigh.fit(locs1)
-
-        for i in range(n2):
-            id_point = i
-            result = neigh.radius_neighbors(locs2[id_point][None, :], sort_results=True)
-            num_match = len(result[0][0])
-
-            # no matching, pass
-            if num_match < 1:
-                continue
-
-            # a list match of (distance, locs1, locs2) ordered by distance
-            id_list = []
-            for _ in range(num_match):
-                id_list.append(id_point)
-            idx = list(zip(result[0][0], result[1][0], id_list))
-
-            # find a proper match
-            mdic = find_match(idx, mdic)
-
-        for s in mdic.keys():
-            if mdic[s]:
-                row_idx = np.append(row_idx, s)
-                col_idx = np.append(col_idx, mdic[s][0][2])
+        graph = neigh.radius_neighbors_graph(locs2, mode="distance").tocoo()
+        row_idx, col_idx = _greedy_match_by_distance(graph.col, graph.row, graph.data)
 
     # nearest neighbor search
     if method_id == 1:
-
-        # set up kdtree
         neigh = NearestNeighbors(algorithm="kd_tree")
         neigh.fit(locs1)
+        dist, indx = neigh.kneighbors(locs2, 1)
+        dist, indx = dist[:, 0], indx[:, 0]
+        cols = np.flatnonzero(dist <= slack)
 
-        for i in range(n2):
-            id_point = i
-            result = neigh.kneighbors(locs2[id_point][None, :], 1)
-            num_match = len(result[0][0])
+        # each point of locs1 keeps its closest point (the first one in case of a tie).
+        order = np.lexsort((cols, dist[cols], indx[cols]))
+        row_idx, first = np.unique(indx[cols][order], return_index=True)
+        col_idx = cols[order][first]
 
-            # no match or distance larger than threshold, pass
-            if num_match < 1 or result[0][0][0] > slack:
-                continue
-
-            # nearest point and distance
-            idx = [result[0][0][0], result[1][0][0], id_point]
+    return row_idx, col_idx
 
-            # if no match or the match has lower distance, fill it
-            if mdic[idx[1]] is None or mdic[idx[1]][0] > idx[0]:
-                mdic[idx[1]] = idx
-            # otherwise, invalid match
 
-        for s in mdic.keys():
-            if mdic[s]:
-                row_idx = np.append(row_idx, s)
-                col_idx = np.append(col_idx, mdic[s][2])
+def _greedy_match_by_distance(rows: np.ndarray, cols: np.ndarray, dist: np.ndarray):
+    """Repeatedly matches the closest candidate pair whose row and column are still unmatched.
 
-    return row_idx, col_idx
+    Pairs are processed in rounds: every pair that is the closest remaining pair of both its row
+    and its column is matched, and all pairs sharing a row or column with a match are discarded.
+    Ties in distance are broken by column and then by row index.
+    """
+    order = np.lexsort((rows, cols, dist))
+    rows, cols = rows[order], cols[order]
+    row_parts, col_parts = [], []
+    while len(rows) > 0:
+        # pairs are sorted, so the closest pair of each row (column) is its first pair.
+        is_closest_for_row = np.zeros(len(rows), dtype=bool)
+        is_closest_for_row[np.unique(rows, return_index=True)[1]] = True
+        is_closest_for_col = np.zeros(len(cols), dtype=bool)
+        is_closest_for_col[np.unique(cols, return_index=True)[1]] = True
+        is_match = is_closest_for_row & is_closest_for_col
+        row_parts.append(rows[is_match])
+        col_parts.append(cols[is_match])
+        is_free = ~(np.isin(rows, rows[is_match]) | np.isin(cols, cols[is_match]))
+        rows, cols = rows[is_free], cols[is_free]
+    row_idx = np.concatenate(row_parts) if row_parts else np.array([], dtype="int")
+    col_idx = np.concatenate(col_parts) if col_parts else np.array([], dtype="int")
+    order = np.argsort(row_idx)
+    return row_idx[order], col_idx[order]
 
 
 def match_by_locs_kdtree(true_locs, est_locs, slack=1.0, method_id=1):
@@ -470,6 +564,226 @@ def scene_metrics(
     return {**detection_result, **classification_result, "counts": counts}
 
 
+def get_detection_stats_by_threshold(
+    true_params: FullCatalog, est_tile_params: TileCatalog, thresholds: np.ndarray, slack=1.0
+) -> Dict[str, Union[int, Tensor]]:
+    """True and false positives of detections for each threshold on the probability of a source.
+
+    The estimated sources are the (single) source of each tile whose probability of containing a
+    source (`"n_source_log_probs"`) is at least the threshold. The candidate sources at the lowest
+    threshold are matched to the true sources once, and the detections at every threshold are
+    evaluated from this single match with sorted cumulative counts.
+
+    Args:
+        true_params: True parameters of each source in the scene (e.g. from coadd catalog).
+        est_tile_params: Estimated tile catalog with `"n_source_log_probs"` and at most one source
+            per tile (e.g. from `Encoder.variational_mode`).
+        thresholds: Array of thresholds on the probability of a source in a tile.
+        slack: Pixel L-infinity distance slack when doing matching for metrics.
+
+    Returns:
+        Dictionary with the true positives (`"tp"`), false positives (`"fp"`) and whether each true
+        source is detected (`"true_matches"`) at each threshold, as well as the number of true
+        sources (`"n_obj"`).
+    """
+    assert true_params.batch_size == est_tile_params.batch_size == 1
+    log_probs = rearrange(est_tile_params["n_source_log_probs"], "n nth ntw 1 1 -> n nth ntw")
+    log_thresholds = torch.tensor(np.log(thresholds), dtype=log_probs.dtype)
+
+    # candidate sources at the lowest threshold.
+    tile_dict = est_tile_params.to_dict()
+    tile_dict["n_sources"] = (log_probs >= log_thresholds.min()).long()
+    candidates = SparseTileCatalog.from_tile_catalog(
+        TileCatalog(est_tile_params.tile_slen, tile_dict)
+    )
+    candidate_log_probs = log_probs[tuple(candidates.indices[:, :3].T)].cpu()
+    est_params = candidates.to_full_params()
+
+    # log probability of the candidate matched to each true source (-inf if unmatched).
+    n_true, n_est = true_params.plocs.shape[1], est_params.plocs.shape[1]
+    matched_log_probs = torch.full((n_true,), -np.inf, dtype=log_probs.dtype)
+    if n_true > 0 and n_est > 0:
+        row_indx, col_indx, dkeep, _ = match_by_locs(
+            true_params.plocs[0], est_params.plocs[0], slack
+        )
+        matched_log_probs[row_indx[dkeep]] = candidate_log_probs[col_indx[dkeep]]
+
+    # number of candidates (matches) with probability at least each threshold.
+    n_selected = n_est - torch.searchsorted(candidate_log_probs.sort()[0], log_thresholds)
+    tp = n_true - torch.searchsorted(matched_log_probs.sort()[0], log_thresholds)
+    true_matches = matched_log_probs.unsqueeze(0) >= log_thresholds.unsqueeze(1)
+    return {"tp": tp, "fp": n_selected - tp, "true_matches": true_matches, "n_obj": n_true}
+
+
+def get_expected_detection_stats_by_threshold(
+    est_tile_params: TileCatalog, thresholds: np.ndarray
+) -> Dict[str, np.ndarray]:
+    """Expected positives and negatives of detections for each threshold on the source probability.
+
+    Each tile is detected if its probability of containing a source is at least the threshold,
+    and counts as a positive with that probability. All thresholds are evaluated at once from
+    cumulative sums of the sorted probabilities.
+
+    Args:
+        est_tile_params: Estimated tile catalog with `"n_source_log_probs"` and at most one source
+            per tile (e.g. from `Encoder.variational_mode`).
+        thresholds: Array of thresholds on the probability of a source in a tile.
+
+    Returns:
+        Dictionary with the expected true positives (`"tp"`), false positives (`"fp"`),
+        true negatives (`"tn"`), false negatives (`"fn"`) and the number of detected tiles
+        (`"n_selected"`) at each threshold.
+    """
+    log_probs = est_tile_params["n_source_log_probs"]
+    prob_on = rearrange(log_probs, "n nth ntw 1 1 -> (n nth ntw)").exp().cpu().sort()[0]
+    n_tiles = len(prob_on)
+
+    # tiles with probability below each threshold are not detected.
+    n_not_selected = torch.searchsorted(prob_on, torch.tensor(thresholds, dtype=prob_on.dtype))
+    prob_on = torch.cat((prob_on.new_zeros(1), prob_on)).double()
+    cumsum_prob_on, cumsum_prob_off = prob_on.cumsum(0), (1 - prob_on).cumsum(0) - 1
+    fn = cumsum_prob_on[n_not_selected]
+    tn = cumsum_prob_off[n_not_selected]
+    tp = cumsum_prob_on[-1] - fn
+    n_selected = n_tiles - n_not_selected
+    return {
+        "tp": tp.numpy(),
+        "fp": (n_selected - tp).numpy(),
+        "tn": tn.numpy(),
+        "fn": fn.numpy(),
+        "n_selected": n_selected.double().numpy(),
+    }
+
+
+class SceneMatch:
+    """Matching of the sources in a scene, reused to compute metrics for any magnitude bins.
+
+    Unlike `scene_metrics`, which looks for the pairs of (magnitude-cut) true and estimated sources
+    within the slack again for each bin, these pairs are found once for the full catalogs. Metrics
+    for any set of magnitude bins and of slacks (up to the slack given here) are then computed by
+    solving the assignment of `match_by_locs` over the pairs of each bin and slack only, which gives
+    the same matches as `scene_metrics`.
+    """
+
+    def __init__(self, true_params: FullCatalog, est_params: FullCatalog, slack: float = 1.0):
+        """Finds the pairs of true and estimated sources of a scene within the slack.
+
+        Args:
+            true_params: True parameters of each source in the scene (e.g. from coadd catalog).
+                Requires `"mags"` and `"galaxy_bools"`.
+            est_params: Predictions on scene obtained from predict_on_scene function.
+                Requires `"mags"` and `"galaxy_bools"`.
+            slack: Pixel L-infinity distance slack when doing matching for metrics.
+        """
+        assert true_params.batch_size == est_params.batch_size == 1
+        ntrue, nest = int(true_params.n_sources.item()), int(est_params.n_sources.item())
+        self.slack = slack
+        self.true_mags = true_params["mags"][0, :ntrue, 0].cpu().numpy()
+        self.est_mags = est_params["mags"][0, :nest, 0].cpu().numpy()
+        self.true_gbools = true_params["galaxy_bools"][0, :ntrue, 0].cpu().numpy().astype(bool)
+        self.est_gbools = est_params["galaxy_bools"][0, :nest, 0].cpu().numpy().astype(bool)
+
+        # pairs of sources within `slack`, with their l1 and l-infinity distances.
+        tlocs = true_params.plocs[0, :ntrue].detach().cpu().numpy()
+        elocs = est_params.plocs[0, :nest].detach().cpu().numpy()
+        self.pair_rows, self.pair_cols, self.pair_err = _get_pairs_within_slack(
+            tlocs, elocs, slack, np.zeros(ntrue, dtype=np.int64), np.zeros(nest, dtype=np.int64)
+        )
+        self.pair_dist = np.abs(tlocs[self.pair_rows] - elocs[self.pair_cols]).max(1)
+
+        # index of the match of each source in the full catalogs (-1 if unmatched).
+        row_indx, col_indx = _assign_pairs(self.pair_rows, self.pair_cols, self.pair_err, slack)
+        self.true_match = np.full(ntrue, -1)
+        self.est_match = np.full(nest, -1)
+        self.true_match[row_indx], self.est_match[col_indx] = col_indx, row_indx
+
+    @property
+    def row_indx(self) -> np.ndarray:
+        """Indices of true sources with a match (sorted)."""
+        return np.flatnonzero(self.true_match >= 0)
+
+    @property
+    def col_indx(self) -> np.ndarray:
+        """Indices of the estimated sources matched to each true source in `row_indx`."""
+        return self.true_match[self.row_indx]
+
+    def compute(self, mag_bins: np.ndarray, slacks: Union[Tuple[float, ...], np.ndarray] = (1.0,)):
+        """Detection and classification metrics for each slack and magnitude bin.
+
+        As in `scene_metrics`, precision is computed by matching the estimated sources in each bin
+        with all true sources, and recall (and classification metrics) by matching the true sources
+        in each bin with all estimated sources.
+
+        Args:
+            mag_bins: Array of shape `(n_bins x 2)` with the (exclusive) lower and upper magnitude
+                of each bin.
+            slacks: Pixel L-infinity distance slacks, which cannot exceed `self.slack`.
+
+        Returns:
+            Dictionary of arrays of shape `(n_slacks x n_bins)` with the metrics (and counts)
+            reported by `scene_metrics`, as well as the accuracy on true galaxies and stars.
+        """
+        mag_bins, slacks = np.asarray(mag_bins), np.asarray(slacks)
+        assert mag_bins.ndim == 2 and mag_bins.shape[1] == 2
+        assert np.all(slacks <= self.slack), "Slacks cannot exceed the slack used for matching."
+
+        # shapes are n_bins x n_sources.
+        tin_bin = (self.true_mags > mag_bins[:, :1]) & (self.true_mags < mag_bins[:, 1:])
+        ein_bin = (self.est_mags > mag_bins[:, :1]) & (self.est_mags < mag_bins[:, 1:])
+        shape = (len(slacks), len(mag_bins))
+        tcount, ecount = np.broadcast_to(tin_bin.sum(-1), shape), np.broadcast_to(
+            ein_bin.sum(-1), shape
+        )
+        tgcount = np.broadcast_to((tin_bin & self.true_gbools).sum(-1), shape)
+        egcount = np.broadcast_to((ein_bin & self.est_gbools).sum(-1), shape)
+
+        # the assignment is solved again over the pairs of each slack and bin.
+        n_ematches = np.zeros(shape, dtype=int)
+        conf_matrix = {k: np.zeros(shape, dtype=int) for k in ("gal_gal", "gal_star", "star_gal")}
+        conf_matrix["star_star"] = np.zeros(shape, dtype=int)
+        for ii, slack in enumerate(slacks):
+            is_pair = self.pair_dist < slack
+            for jj in range(len(mag_bins)):
+                keep = is_pair & ein_bin[jj, self.pair_cols]
+                row_indx, _ = self._assign(keep, slack)
+                n_ematches[ii, jj] = len(row_indx)
+
+                keep = is_pair & tin_bin[jj, self.pair_rows]
+                row_indx, col_indx = self._assign(keep, slack)
+                tgbool, egbool = self.true_gbools[row_indx], self.est_gbools[col_indx]
+                conf_matrix["gal_gal"][ii, jj] = (tgbool & egbool).sum()
+                conf_matrix["gal_star"][ii, jj] = (tgbool & ~egbool).sum()
+                conf_matrix["star_gal"][ii, jj] = (~tgbool & egbool).sum()
+                conf_matrix["star_star"][ii, jj] = (~tgbool & ~egbool).sum()
+        n_matches_gal = conf_matrix["gal_gal"] + conf_matrix["gal_star"]
+        n_matches_star = conf_matrix["star_gal"] + conf_matrix["star_star"]
+        n_matches = n_matches_gal + n_matches_star
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            precision = n_ematches / ecount
+            recall = n_matches / tcount
+            return {
+                "precision": precision,
+                "recall": recall,
+                "f1": 2 * precision * recall / (precision + recall),
+                "n_galaxies_detected": n_matches_gal,
+                "n_matches": n_matches,
+                "class_acc": (conf_matrix["gal_gal"] + conf_matrix["star_star"]) / n_matches,
+                "galaxy_acc": conf_matrix["gal_gal"] / n_matches_gal,
+                "star_acc": conf_matrix["star_star"] / n_matches_star,
+                **{f"conf_matrix_{k}": v for k, v in conf_matrix.items()},
+                "tgcount": tgcount,
+                "tscount": tcount - tgcount,
+                "egcount": egcount,
+                "escount": ecount - egcount,
+                "n_matches_coadd_gal": n_matches_gal,
+                "n_matches_coadd_star": n_matches_star,
+            }
+
+    def _assign(self, keep: np.ndarray, slack: float) -> Tuple[np.ndarray, np.ndarray]:
+        return _assign_pairs(self.pair_rows[keep], self.pair_cols[keep], self.pair_err[keep], slack)
+
+
 class CoaddFullCatalog(FullCatalog):
     coadd_names = {
         "objid": "objid",
@@ -544,6 +858,9 @@ def get_single_galaxy_measurements(
     recon_images: np.ndarray,
     psf_image: np.ndarray,
     pixel_scale: float = 0.396,
+    method: str = "ksb",
+    n_workers: int = 0,
+    batch_size: int = 1000,
 ):
     """Compute individual galaxy measurements comparing true images with reconstructed images.
 
@@ -556,14 +873,22 @@ def get_single_galaxy_measurements(
             reconstructions of `true_images` without noise or background.
         psf_image: Array of shape (n_bands, slen, slen) containing PSF image used for
             convolving the galaxies in `true_images`.
+        method: If "ksb" (default), each galaxy is measured with GalSim (`calculateHLR` and the
+            KSB method of `galsim.hsm.EstimateShear`). If "adaptive", half-light radii and
+            ellipticities are computed for batches of galaxies at once with
+            `get_half_light_radius` and `get_corrected_ellipticity`. Ellipticities are then NaN
+            for galaxies that are not resolved or whose adaptive moments do not converge.
+        n_workers: If positive and `method` is "ksb", galaxies are measured by a pool of this
+            many processes.
+        batch_size: Number of galaxies measured at a time with the "adaptive" method.
 
     Returns:
         Dictionary containing second-moment measurements for `true_images` and `recon_images`.
     """
-    # TODO: Consider multiprocessing? (if necessary)
     assert true_images.shape == recon_images.shape
     assert len(true_images.shape) == len(recon_images.shape) == 4, "Incorrect array format."
     assert true_images.shape[1] == recon_images.shape[1] == psf_image.shape[0] == 1  # one band
+    assert method in {"adaptive", "ksb"}
     n_samples = true_images.shape[0]
     true_images = true_images.reshape(-1, slen, slen)
     recon_images = recon_images.reshape(-1, slen, slen)
@@ -572,45 +897,203 @@ def get_single_galaxy_measurements(
     true_fluxes = true_images.sum(axis=(1, 2))
     recon_fluxes = recon_images.sum(axis=(1, 2))
 
-    true_hlrs = np.zeros((n_samples))
-    recon_hlrs = np.zeros((n_samples))
-    true_ellip = np.zeros((n_samples, 2))  # 2nd shape: e1, e2
-    recon_ellip = np.zeros((n_samples, 2))
+    # measure true and reconstructed galaxies together.
+    images = np.concatenate((true_images, recon_images))
+    if method == "adaptive":
+        psf = torch.from_numpy(psf_image)
+        measurements = []
+        for batch in torch.split(torch.from_numpy(images), batch_size):
+            batch_hlrs = get_half_light_radius(batch, pixel_scale).unsqueeze(-1)
+            batch_ellips = get_corrected_ellipticity(batch, psf)
+            measurements.append(torch.cat((batch_hlrs, batch_ellips), dim=-1).numpy())
+    elif n_workers > 0:
+        chunks = np.array_split(images, n_workers * 4)
+        with ProcessPoolExecutor(n_workers) as executor:
+            measure = partial(_get_galsim_measurements, psf_image=psf_image, scale=pixel_scale)
+            measurements = list(executor.map(measure, chunks))
+    else:
+        measurements = [_get_galsim_measurements(images, psf_image, pixel_scale)]
+    measured = np.concatenate(measurements)
+    hlrs, ellips = measured[:, 0], measured[:, 1:]
 
-    # get galsim PSF
-    galsim_psf_image = galsim.Image(psf_image, scale=pixel_scale)
+    return {
+        "true_fluxes": true_fluxes,
+        "recon_fluxes": recon_fluxes,
+        "true_ellip": ellips[:n_samples],
+        "recon_ellip": ellips[n_samples:],
+        "true_hlrs": hlrs[:n_samples],
+        "recon_hlrs": hlrs[n_samples:],
+        "true_mags": convert_flux_to_mag(true_fluxes),
+        "recon_mags": convert_flux_to_mag(recon_fluxes),
+    }
 
-    # Now we use galsim to measure size and ellipticity
-    for i in tqdm.tqdm(range(n_samples), desc="Measuring galaxies"):
-        true_image = true_images[i]
-        recon_image = recon_images[i]
 
-        galsim_true_image = galsim.Image(true_image, scale=pixel_scale)
-        galsim_recon_image = galsim.Image(recon_image, scale=pixel_scale)
+def _get_galsim_measurements(images: np.ndarray, psf_image: np.ndarray, scale: float):
+    """Half-light radius (PSF-convolved) and KSB shear (g1, g2) of each image with GalSim."""
+    galsim_psf_image = galsim.Image(psf_image, scale=scale)
+    measurements = np.zeros((len(images), 3))
+    for i, image in enumerate(images):
+        galsim_image = galsim.Image(image, scale=scale)
+        res = galsim.hsm.EstimateShear(
+            galsim_image, galsim_psf_image, shear_est="KSB", strict=False
+        )
+        measurements[i] = (galsim_image.calculateHLR(), res.corrected_g1, res.corrected_g2)
+    return measurements
 
-        true_hlrs[i] = galsim_true_image.calculateHLR()  # PSF-convolved.
-        recon_hlrs[i] = galsim_recon_image.calculateHLR()
 
-        res_true = galsim.hsm.EstimateShear(
-            galsim_true_image, galsim_psf_image, shear_est="KSB", strict=False
-        )
-        res_recon = galsim.hsm.EstimateShear(
-            galsim_recon_image, galsim_psf_image, shear_est="KSB", strict=False
+def get_half_light_radius(images: Tensor, pixel_scale: float = 1.0) -> Tensor:
+    """Half-light radius of a batch of images, as in `galsim.Image.calculateHLR`.
+
+    The radius is measured from the center of the images, and the enclosed flux is
+    approximated by the flux of the pixels whose centers are within the radius (with linear
+    interpolation between consecutive pixels).
+
+    Args:
+        images: Tensor of shape `(n x slen x slen)`.
+        pixel_scale: Conversion from pixels to the units of the returned radii.
+
+    Returns:
+        Tensor of shape `(n,)` with the half-light radius of each image.
+    """
+    _, h, w = images.shape
+    dy = torch.arange(h, dtype=torch.double) - (h - 1) / 2
+    dx = torch.arange(w, dtype=torch.double) - (w - 1) / 2
+    rsq = (dy.reshape(-1, 1) ** 2 + dx.reshape(1, -1) ** 2).reshape(-1)
+
+    # same ordering of pixels by radius as galsim.
+    indx = torch.from_numpy(np.argsort(rsq.numpy()))
+    rsq = rsq[indx].to(images.device)
+    data = rearrange(images.double(), "n h w -> n (h w)")[:, indx]
+    cumflux = data.cumsum(1)
+    flux = data.sum(1, keepdim=True)
+
+    # interpolate between first pixel with cumulative flux above half and the previous one.
+    k = torch.argmax((cumflux > 0.5 * flux).byte(), dim=1, keepdim=True)
+    flux_k = cumflux.gather(1, k) / flux
+    flux_km1 = cumflux.gather(1, (k - 1).clamp(min=0)) / flux
+    rsq_k, rsq_km1 = rsq[k], rsq[(k - 1).clamp(min=0)]
+    hlrsq = (rsq_km1 * (flux_k - 0.5) + rsq_k * (0.5 - flux_km1)) / (flux_k - flux_km1)
+    hlrsq = torch.where(k == 0, rsq[0] * 0.5 / flux_k, hlrsq)
+    return hlrsq.sqrt().reshape(-1) * pixel_scale
+
+
+def get_adaptive_moments(images: Tensor, max_iter: int = 400, tol: float = 1e-6):
+    """Adaptive second moments of a batch of images (in pixels).
+
+    As in `galsim.hsm.FindAdaptiveMom`, the moments are those of the elliptical Gaussian weight
+    function matched to the image, i.e. such that the weighted centroid of the image is that of the
+    weight and the weighted covariance of the image is half that of the weight. They are found by
+    iterating the update that would be exact for a Gaussian image (falling back to the usual
+    fixed-point update when it is not well-defined). Each iteration only takes two matrix products
+    with the images of the batch that have not converged.
+
+    Args:
+        images: Tensor of shape `(n x slen x slen)`.
+        max_iter: Maximum number of iterations.
+        tol: An image has converged once its moments and centroid change by less than `tol`.
+
+    Returns:
+        A tuple of two tensors:
+        - centroids: Tensor of shape `(n x 2)` with the (x, y) centroid of each image relative to
+            the center of the image.
+        - moments: Tensor of shape `(n x 3)` with the moments (Mxx, Myy, Mxy) of each image.
+            They are NaN for images where the iteration did not converge.
+    """
+    n, h, w = images.shape
+    flat_images = rearrange(images.double(), "n h w -> n (h w)")
+    y = torch.arange(h, dtype=torch.double, device=images.device) - (h - 1) / 2
+    x = torch.arange(w, dtype=torch.double, device=images.device) - (w - 1) / 2
+    y, x = y.reshape(-1, 1).expand(h, w).reshape(-1), x.reshape(1, -1).expand(h, w).reshape(-1)
+    # weighted sums of (1, x, y, x^2, y^2, xy) and quadratic forms are products with this basis.
+    basis = torch.stack((torch.ones_like(x), x, y, x * x, y * y, x * y))
+
+    # same initial guess as galsim (circular weight with 5 pixel standard deviation).
+    centroids = flat_images.new_zeros(n, 2)
+    covs = 25.0 * torch.eye(2, dtype=torch.double, device=images.device).repeat(n, 1, 1)
+    converged = torch.zeros(n, dtype=torch.bool, device=images.device)
+    for _ in range(max_iter):
+        indx = torch.nonzero(~converged).reshape(-1)
+        cov, centroid = covs[indx], centroids[indx]
+        inv_cov = _inv_2x2(cov)
+        ixx, iyy, ixy = inv_cov[:, 0, 0], inv_cov[:, 1, 1], inv_cov[:, 0, 1]
+        cx, cy = centroid[:, 0], centroid[:, 1]
+        rho2_coeffs = torch.stack(
+            (
+                ixx * cx**2 + iyy * cy**2 + 2 * ixy * cx * cy,
+                -2 * (ixx * cx + ixy * cy),
+                -2 * (iyy * cy + ixy * cx),
+                ixx,
+                iyy,
+                2 * ixy,
+            ),
+            dim=1,
         )
+        weighted = (rho2_coeffs @ basis).mul_(-0.5).exp_().mul_(flat_images[indx])
+        sums = weighted @ basis.T
+        sums = sums[:, 1:] / sums[:, :1]
+        mean = sums[:, :2]
+        cxx = sums[:, 2] - mean[:, 0] ** 2
+        cyy = sums[:, 3] - mean[:, 1] ** 2
+        cxy = sums[:, 4] - mean[:, 0] * mean[:, 1]
+        weighted_cov = torch.stack((cxx, cxy, cxy, cyy), dim=1).reshape(-1, 2, 2)
+
+        # a Gaussian image with covariance `new_cov` would have this weighted covariance.
+        inv_weighted_cov = _inv_2x2(weighted_cov)
+        inv_new_cov = inv_weighted_cov - inv_cov
+        is_exact = (inv_new_cov[:, 0, 0] > 0) & (_det_2x2(inv_new_cov) > 0)
+        new_cov = _inv_2x2(torch.where(is_exact[:, None, None], inv_new_cov, inv_cov))
+        new_centroid = inv_weighted_cov @ mean.unsqueeze(-1) - inv_cov @ centroid.unsqueeze(-1)
+        new_centroid = (new_cov @ new_centroid).squeeze(-1)
+        new_cov = torch.where(is_exact[:, None, None], new_cov, 2 * weighted_cov)
+        new_centroid = torch.where(is_exact[:, None], new_centroid, 2 * mean - centroid)
+
+        change = torch.cat(((new_cov - cov).reshape(-1, 4), new_centroid - centroid), dim=1)
+        covs[indx], centroids[indx] = new_cov, new_centroid
+        converged[indx] = change.abs().max(1)[0] < tol
+        if converged.all():
+            break
+
+    moments = torch.stack((covs[:, 0, 0], covs[:, 1, 1], covs[:, 0, 1]), dim=1)
+    moments[~converged] = np.nan
+    return centroids, moments
+
+
+def _det_2x2(m: Tensor) -> Tensor:
+    return m[:, 0, 0] * m[:, 1, 1] - m[:, 0, 1] * m[:, 1, 0]
+
+
+def _inv_2x2(m: Tensor) -> Tensor:
+    """Inverse of a batch of 2x2 matrices (NaN or infinite where singular, without raising)."""
+    adj = torch.stack((m[:, 1, 1], -m[:, 0, 1], -m[:, 1, 0], m[:, 0, 0]), dim=1).reshape(-1, 2, 2)
+    return adj / _det_2x2(m)[:, None, None]
+
+
+def get_corrected_ellipticity(images: Tensor, psf_image: Tensor) -> Tensor:
+    """PSF-corrected ellipticity (reduced shear) of a batch of images from adaptive moments.
+
+    The adaptive moments of the PSF are subtracted from those of each image, which exactly
+    removes the PSF for Gaussian profiles. The reduced shear (g1, g2) is that of an elliptical
+    profile with the corrected moments, which can be compared with the output of
+    `galsim.hsm.EstimateShear` (e.g. `corrected_g1` and `corrected_g2` of KSB).
 
-        true_ellip[i, :] = (res_true.corrected_g1, res_true.corrected_g2)
-        recon_ellip[i, :] = (res_recon.corrected_g1, res_recon.corrected_g2)
+    Args:
+        images: Tensor of shape `(n x slen x slen)`.
+        psf_image: Tensor of shape `(slen x slen)` with the PSF convolving the images.
 
-    return {
-        "true_fluxes": true_fluxes,
-        "recon_fluxes": recon_fluxes,
-        "true_ellip": true_ellip,
-        "recon_ellip": recon_ellip,
-        "true_hlrs": true_hlrs,
-        "recon_hlrs": recon_hlrs,
-        "true_mags": convert_flux_to_mag(true_fluxes),
-        "recon_mags": convert_flux_to_mag(recon_fluxes),
-    }
+    Returns:
+        Tensor of shape `(n x 2)` with (g1, g2) for each image. It is NaN for images whose
+        moments could not be measured or are smaller than those of the PSF.
+    """
+    _, moments = get_adaptive_moments(images)
+    _, psf_moments = get_adaptive_moments(psf_image.unsqueeze(0))
+    mxx, myy, mxy = (moments - psf_moments).unbind(1)
+    is_resolved = (mxx > 0) & (myy > 0) & (mxx * myy > mxy**2)
+    e1 = (mxx - myy) / (mxx + myy)
+    e2 = 2 * mxy / (mxx + myy)
+    e = torch.stack((e1, e2), dim=1)
+    esq = e1**2 + e2**2
+    g = e / (1 + torch.sqrt((1 - esq).clamp(min=0))).unsqueeze(-1)
+    return torch.where(is_resolved.unsqueeze(-1), g, torch.full_like(g, np.nan))
 
 
 def plot_image(
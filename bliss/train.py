@@ -2,7 +2,7 @@ import datetime as dt
 import json
 from pathlib import Path
 from time import time_ns
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 
 import pytorch_lightning as pl
 import torch
@@ -13,6 +13,8 @@ from pytorch_lightning.loggers import TensorBoardLogger
 from pytorch_lightning.profiler import AdvancedProfiler
 from pytorch_lightning.utilities import rank_zero_only
 
+from bliss.datasets.simulated import PrefetchStatsLogger, SimulatedDataset
+
 
 def train(cfg: DictConfig):
 
@@ -39,7 +41,11 @@ def train(cfg: DictConfig):
     checkpoint_callback = setup_callbacks(cfg)
     profiler = setup_profiler(cfg)
 
-    callbacks = [] if checkpoint_callback is None else [checkpoint_callback]
+    callbacks: List[pl.Callback] = [] if checkpoint_callback is None else [checkpoint_callback]
+    # prefetch statistics are only gathered in the main process (see `PrefetchStats`).
+    if isinstance(dataset, SimulatedDataset) and dataset.n_producers > 0:
+        if dataset.num_workers == 0:
+            callbacks.append(PrefetchStatsLogger())
 
     trainer = instantiate(
         cfg.training.trainer, logger=logger, profiler=profiler, callbacks=callbacks
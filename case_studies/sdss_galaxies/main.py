@@ -18,9 +18,12 @@ def main(cfg):
     if cfg.mode == "train":
         train(cfg)
     elif cfg.mode == "generate":
-        filepath = cfg.generate.file + ".pt"
+        shard_size = cfg.generate.get("shard_size")
+        filepath = cfg.generate.file if shard_size else cfg.generate.file + ".pt"
         imagepath = cfg.generate.file + ".png"
-        generate(cfg.generate.dataset, filepath, imagepath, cfg.generate.n_plots)
+        generate(
+            cfg.generate.dataset, filepath, imagepath, cfg.generate.n_plots, shard_size=shard_size
+        )
     else:
         raise KeyError
 
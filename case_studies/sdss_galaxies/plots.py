@@ -2,7 +2,6 @@
 """Produce all figures. Save to PNG format."""
 import warnings
 from abc import abstractmethod
-from collections import defaultdict
 from pathlib import Path
 from typing import Union
 
@@ -442,25 +441,6 @@ class AEReconstructionFigures(BlissFigures):
 class DetectionClassificationFigures(BlissFigures):
     cache = "detect_class.pt"
 
-    @staticmethod
-    def compute_mag_bin_metrics(mag_bins: np.ndarray, truth: FullCatalog, pred: FullCatalog):
-        metrics_per_mag = defaultdict(lambda: np.zeros(len(mag_bins)))
-
-        # compute data for precision/recall/classification accuracy as a function of magnitude.
-        for ii, (mag1, mag2) in enumerate(mag_bins):
-            res = reporting.scene_metrics(truth, pred, mag_min=mag1, mag_max=mag2, slack=1.0)
-            metrics_per_mag["precision"][ii] = res["precision"].item()
-            metrics_per_mag["recall"][ii] = res["recall"].item()
-            metrics_per_mag["f1"][ii] = res["f1"].item()
-            metrics_per_mag["class_acc"][ii] = res["class_acc"].item()
-            conf_matrix = res["conf_matrix"]
-            metrics_per_mag["galaxy_acc"][ii] = conf_matrix[0, 0] / conf_matrix[0, :].sum().item()
-            metrics_per_mag["star_acc"][ii] = conf_matrix[1, 1] / conf_matrix[1, :].sum().item()
-            for k, v in res["counts"].items():
-                metrics_per_mag[k][ii] = v
-
-        return dict(metrics_per_mag)
-
     def compute_metrics(self, truth: FullCatalog, pred: FullCatalog):
 
         # prepare magnitude bins
@@ -472,25 +452,24 @@ class DetectionClassificationFigures(BlissFigures):
         mag_bins1 = mag_bins2 - 1
         mag_bins = np.column_stack((mag_bins1, mag_bins2))
 
-        # compute metrics
-        cuts_data = self.compute_mag_bin_metrics(mag_cuts, truth, pred)
-        bins_data = self.compute_mag_bin_metrics(mag_bins, truth, pred)
+        # compute metrics for all magnitude cuts and bins from a single matching.
+        scene_match = reporting.SceneMatch(truth, pred, slack=1.0)
+        cuts_data = {k: v[0] for k, v in scene_match.compute(mag_cuts).items()}
+        bins_data = {k: v[0] for k, v in scene_match.compute(mag_bins).items()}
 
         # data for scatter plot of misclassifications (over all magnitudes).
-        tplocs = truth.plocs.reshape(-1, 2)
-        eplocs = pred.plocs.reshape(-1, 2)
-        tindx, eindx, dkeep, _ = reporting.match_by_locs(tplocs, eplocs, slack=1.0)
+        tindx, eindx = scene_match.row_indx, scene_match.col_indx
 
         # compute egprob separately for PHOTO
-        egbool = pred["galaxy_bools"].reshape(-1)[eindx][dkeep]
+        egbool = pred["galaxy_bools"].reshape(-1)[eindx]
         egprob = pred.get("galaxy_probs", None)
-        egprob = egbool if egprob is None else egprob.reshape(-1)[eindx][dkeep]
+        egprob = egbool if egprob is None else egprob.reshape(-1)[eindx]
         full_metrics = {
-            "tgbool": truth["galaxy_bools"].reshape(-1)[tindx][dkeep],
+            "tgbool": truth["galaxy_bools"].reshape(-1)[tindx],
             "egbool": egbool,
             "egprob": egprob,
-            "tmag": truth["mags"].reshape(-1)[tindx][dkeep],
-            "emag": pred["mags"].reshape(-1)[eindx][dkeep],
+            "tmag": truth["mags"].reshape(-1)[tindx],
+            "emag": pred["mags"].reshape(-1)[eindx],
         }
 
         return mag_cuts2, mag_bins2, cuts_data, bins_data, full_metrics
@@ -8,12 +8,9 @@ import pandas as pd
 import torch
 from einops import rearrange, repeat
 from hydra.utils import instantiate
-from joblib import Parallel, delayed
 from matplotlib import pyplot as plt
-from torch import Tensor
 from torch.distributions import Normal, Poisson
 from torch.types import Number
-from tqdm import tqdm
 
 from bliss import reporting
 from bliss.catalog import FullCatalog, TileCatalog
@@ -72,6 +69,7 @@ def reconstruct(cfg):
         wlims,
         slen=cfg.reconstruct.slen,
         device=device,
+        cache_dist_params=True,
     )
     tile_map_recon["galaxy_blends"] = infer_blends(tile_map_recon, 2)
     print(f"{(tile_map_recon['galaxy_blends'] > 1).sum()} galaxies are part of blends in image.")
@@ -100,22 +98,7 @@ def reconstruct(cfg):
             loc_slack=1.0,
         )
 
-    encoder_lower_threshold = Encoder(
-        encoder.location_encoder,
-        encoder.binary_encoder,
-        encoder.galaxy_encoder,
-        map_n_source_weights=cfg.reconstruct.map_n_source_weights,
-    ).to(encoder.device)
-    _, tile_map_lower_threshold = reconstruct_scene_at_coordinates(
-        encoder_lower_threshold,
-        dec,
-        frame.image,
-        frame.background,
-        hlims,
-        wlims,
-        slen=cfg.reconstruct.slen,
-        device=device,
-    )
+    tile_map_lower_threshold = encoder.rethreshold(cfg.reconstruct.map_n_source_weights)
     positive_negative_stats = get_positive_negative_stats(
         ground_truth_catalog, tile_map_lower_threshold, mag_max=cfg.reconstruct.mag_max
     )
@@ -614,20 +597,6 @@ def expected_precision_for_threshold(tile_map: TileCatalog, threshold: float):
     return precision.item()
 
 
-def expected_positives_and_negatives(tile_map: TileCatalog, threshold: float) -> Dict[str, float]:
-    prob_on: Tensor = rearrange(
-        tile_map["n_source_log_probs"], "n nth ntw 1 1 -> (n nth ntw)"
-    ).exp()
-    is_on_array = prob_on >= threshold
-    prob_detected = prob_on[is_on_array]
-    prob_not_detected = prob_on[~is_on_array]
-    tp = float(prob_detected.sum().item())
-    fp = float((1 - prob_detected).sum().item()) if is_on_array.sum() > 0 else 0.0
-    tn = float((1 - prob_not_detected).sum().item()) if (~is_on_array).sum() > 0 else 0.0
-    fn = float(prob_not_detected.sum().item())
-    return {"tp": tp, "fp": fp, "tn": tn, "fn": fn, "n_selected": float(is_on_array.sum())}
-
-
 def expected_positives_plot(
     tile_map: TileCatalog, actual_results: Dict, map_n_source_weights: Tuple[float, float]
 ):
@@ -635,14 +604,7 @@ def expected_positives_plot(
     figsize = (4 * base_size, 2 * base_size)
     fig, axes = plt.subplots(nrows=4, ncols=2, figsize=figsize)
     thresholds = np.linspace(0.01, 0.99, 99)
-    expected_results_lists = defaultdict(list)
-    for threshold in thresholds:
-        res_at_threshold = expected_positives_and_negatives(tile_map, threshold)
-        for measure, value_at_threshold in res_at_threshold.items():
-            expected_results_lists[measure].append(value_at_threshold)
-    expected_results: Dict[str, np.ndarray] = {}
-    for measure, values in expected_results_lists.items():
-        expected_results[measure] = np.array(values)
+    expected_results = reporting.get_expected_detection_stats_by_threshold(tile_map, thresholds)
     min_viable_threshold = map_n_source_weights[0] / (
         map_n_source_weights[0] + map_n_source_weights[1]
     )
@@ -780,39 +742,7 @@ def get_positive_negative_stats(
 ):
     true_cat = true_cat.apply_mag_bin(-np.inf, mag_max)
     thresholds = np.linspace(0.01, 0.99, 99)
-    log_probs = rearrange(est_tile_cat["n_source_log_probs"], "n nth ntw 1 1 -> n nth ntw")
-    est_tile_cat = est_tile_cat.copy()
-
-    res = Parallel(n_jobs=10)(
-        delayed(stats_for_threshold)(true_cat.plocs, est_tile_cat, t, log_probs)
-        for t in tqdm(thresholds)
-    )
-    out: Dict[str, Union[int, Tensor]] = {}
-    for k in res[0]:
-        out[k] = torch.stack([r[k] for r in res])
-    out["n_obj"] = true_cat.plocs.shape[1]
-    return out
-
-
-def stats_for_threshold(
-    true_plocs: Tensor, est_tile_cat: TileCatalog, threshold: float, log_probs: Tensor
-):
-    est_tile_cat.n_sources = log_probs >= np.log(threshold)
-    est_cat = est_tile_cat.to_full_params()
-    number_true = true_plocs.shape[1]
-    number_est = est_cat.plocs.shape[1]
-    true_matches = torch.zeros(true_plocs.shape[1], dtype=torch.bool)
-    if number_true == 0 or number_est == 0:
-        return {
-            "tp": torch.tensor(0.0),
-            "fp": torch.tensor(float(number_est)),
-            "true_matches": true_matches,
-        }
-    row_indx, col_indx, d, _ = reporting.match_by_locs(true_plocs[0], est_cat.plocs[0], 1.0)
-    true_matches[row_indx] = d
-    tp = d.sum()
-    fp = number_est - tp
-    return {"tp": tp, "fp": fp, "true_matches": true_matches}
+    return reporting.get_detection_stats_by_threshold(true_cat, est_tile_cat, thresholds)
 
 
 if __name__ == "__main__":
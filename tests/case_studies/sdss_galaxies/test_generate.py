@@ -1,8 +1,12 @@
+import pickle
 from pathlib import Path
 
+import torch
 from hydra.utils import instantiate
+from torch.utils.data import DataLoader
 
 from bliss import generate
+from bliss.datasets.simulated import ShardedBlissDataset
 
 
 class TestGenerate:
@@ -19,3 +23,51 @@ class TestGenerate:
         )
         filepath.unlink()
         imagepath.unlink()
+
+
+class _BatchList:
+    def __init__(self, batches):
+        self.batches = batches
+
+    def train_dataloader(self):
+        return self.batches
+
+
+def test_generate_sharded(tmp_path):
+    batches = []
+    for _ in range(5):
+        batches.append(
+            {
+                "images": torch.randn(3, 1, 8, 8),
+                "n_sources": torch.randint(0, 2, (3, 2, 2)),
+                "background": torch.ones(3, 1, 8, 8),
+            }
+        )
+    dataset = _BatchList(batches)
+    dirpath = tmp_path / "sharded"
+    generate.generate(
+        dataset, tmp_path / "single.pt", tmp_path / "single.png", n_plots=4, shard_size=None
+    )
+    generate.generate(
+        dataset,
+        dirpath,
+        tmp_path / "sharded.png",
+        n_plots=4,
+        global_params=("background",),
+        shard_size=4,
+    )
+
+    sharded = ShardedBlissDataset(dirpath)
+    assert len(sharded) == 15
+    assert len(list(dirpath.glob("shard-*-images.npy"))) == 4
+    expected = torch.load(tmp_path / "single.pt")
+    for i in (0, 3, 4, 14, -1):
+        item = sharded[i]
+        assert torch.equal(item["images"], expected["images"][i])
+        assert torch.equal(item["n_sources"], expected["n_sources"][i])
+        assert torch.equal(item["background"], expected["background"])
+
+    # workers receive a pickled dataset without the memory maps.
+    loader = DataLoader(pickle.loads(pickle.dumps(sharded)), batch_size=4)
+    images = torch.cat([batch["images"] for batch in loader])
+    assert torch.equal(images, expected["images"])
@@ -1,6 +1,7 @@
 from pathlib import Path
 
 import galsim
+import numpy as np
 import torch
 from astropy.table import Table
 
@@ -79,3 +80,24 @@ def test_measurements():
     image = gal_conv.drawImage(nx=slen, ny=slen, scale=pixel_scale).array.reshape(1, 1, slen, slen)
 
     reporting.get_single_galaxy_measurements(slen, image, image, psf_image, pixel_scale)
+
+    # batched measurements agree with galsim on sheared gaussian galaxies.
+    shears = ((0.0, 0.0), (0.2, -0.1), (-0.3, 0.25), (0.05, 0.4))
+    images = np.stack(
+        [
+            galsim.Convolution(gal.shear(g1=g1, g2=g2), psf)
+            .drawImage(nx=slen, ny=slen, scale=pixel_scale)
+            .array.reshape(1, slen, slen)
+            for g1, g2 in shears
+        ]
+    )
+    measurements = reporting.get_single_galaxy_measurements(
+        slen, images, images, psf_image, pixel_scale, method="adaptive"
+    )
+    ksb_measurements = reporting.get_single_galaxy_measurements(
+        slen, images, images, psf_image, pixel_scale, method="ksb", n_workers=2
+    )
+    assert np.allclose(measurements["true_hlrs"], ksb_measurements["true_hlrs"])
+    assert np.allclose(measurements["true_ellip"], shears, atol=1e-3)
+    # KSB is biased for large shears.
+    assert np.allclose(measurements["true_ellip"], ksb_measurements["true_ellip"], atol=0.1)
@@ -1,7 +1,18 @@
+from pathlib import Path
+
 import numpy as np
 import pytest
+import torch
+from astropy.io import fits
+from astropy.wcs import WCS
+from scipy.interpolate import RegularGridInterpolator
 
-from bliss.datasets.sdss import SloanDigitalSkySurvey
+from bliss.datasets.sdss import (
+    PhotoFullCatalog,
+    SloanDigitalSkySurvey,
+    expand_sky,
+    read_frame_metadata,
+)
 
 
 class TestSDSS:
@@ -31,3 +42,125 @@ class TestSDSS:
             bands=range(5),
         )
         assert (len(sdss_obj9)) == 2
+
+
+def write_sdss_field(sdss_dir: Path, run: int, camcol: int, field: int, h=30, w=40):
+    """Writes a photoField file and small random frames (in all bands) of an SDSS field."""
+    camcol_dir = sdss_dir / str(run) / str(camcol)
+    field_dir = camcol_dir / str(field)
+    field_dir.mkdir(parents=True)
+    columns = [
+        fits.Column(name="FIELD", format="J", array=np.array([field])),
+        fits.Column(name="GAIN", format="5E", array=np.array([[4.5, 4.6, 4.7, 4.76, 4.8]])),
+    ]
+    pf_hdu = fits.BinTableHDU.from_columns(columns)
+    pf_hdu.writeto(camcol_dir / f"photoField-{run:06d}-{camcol:d}.fits")
+
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    wcs.wcs.crval = [10.0, 20.0]
+    wcs.wcs.crpix = [w / 2, h / 2]
+    wcs.wcs.cdelt = [-1e-4, 1e-4]
+    rng = np.random.default_rng(field)
+    for bl in "ugriz":
+        sky_small = rng.uniform(0.1, 0.2, size=(4, 5)).astype(np.float32)
+        sky_x = np.linspace(-0.5, 5.5, w, dtype=np.float32)
+        sky_y = np.linspace(-0.5, 4.5, h, dtype=np.float32)
+        columns = [
+            fits.Column(name="ALLSKY", format="20E", dim="(5,4)", array=sky_small[None]),
+            fits.Column(name="XINTERP", format=f"{w}E", array=sky_x[None]),
+            fits.Column(name="YINTERP", format=f"{h}E", array=sky_y[None]),
+        ]
+        hdus = [
+            fits.PrimaryHDU(rng.normal(size=(h, w)).astype(np.float32), header=wcs.to_header()),
+            fits.ImageHDU(rng.uniform(0.004, 0.006, size=w).astype(np.float32)),
+            fits.BinTableHDU.from_columns(columns),
+        ]
+        frame_path = field_dir / f"frame-{bl}-{run:06d}-{camcol:d}-{field:04d}.fits"
+        fits.HDUList(hdus).writeto(frame_path)
+
+
+def test_sdss_frame_cache(tmp_path, monkeypatch):
+    # the default cache directory (when caching is enabled) is in the user's cache directory.
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "user_cache"))
+    cache_dir = tmp_path / "user_cache" / "bliss" / "sdss"
+    sdss_dir = tmp_path / "sdss"
+    write_sdss_field(sdss_dir, run=94, camcol=1, field=12)
+    SloanDigitalSkySurvey(sdss_dir, 94, 1, (12,), bands=(2, 3))[0]
+    assert not cache_dir.exists(), "frames are only cached on request."
+    frames = []
+    for use_cache in (False, True, True):
+        sdss = SloanDigitalSkySurvey(sdss_dir, 94, 1, (12,), bands=(2, 3), use_cache=use_cache)
+        frames.append(sdss[0])
+    for frame in frames[1:]:
+        for k in ("image", "background", "gain", "nelec_per_nmgy_list", "calibration"):
+            assert np.array_equal(frame[k], frames[0][k])
+            assert frame[k].dtype == frames[0][k].dtype
+        for wcs, expected_wcs in zip(frame["wcs"], frames[0]["wcs"]):
+            assert np.allclose(
+                wcs.wcs_pix2world(3.0, 4.0, 0), expected_wcs.wcs_pix2world(3.0, 4.0, 0)
+            )
+    assert (cache_dir / "94" / "1" / "12" / "frame-r-000094-1-0012" / "meta.json").exists()
+    assert not (sdss_dir / "cache").exists()
+
+    # single bands are memory-mapped from the cache (and can be modified without changing it).
+    image = SloanDigitalSkySurvey(sdss_dir, 94, 1, (12,), bands=(2,), use_cache=True)[0]["image"]
+    assert isinstance(image.base, np.memmap)
+    image[:] = 0
+    assert np.array_equal(
+        SloanDigitalSkySurvey(sdss_dir, 94, 1, (12,), bands=(2,), use_cache=True)[0]["image"][0],
+        frames[0]["image"][0],
+    )
+
+    # the cache entry is rebuilt when the frame changes.
+    frame_path = sdss_dir / "94" / "1" / "12" / "frame-r-000094-1-0012.fits"
+    with fits.open(frame_path, mode="update") as hdus:
+        hdus[0].data *= 2
+    image = SloanDigitalSkySurvey(sdss_dir, 94, 1, (12,), bands=(2,), use_cache=True)[0]["image"]
+    assert not np.array_equal(image[0], frames[0]["image"][0])
+    assert np.array_equal(
+        image, SloanDigitalSkySurvey(sdss_dir, 94, 1, (12,), bands=(2,), use_cache=True)[0]["image"]
+    )
+
+
+def test_expand_sky():
+    rng = np.random.default_rng(0)
+    sky_small = rng.uniform(size=(12, 16)).astype(">f4")
+    sky_y = np.linspace(-1.0, 12.0, 97).astype(">f4")
+    sky_x = np.linspace(-0.5, 15.5, 129).astype(">f4")
+    small_rcs = (np.arange(12), np.arange(16))
+    points = np.stack(np.meshgrid(sky_y.clip(0, 11), sky_x.clip(0, 15), indexing="ij"), axis=-1)
+    for method in ("nearest", "linear"):
+        expected = RegularGridInterpolator(small_rcs, sky_small, method=method)(points)
+        assert np.allclose(expand_sky(sky_small, sky_y, sky_x, method), expected)
+
+
+def test_photo_catalog_from_header(tmp_path):
+    sdss_dir = tmp_path / "sdss"
+    write_sdss_field(sdss_dir, run=94, camcol=1, field=12)
+    metadata = read_frame_metadata(sdss_dir, 94, 1, 12, band=2)
+    frame = SloanDigitalSkySurvey(sdss_dir, 94, 1, (12,), bands=(2,), use_cache=False)[0]
+    assert (metadata["height"], metadata["width"]) == frame["image"].shape[1:]
+    assert metadata["wcs"].to_header_string() == frame["wcs"][0].to_header_string()
+
+    n_objects = 20
+    rng = np.random.default_rng(0)
+    ras, decs = metadata["wcs"].wcs_pix2world(rng.uniform(0, 40, 20), rng.uniform(0, 30, 20), 0)
+    columns = [
+        fits.Column(name="objc_type", format="J", array=rng.choice([3, 6, 0], n_objects)),
+        fits.Column(name="thing_id", format="J", array=rng.choice([-1, 1], n_objects)),
+        fits.Column(name="ra", format="D", array=ras),
+        fits.Column(name="dec", format="D", array=decs),
+    ]
+    for name in ("psfflux", "psfmag", "cmodelflux", "cmodelmag"):
+        columns.append(fits.Column(name=name, format="5E", array=rng.uniform(size=(n_objects, 5))))
+    po_path = sdss_dir / "94" / "1" / "12" / "photoObj-000094-1-0012.fits"
+    fits.BinTableHDU.from_columns(columns).writeto(po_path)
+
+    catalog = PhotoFullCatalog.from_file(sdss_dir, 94, 1, 12, band=2)
+    keep = np.isin(columns[0].array, (3, 6)) & (columns[1].array != -1)
+    assert catalog.n_sources.item() == keep.sum() > 0
+    for ra, dec, ploc in zip(ras[keep], decs[keep], catalog.plocs[0]):
+        pt, pr = frame["wcs"][0].wcs_world2pix(np.float32(ra), np.float32(dec), 0)
+        assert torch.allclose(ploc, torch.tensor([float(pr), float(pt)]) + 0.5)
+    assert (catalog.height, catalog.width) == (30, 40)
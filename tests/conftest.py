@@ -1,6 +1,7 @@
 # pylint: skip-file
 from pathlib import Path
 
+import numpy as np
 import pytest
 import pytorch_lightning as pl
 import torch
@@ -98,3 +99,12 @@ def model_setup(devices):
 @pytest.fixture(scope="session")
 def get_config():
     return get_cfg
+
+
+@pytest.fixture(scope="session")
+def psf_params_file(tmp_path_factory):
+    # PSF parameters of two bands; `StarTileDecoder` uses the first `n_bands` of them.
+    psf_params = torch.tensor([[1.5, 4.0, 3.0, 3.0, 0.1, 0.05], [2.0, 5.0, 3.0, 3.0, 0.2, 0.1]])
+    psf_params_file = tmp_path_factory.mktemp("psf") / "psf_params.npy"
+    np.save(psf_params_file, psf_params.log().numpy())
+    return str(psf_params_file)
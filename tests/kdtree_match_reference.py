@@ -0,0 +1,42 @@
+"""Previous per-point loop of `bliss.reporting.kdtree_match`, used as a reference.
+
+Shared by `tests/test_metrics.py` and `benchmarks/kdtree_match.py`.
+"""
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+
+def find_match_loop(idx, mdic):
+    # previous recursive conflict resolution of the radius search.
+    if len(idx) > 0:
+        dic_key = idx[0][1]
+        if mdic[dic_key] is None:
+            mdic[dic_key] = idx
+        elif idx[0][0] >= mdic[dic_key][0][0]:
+            del idx[0]
+            mdic = find_match_loop(idx, mdic)
+        else:
+            new_idx = mdic[dic_key]
+            mdic[dic_key] = idx
+            del new_idx[0]
+            mdic = find_match_loop(new_idx, mdic)
+    return mdic
+
+
+def kdtree_match_loop(locs1, locs2, slack, method_id):
+    # previous implementation, with one neighbor query per point of `locs2`.
+    mdic = {k: None for k in range(len(locs1))}
+    neigh = NearestNeighbors(algorithm="kd_tree", radius=slack).fit(locs1)
+    for i in range(len(locs2)):
+        if method_id == 0:
+            dist, indx = neigh.radius_neighbors(locs2[i][None, :], sort_results=True)
+            if len(dist[0]) > 0:
+                mdic = find_match_loop(list(zip(dist[0], indx[0], [i] * len(dist[0]))), mdic)
+        else:
+            dist, indx = neigh.kneighbors(locs2[i][None, :], 1)
+            match = (dist[0][0], indx[0][0], i)
+            if match[0] <= slack and (mdic[match[1]] is None or mdic[match[1]][0][0] > match[0]):
+                mdic[match[1]] = [match]
+    row_idx = np.array([k for k, v in mdic.items() if v], dtype="int")
+    col_idx = np.array([mdic[k][0][2] for k in row_idx], dtype="int")
+    return row_idx, col_idx
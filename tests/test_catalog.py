@@ -0,0 +1,141 @@
+import torch
+from einops import rearrange
+from torch.nn import functional as F
+
+from bliss.catalog import (
+    FullCatalog,
+    SparseTileCatalog,
+    TileCatalog,
+    get_images_in_tiles,
+    get_is_on_from_n_sources,
+    get_ptile_batches,
+)
+
+
+def test_get_images_in_tiles():
+    tile_slen, ptile_slen = 4, 12
+    images = torch.randn(3, 2, 30, 34)
+    n_tiles_h = (30 - ptile_slen) // tile_slen + 1
+    n_tiles_w = (34 - ptile_slen) // tile_slen + 1
+
+    unfolded = F.unfold(images, kernel_size=ptile_slen, stride=tile_slen)
+    expected = rearrange(
+        unfolded,
+        "b (c h w) (nth ntw) -> b nth ntw c h w",
+        nth=n_tiles_h,
+        ntw=n_tiles_w,
+        c=2,
+        h=ptile_slen,
+        w=ptile_slen,
+    )
+    image_ptiles = get_images_in_tiles(images, tile_slen, ptile_slen)
+    assert image_ptiles.shape == expected.shape
+    assert torch.equal(image_ptiles, expected)
+    assert image_ptiles.data_ptr() == images.data_ptr()
+
+    flat_ptiles = rearrange(image_ptiles, "b nth ntw c h w -> (b nth ntw) c h w")
+    for batch_size in (1, 7, n_tiles_h * n_tiles_w, 1000):
+        batches = list(get_ptile_batches(images, tile_slen, ptile_slen, batch_size))
+        assert all(len(ptiles) <= batch_size for ptiles in batches)
+        assert torch.equal(torch.cat(batches, dim=0), flat_ptiles)
+
+
+def _to_tile_params_loop(full_catalog, tile_slen, max_sources_per_tile):
+    # reference implementation, one source at a time.
+    n_tiles_h, n_tiles_w = full_catalog.height // tile_slen, full_catalog.width // tile_slen
+    shape = (full_catalog.batch_size, n_tiles_h, n_tiles_w, max_sources_per_tile)
+    tile_params = {"locs": torch.zeros(*shape, 2)}
+    tile_params.update({k: v.new_zeros(*shape, v.shape[-1]) for k, v in full_catalog.items()})
+    tile_n_sources = torch.zeros(shape[:3], dtype=torch.int64)
+    for b in range(full_catalog.batch_size):
+        for idx in range(int(full_catalog.n_sources[b])):
+            ploc = full_catalog.plocs[b, idx]
+            h, w = (ploc // tile_slen).long()
+            source_idx = tile_n_sources[b, h, w]
+            tile_params["locs"][b, h, w, source_idx] = ploc / tile_slen - torch.stack((h, w))
+            for k, v in full_catalog.items():
+                tile_params[k][b, h, w, source_idx] = v[b, idx]
+            tile_n_sources[b, h, w] += 1
+    tile_params["n_sources"] = tile_n_sources
+    return TileCatalog(tile_slen, tile_params)
+
+
+def test_to_tile_params():
+    plocs = torch.rand(3, 40, 2) * torch.tensor([20.0, 28.0])
+    n_sources = torch.tensor([40, 0, 17])
+    is_on_array = (torch.arange(40) < n_sources.unsqueeze(-1)).unsqueeze(-1)
+    full_catalog = FullCatalog(
+        20,
+        28,
+        {
+            "plocs": plocs * is_on_array,
+            "n_sources": n_sources,
+            "fluxes": torch.rand(3, 40, 1) * is_on_array,
+            "galaxy_bools": (torch.rand(3, 40, 1) > 0.5).float() * is_on_array,
+        },
+    )
+    tile_catalog = full_catalog.to_tile_params(4, 6)
+    expected = _to_tile_params_loop(full_catalog, 4, 6)
+    assert torch.equal(tile_catalog.n_sources, expected.n_sources)
+    assert torch.allclose(tile_catalog.locs, expected.locs)
+    for k in ("fluxes", "galaxy_bools"):
+        assert torch.equal(tile_catalog[k], expected[k])
+
+    # parameters keep their dtype.
+    full_catalog["galaxy_indices"] = torch.randint(0, 100, (3, 40, 1)) * is_on_array
+    full_catalog["objid"] = torch.randint(0, 2**40, (3, 40, 1)) * is_on_array
+    full_catalog["fluxes"] = full_catalog["fluxes"].double()
+    tile_catalog = full_catalog.to_tile_params(4, 6)
+    expected = _to_tile_params_loop(full_catalog, 4, 6)
+    for k, v in full_catalog.items():
+        assert tile_catalog[k].dtype == v.dtype
+        assert torch.equal(tile_catalog[k], expected[k])
+
+    single_params = {k: v[:1] for k, v in full_catalog.items()}
+    single_params.update({"plocs": full_catalog.plocs[:1], "n_sources": n_sources[:1]})
+    single_catalog = FullCatalog(20, 28, single_params)
+    assert single_catalog.equals(single_catalog.to_tile_params(4, 6).to_full_params())
+
+
+def test_sparse_tile_catalog():
+    n_sources = torch.randint(0, 3, (2, 5, 7))
+    is_on_array = get_is_on_from_n_sources(n_sources, 2).unsqueeze(-1)
+    tile_catalog = TileCatalog(
+        4,
+        {
+            "n_sources": n_sources,
+            "locs": torch.rand(2, 5, 7, 2, 2) * is_on_array,
+            "fluxes": torch.rand(2, 5, 7, 2, 1) * is_on_array,
+            "galaxy_bools": (torch.rand(2, 5, 7, 2, 1) > 0.5).float() * is_on_array,
+        },
+    )
+    sparse_catalog = SparseTileCatalog.from_tile_catalog(tile_catalog)
+    assert sparse_catalog.n_on == n_sources.sum()
+    assert sparse_catalog.to_tile_catalog().equals(tile_catalog)
+    assert sparse_catalog.to_full_params().n_sources.equal(n_sources.sum((1, 2)))
+    assert (
+        sparse_catalog.crop((1, 4), (2, None))
+        .to_tile_catalog()
+        .equals(tile_catalog.crop((1, 4), (2, None)))
+    )
+
+    full_catalog = sparse_catalog.to_full_params()
+    sparse_from_full = SparseTileCatalog.from_full_catalog(full_catalog, 4, 2)
+    assert sparse_from_full.to_tile_catalog().equals(tile_catalog, atol=1e-6)
+
+    single_catalog = TileCatalog(4, {k: v[:1] for k, v in tile_catalog.to_dict().items()})
+    plocs = torch.rand(30, 2) * torch.tensor([20.0, 28.0])
+    expected = single_catalog.get_tile_params_at_coord(plocs)
+    tile_params = SparseTileCatalog.from_tile_catalog(single_catalog).get_tile_params_at_coord(
+        plocs
+    )
+    for k, v in expected.items():
+        assert torch.equal(tile_params[k], v)
+
+    # values at off-slots (e.g. log-probabilities of larger counts) are dropped.
+    tile_catalog["n_source_log_probs"] = torch.rand(2, 5, 7, 2, 1).log()
+    tile_catalog["fluxes"] = torch.rand(2, 5, 7, 2, 1)
+    round_trip = SparseTileCatalog.from_tile_catalog(tile_catalog).to_tile_catalog()
+    assert round_trip.equals(tile_catalog, exclude=("n_source_log_probs", "fluxes"))
+    for k in ("n_source_log_probs", "fluxes"):
+        assert torch.equal(round_trip[k], tile_catalog[k] * is_on_array)
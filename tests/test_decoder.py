@@ -0,0 +1,139 @@
+import torch
+from einops import rearrange, reduce
+
+from bliss.catalog import TileCatalog, get_is_on_from_n_sources
+from bliss.models.decoder import (
+    ImageDecoder,
+    StarTileDecoder,
+    Tiler,
+    reconstruct_image_from_ptiles,
+)
+from bliss.models.galaxy_net import OneCenteredGalaxyAE
+
+
+def test_tiler_forward():
+    tiler = Tiler(tile_slen=2, ptile_slen=10)
+    locs = torch.rand(6, 4, 2)
+    sources = torch.rand(6, 4, 2, 11, 11)
+
+    expected = torch.zeros(6, 2, 10, 10)
+    for n in range(locs.shape[1]):
+        expected += tiler._render_one_source(locs[:, n], sources[:, n])  # noqa: WPS437
+    assert torch.allclose(tiler(locs, sources), expected, atol=1e-6)
+
+
+def _render_ptiles(decoder: ImageDecoder, tile_catalog: TileCatalog):
+    # reference implementation of `render_images`, which renders every padded tile densely.
+    batch_size, n_tiles_h, n_tiles_w, max_sources, _ = tile_catalog.locs.shape
+    n_sources = rearrange(tile_catalog.n_sources, "b nth ntw -> (b nth ntw)")
+    locs = rearrange(tile_catalog.locs, "b nth ntw s xy -> (b nth ntw) s xy", xy=2)
+    galaxy_bools = rearrange(tile_catalog["galaxy_bools"], "b nth ntw s 1 -> (b nth ntw) s 1")
+    fluxes = rearrange(tile_catalog["fluxes"], "b nth ntw s band -> (b nth ntw) s band")
+    is_on_array = get_is_on_from_n_sources(n_sources, max_sources).unsqueeze(-1)
+    star_bools = (1 - galaxy_bools) * is_on_array
+    img_shape = (
+        batch_size,
+        n_tiles_h,
+        n_tiles_w,
+        decoder.n_bands,
+        decoder.ptile_slen,
+        decoder.ptile_slen,
+    )
+    stars = decoder.star_tile_decoder(locs, fluxes, star_bools)
+    return stars.view(img_shape)
+
+
+def test_render_images(psf_params_file, devices):
+    device = devices.device
+    for border_padding in (2, 4):
+        decoder = ImageDecoder(
+            n_bands=1,
+            tile_slen=2,
+            ptile_slen=10,
+            psf_slen=25,
+            sdss_bands=(2,),
+            psf_params_file=psf_params_file,
+            border_padding=border_padding,
+        ).to(device)
+        n_sources = torch.randint(0, 3, (2, 5, 7), device=device)
+        is_on_array = get_is_on_from_n_sources(n_sources, 2).unsqueeze(-1)
+        tile_catalog = TileCatalog(
+            decoder.tile_slen,
+            {
+                "n_sources": n_sources,
+                "locs": torch.rand(2, 5, 7, 2, 2, device=device) * is_on_array,
+                "galaxy_bools": torch.zeros(2, 5, 7, 2, 1, device=device),
+                "fluxes": torch.rand(2, 5, 7, 2, 1, device=device) * 1000 * is_on_array,
+            },
+        )
+        images = decoder.render_images(tile_catalog)
+        image_ptiles = _render_ptiles(decoder, tile_catalog)
+        expected = reconstruct_image_from_ptiles(image_ptiles, 2, border_padding)
+        assert (
+            images.shape
+            == expected.shape
+            == (2, 1, 10 + 2 * border_padding, 14 + 2 * border_padding)
+        )
+        assert torch.allclose(images, expected, atol=1e-4)
+
+
+def test_psf_cache(psf_params_file, devices):
+    star_decoder = StarTileDecoder(2, 10, 2, 25, psf_params_file=psf_params_file)
+    star_decoder = star_decoder.to(devices.device)
+
+    with torch.no_grad():
+        psf = star_decoder._adjust_psf()  # noqa: WPS437
+        assert star_decoder._adjust_psf() is psf  # noqa: WPS437
+        psf_sums = reduce(star_decoder._get_psf(), "n h w -> n", "sum")  # noqa: WPS437
+        assert torch.allclose(psf_sums, torch.ones(2, device=devices.device))
+
+        star_decoder.params[0, 0] += 0.1
+        new_psf = star_decoder._adjust_psf()  # noqa: WPS437
+        assert not torch.allclose(new_psf, psf)
+        assert torch.equal(new_psf, star_decoder._fit_psf())  # noqa: WPS437
+
+    # gradients flow when psf parameters are being trained.
+    star_decoder._adjust_psf().sum().backward()  # noqa: WPS437
+    assert star_decoder.params.grad is not None
+
+
+def test_galaxy_stamp_bank(tmp_path, psf_params_file):
+    galaxy_ae_ckpt = tmp_path / "galaxy_ae.pt"
+    galaxy_ae = OneCenteredGalaxyAE(slen=53, latent_dim=8, hidden=16, n_bands=1)
+    torch.save(galaxy_ae.state_dict(), galaxy_ae_ckpt)
+    decoder = ImageDecoder(
+        n_bands=1,
+        tile_slen=4,
+        ptile_slen=52,
+        psf_slen=25,
+        sdss_bands=(2,),
+        psf_params_file=psf_params_file,
+        galaxy_ae=galaxy_ae,
+        galaxy_ae_ckpt=str(galaxy_ae_ckpt),
+    )
+
+    latents = torch.randn(10, 8)
+    galaxy_bools = torch.tensor([1.0, 0.0, 1.0, 1.0]).view(1, 2, 2, 1, 1)
+    galaxy_indices = torch.tensor([3, 0, 7, 3]).view(1, 2, 2, 1, 1) * galaxy_bools.long()
+    tile_catalog = TileCatalog(
+        decoder.tile_slen,
+        {
+            "n_sources": torch.ones(1, 2, 2).long(),
+            "locs": torch.rand(1, 2, 2, 1, 2),
+            "galaxy_bools": galaxy_bools,
+            "galaxy_params": latents[galaxy_indices.squeeze(-1)] * galaxy_bools,
+            "galaxy_indices": galaxy_indices,
+            "fluxes": torch.full((1, 2, 2, 1, 1), 1000.0) * (1 - galaxy_bools),
+        },
+    )
+
+    with torch.no_grad():
+        images = decoder.render_images(tile_catalog)
+        galaxy_fluxes = decoder.get_galaxy_fluxes(galaxy_bools, tile_catalog["galaxy_params"])
+        decoder.set_galaxy_stamp_bank(latents, batch_size=3)
+        assert decoder.galaxy_stamp_bank.shape == (10, 1, 53, 53)
+        assert torch.allclose(decoder.render_images(tile_catalog), images, atol=1e-3)
+        bank_galaxy_fluxes = decoder.get_galaxy_fluxes(
+            galaxy_bools, tile_catalog["galaxy_params"], galaxy_indices
+        )
+        assert torch.allclose(bank_galaxy_fluxes, galaxy_fluxes)
@@ -2,6 +2,8 @@ import torch
 from einops import rearrange
 
 from bliss.catalog import get_images_in_tiles
+from bliss.encoder import Encoder
+from bliss.models.binary import BinaryEncoder
 from bliss.models.location_encoder import LocationEncoder, LogBackgroundTransform
 
 
@@ -106,3 +108,201 @@ class TestSourceEncoder:
         image_ptiles = rearrange(image_ptiles, "n nth ntw b h w -> (n nth ntw) b h w")
         var_params = star_encoder.encode(image_ptiles)
         star_encoder.sample(var_params, n_samples)
+
+
+def test_sparse_encoder(devices):
+    device = devices.device
+    n_bands = 1
+    tile_slen = 4
+    ptile_slen = 20
+
+    location_encoder = LocationEncoder(
+        LogBackgroundTransform(),
+        channel=8,
+        dropout=0,
+        spatial_dropout=0,
+        hidden=64,
+        ptile_slen=ptile_slen,
+        tile_slen=tile_slen,
+        n_bands=n_bands,
+        mean_detections=0.48,
+        max_detections=1,
+    )
+    binary_encoder = BinaryEncoder(
+        LogBackgroundTransform(),
+        n_bands=n_bands,
+        tile_slen=tile_slen,
+        ptile_slen=ptile_slen,
+        channel=8,
+        hidden=64,
+        spatial_dropout=0,
+        dropout=0,
+    )
+    background = torch.full((2, n_bands, 60, 60), 100.0, device=device)
+    images = background + torch.randn(*background.shape, device=device) * 10.0
+    images[:, :, :, 30:] *= 5
+
+    # choose weights so that roughly half of the tiles are on
+    with torch.no_grad():
+        image_ptiles = get_images_in_tiles(
+            torch.cat((images, background), dim=1), tile_slen, ptile_slen
+        )
+        image_ptiles = rearrange(image_ptiles, "n nth ntw b h w -> (n nth ntw) b h w")
+        log_probs = location_encoder.eval().to(device).encode(image_ptiles)["n_source_log_probs"]
+        weight = (log_probs[:, 0] - log_probs[:, 1]).exp().median().item()
+
+    catalogs = {}
+    for sparse in (True, False):
+        encoder = Encoder(
+            location_encoder.eval(),
+            binary_encoder.eval(),
+            map_n_source_weights=(1.0, weight),
+            batch_size=50,
+            sparse=sparse,
+        ).to(device)
+        catalogs[sparse] = encoder.variational_mode(images, background)
+
+    n_sources = catalogs[True].n_sources
+    assert 0 < n_sources.sum() < n_sources.numel()
+    assert torch.equal(n_sources, catalogs[False].n_sources)
+    assert torch.allclose(catalogs[True].locs, catalogs[False].locs)
+    for k in ("galaxy_bools", "star_bools", "galaxy_probs"):
+        assert torch.allclose(catalogs[True][k], catalogs[False][k])
+
+    # re-thresholding the cached distributional parameters matches encoding from scratch.
+    encoder.variational_mode(images, background, cache_dist_params=True)
+    for new_weight in (weight / 2, weight * 2):
+        new_encoder = Encoder(
+            location_encoder, binary_encoder, map_n_source_weights=(1.0, new_weight), batch_size=50
+        ).to(device)
+        expected = new_encoder.variational_mode(images, background)
+        catalog = encoder.rethreshold((1.0, new_weight))
+        assert not torch.equal(catalog.n_sources, n_sources)
+        for k, v in expected.items():
+            assert torch.allclose(catalog[k], v)
+
+
+def test_encode_image(devices):
+    device = devices.device
+    tile_slen = 2
+    ptile_slen = 10
+    location_encoder = LocationEncoder(
+        LogBackgroundTransform(),
+        channel=8,
+        dropout=0,
+        spatial_dropout=0,
+        hidden=64,
+        ptile_slen=ptile_slen,
+        tile_slen=tile_slen,
+        n_bands=2,
+        mean_detections=0.48,
+        max_detections=2,
+    ).to(device)
+    for module in location_encoder.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-1, 1)
+            module.running_var.uniform_(0.5, 2)
+    location_encoder.eval()
+
+    background = torch.tensor((10.0, 20.0), device=device).reshape(1, -1, 1, 1)
+    background = background.expand(2, 2, 20, 24)
+    images = background + torch.randn(*background.shape, device=device) * background.sqrt()
+
+    with torch.no_grad():
+        image_ptiles = get_images_in_tiles(
+            torch.cat((images, background), dim=1), tile_slen, ptile_slen
+        )
+        image_ptiles = rearrange(image_ptiles, "n nth ntw b h w -> (n nth ntw) b h w")
+        dist_params = location_encoder.encode(image_ptiles)
+        image_dist_params = location_encoder.encode_image(images, background, batch_size=17)
+
+    for k, v in dist_params.items():
+        assert torch.allclose(image_dist_params[k], v, atol=1e-5)
+
+    # in training mode, batch norm uses batch statistics so all padded tiles are encoded at once.
+    location_encoder.train()
+    with torch.no_grad():
+        dist_params = location_encoder.encode(image_ptiles)
+        image_dist_params = location_encoder.encode_image(images, background)
+
+    for k, v in dist_params.items():
+        assert torch.allclose(image_dist_params[k], v, atol=1e-5)
+
+    # the binary encoder also transforms the full images before tiling them in training.
+    binary_encoder = BinaryEncoder(
+        LogBackgroundTransform(),
+        n_bands=2,
+        tile_slen=tile_slen,
+        ptile_slen=ptile_slen,
+        channel=8,
+        hidden=64,
+        spatial_dropout=0,
+        dropout=0,
+    ).to(device)
+    locs = torch.rand(len(image_ptiles), 1, 2, device=device)
+    batch = {
+        "images": images,
+        "background": background,
+        "locs": locs.reshape(2, -1, 1, 1, 2),
+        "galaxy_bools": torch.ones(2, len(image_ptiles) // 2, 1, 1, 1, device=device),
+        "n_sources": torch.ones(2, len(image_ptiles) // 2, 1, dtype=torch.long, device=device),
+    }
+    with torch.no_grad():
+        galaxy_probs = binary_encoder.get_prediction(batch)["galaxy_probs"]
+        expected = binary_encoder.encode(image_ptiles, locs)
+    assert torch.allclose(galaxy_probs, expected.reshape(-1), atol=1e-5)
+
+
+def test_encode_frame(devices):
+    device = devices.device
+    tile_slen = 4
+    ptile_slen = 20
+    location_encoder = LocationEncoder(
+        LogBackgroundTransform(),
+        channel=8,
+        dropout=0,
+        spatial_dropout=0,
+        hidden=64,
+        ptile_slen=ptile_slen,
+        tile_slen=tile_slen,
+        n_bands=1,
+        mean_detections=0.48,
+        max_detections=2,
+    ).to(device)
+    for module in location_encoder.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-1, 1)
+            module.running_var.uniform_(0.5, 2)
+    location_encoder.eval()
+
+    background = torch.full((2, 1, 120, 100), 100.0, device=device)
+    images = background + torch.randn(*background.shape, device=device) * 10.0
+    n_tiles_h, n_tiles_w = (120 - ptile_slen) // tile_slen + 1, (100 - ptile_slen) // tile_slen + 1
+
+    with torch.no_grad():
+        dist_params = location_encoder.encode_frame(images, background)
+        assert dist_params["n_source_log_probs"].shape[0] == 2 * n_tiles_h * n_tiles_w
+
+        # the output does not depend on the bands of tile rows that are encoded at a time.
+        for batch_size in (1, 2 * n_tiles_w + 1, 7 * n_tiles_w):
+            band_dist_params = location_encoder.encode_frame(images, background, batch_size)
+            for k, v in dist_params.items():
+                assert torch.allclose(band_dist_params[k], v, atol=1e-5)
+
+        # each padded tile uses the features of the full image at its location.
+        transformed = location_encoder.input_transform(torch.cat((images, background), dim=1))
+        stride, radius = location_encoder.enc_conv.get_receptive_field()
+        d = location_encoder.dim_enc_conv_out
+        for i, j in ((0, 0), (n_tiles_h // 2, n_tiles_w // 2), (n_tiles_h - 1, n_tiles_w - 1)):
+            top, left = i * tile_slen, j * tile_slen
+            crop_top, crop_left = max(top - 2 * radius, 0), max(left - 2 * radius, 0)
+            crop = transformed[:, :, crop_top : (top + ptile_slen + 2 * radius)]
+            crop = crop[:, :, :, crop_left : (left + ptile_slen + 2 * radius)]
+            features = location_encoder.enc_conv(crop)
+            ftop, fleft = (top - crop_top) // stride, (left - crop_left) // stride
+            features = features[:, :, ftop : (ftop + d), fleft : (fleft + d)]
+            expected = location_encoder._get_dist_params(features)
+            indices = torch.arange(2, device=device) * n_tiles_h * n_tiles_w
+            indices += i * n_tiles_w + j
+            for k, v in expected.items():
+                assert torch.allclose(dist_params[k][indices], v, atol=1e-5)
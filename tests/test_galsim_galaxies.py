@@ -0,0 +1,65 @@
+import galsim
+import numpy as np
+import torch
+
+from bliss.datasets.background import ConstantBackground
+from bliss.datasets.galsim_galaxies import GalsimGalaxyDecoder, GalsimGalaxyPrior, SDSSGalaxies
+
+
+def test_galsim_decoder_pool(tmp_path):
+    psf_image_file = tmp_path / "psf.npy"
+    psf = galsim.Gaussian(fwhm=1.4).drawImage(nx=25, ny=25, scale=0.396).array
+    np.save(psf_image_file, psf.reshape(1, 25, 25))
+    prior = GalsimGalaxyPrior(
+        flux_sample="uniform",
+        min_flux=1e3,
+        max_flux=1e5,
+        a_sample="uniform",
+        min_a_d=0.5,
+        max_a_d=2.0,
+        min_a_b=0.5,
+        max_a_b=2.0,
+    )
+    galaxy_params = prior.sample(10, "cpu")
+
+    decoder = GalsimGalaxyDecoder(21, 1, 0.396, str(psf_image_file))
+    pool_decoder = GalsimGalaxyDecoder(21, 1, 0.396, str(psf_image_file), n_workers=2)
+    try:
+        images = pool_decoder(galaxy_params)
+    finally:
+        pool_decoder.close()
+    assert images.shape == (10, 1, 21, 21)
+    assert torch.allclose(images, decoder(galaxy_params))
+
+
+def test_sdss_galaxies_batches(tmp_path):
+    psf_image_file = tmp_path / "psf.npy"
+    psf = galsim.Gaussian(fwhm=1.4).drawImage(nx=25, ny=25, scale=0.396).array
+    np.save(psf_image_file, psf.reshape(1, 25, 25))
+    prior = GalsimGalaxyPrior(
+        flux_sample="uniform",
+        min_flux=1e3,
+        max_flux=1e5,
+        a_sample="uniform",
+        min_a_d=0.5,
+        max_a_d=2.0,
+        min_a_b=0.5,
+        max_a_b=2.0,
+    )
+    decoder = GalsimGalaxyDecoder(21, 1, 0.396, str(psf_image_file))
+    dataset = SDSSGalaxies(prior, decoder, ConstantBackground((865.0,)), 0, 4, 3)
+
+    # each batch of galaxies is rendered with a single call to the decoder.
+    n_calls = 0
+
+    def count_calls(z):
+        nonlocal n_calls
+        n_calls += 1
+        return GalsimGalaxyDecoder.__call__(decoder, z)
+
+    dataset.decoder = count_calls
+    batches = list(dataset.train_dataloader())
+    assert len(batches) == 3 and n_calls == 3
+    for batch in batches:
+        assert batch["images"].shape == batch["noiseless"].shape == (4, 1, 21, 21)
+        assert batch["params"].shape[0] == batch["snr"].shape[0] == 4
@@ -1,8 +1,23 @@
+import numpy as np
 import torch
+from scipy.optimize import linear_sum_assignment
 from sklearn.metrics import confusion_matrix
 
-from bliss.catalog import FullCatalog
-from bliss.reporting import ClassificationMetrics, DetectionMetrics, match_by_locs_kdtree
+from kdtree_match_reference import kdtree_match_loop
+
+from bliss.catalog import FullCatalog, TileCatalog
+from bliss.reporting import (
+    ClassificationMetrics,
+    DetectionMetrics,
+    SceneMatch,
+    get_detection_stats_by_threshold,
+    get_expected_detection_stats_by_threshold,
+    kdtree_match,
+    match_by_locs,
+    match_by_locs_batched,
+    match_by_locs_kdtree,
+    scene_metrics,
+)
 
 
 def kdtree_test(true_loc, est_loc, true_bool, est_bool, slen, slack, method_id):
@@ -143,3 +158,276 @@ def test_metrics():
     assert recall == 3 / 3
     assert class_acc == 2 / 3
     assert torch.round(avg_distance_kdtree, decimals=3) == 0.05
+
+
+def _match_by_locs_dense(true_locs, est_locs, slack):
+    # reference: dense assignment where each pair within `slack` gains more than any total error.
+    true_locs, est_locs = true_locs.double().numpy(), est_locs.double().numpy()
+    locs_abs_diff = np.abs(true_locs[:, None] - est_locs[None])
+    is_pair = locs_abs_diff.max(-1) < slack
+    is_pair &= ((true_locs**2).sum(1) > 0)[:, None] & ((est_locs**2).sum(1) > 0)[None]
+    gain = 2 * slack * min(len(true_locs), len(est_locs)) + 1
+    cost = np.where(is_pair, locs_abs_diff.sum(-1) - gain, 0.0)
+    row_indx, col_indx = linear_sum_assignment(cost)
+    keep = is_pair[row_indx, col_indx]
+    return row_indx[keep], col_indx[keep], locs_abs_diff[row_indx[keep], col_indx[keep]].sum()
+
+
+def _match_by_locs_penalized(true_locs, est_locs, slack):
+    # previous dense assignment with penalty on pairs farther than `slack` apart.
+    locs_abs_diff = (true_locs.unsqueeze(1) - est_locs.unsqueeze(0)).abs()
+    locs_err = locs_abs_diff.sum(-1)
+    locs_err = locs_err + (locs_abs_diff.max(-1)[0] > slack) * locs_err.max()
+    row_indx, col_indx = linear_sum_assignment(locs_err)
+    dist = (true_locs[row_indx] - est_locs[col_indx]).abs().max(1)[0]
+    is_real = (true_locs[row_indx].abs().sum(1) > 0) & (est_locs[col_indx].abs().sum(1) > 0)
+    return ((dist < slack) & is_real).sum()
+
+
+def _check_match_by_locs(true_locs, est_locs, slack):
+    # matches within slack are as many as in the dense reference, and with the same total error.
+    # l1 errors have ties (e.g. pairs in the same order along both axes), so pairs can differ.
+    row_indx, col_indx, dist_keep, avg_distance = match_by_locs(true_locs, est_locs, slack)
+    dense_row_indx, _, dense_locs_err = _match_by_locs_dense(true_locs, est_locs, slack)
+    locs_abs_diff = (true_locs[row_indx] - est_locs[col_indx]).abs()
+    n_real = min((true_locs.abs().sum(1) > 0).sum(), (est_locs.abs().sum(1) > 0).sum())
+
+    assert len(row_indx) == n_real
+    assert len(set(row_indx)) == len(row_indx) and len(set(col_indx)) == len(col_indx)
+    assert (true_locs[row_indx].abs().sum(1) > 0).all()
+    assert (est_locs[col_indx].abs().sum(1) > 0).all()
+    assert torch.equal(dist_keep, locs_abs_diff.max(1)[0] < slack)
+    assert dist_keep.sum() == len(dense_row_indx)
+    assert dist_keep.sum() >= _match_by_locs_penalized(true_locs, est_locs, slack)
+    locs_err = locs_abs_diff[dist_keep].sum().item()
+    assert np.isclose(locs_err, dense_locs_err, rtol=1e-5, atol=1e-4)
+    if len(row_indx) > 0:
+        assert torch.isclose(avg_distance, locs_abs_diff.max(1)[0].mean())
+
+
+def test_match_by_locs():
+    # sources on a jittered grid, with some estimated sources missing and some spurious.
+    grid = torch.stack(torch.meshgrid(torch.arange(40), torch.arange(40), indexing="ij"), dim=-1)
+    grid = (grid.reshape(-1, 2)[torch.randperm(1600)] + 1) * 5.0
+    true_locs = grid[:1200] + torch.rand(1200, 2)
+    est_locs = true_locs + torch.randn(1200, 2).clamp(-2, 2) * 0.4
+    spurious_locs = grid[1200:1350] + 3 * torch.rand(150, 2)
+    est_locs = torch.cat((est_locs[:1000], spurious_locs))[torch.randperm(1150)]
+    true_locs[:5] = 0.0
+
+    row_indx, _, dist_keep, avg_distance = match_by_locs(true_locs, est_locs, 1.0)
+    assert len(row_indx) == 1150
+    assert 995 <= dist_keep.sum() <= 1000
+    assert avg_distance > 0
+    _check_match_by_locs(true_locs, est_locs, 1.0)
+
+    # no sources or no pairs within slack.
+    assert len(match_by_locs(true_locs[:0], est_locs, 1.0)[0]) == 0
+    assert len(match_by_locs(true_locs, est_locs[:0], 1.0)[0]) == 0
+    assert not match_by_locs(true_locs[5:6], true_locs[5:6] + 10, 1.0)[2].any()
+
+
+def test_match_by_locs_random():
+    # crowded random catalogs (with some sources at the origin) match as the dense assignment.
+    for _ in range(100):
+        n1, n2 = torch.randint(1, 60, (2,)).tolist()
+        size = torch.randint(3, 30, (1,)).item()
+        true_locs = torch.rand(n1, 2) * size
+        est_locs = torch.cat((true_locs + torch.randn(n1, 2) * 0.5, torch.rand(n2, 2) * size))
+        est_locs = est_locs[torch.randperm(n1 + n2)[:n2]]
+        true_locs[torch.rand(n1) < 0.05] = 0.0
+        _check_match_by_locs(true_locs, est_locs, 1.0)
+
+    # dense clusters of sources, far apart from each other.
+    for _ in range(20):
+        centers = torch.rand(5, 2) * 100
+        true_locs = centers[torch.randint(5, (50,))] + torch.randn(50, 2)
+        est_locs = centers[torch.randint(5, (40,))] + torch.randn(40, 2)
+        _check_match_by_locs(true_locs, est_locs, 1.5)
+
+    # sources on an integer grid have many more ties.
+    for _ in range(20):
+        true_locs = torch.randint(1, 8, (40, 2)).float()
+        est_locs = torch.randint(1, 8, (30, 2)).float()
+        _check_match_by_locs(true_locs, est_locs, 1.5)
+
+
+def test_kdtree_match():
+    # estimated sources 0 and 6 are equally far from two true sources, 5 and 7 are equally far
+    # from true source 3, estimated source 3 and true source 4 are unmatched.
+    locs1 = torch.tensor([[1.0, 1.0], [3.0, 1.0], [10.0, 10.0], [20.0, 20.0], [40.0, 40.0]])
+    locs2 = torch.tensor(
+        [
+            [2.0, 1.0],
+            [3.0, 1.5],
+            [1.0, 1.5],
+            [30.0, 30.0],
+            [10.5, 10.0],
+            [20.5, 20.0],
+            [2.0, 1.0],
+            [19.5, 20.0],
+        ]
+    )
+    for method_id in (0, 1):
+        row_idx, col_idx = kdtree_match(locs1, locs2, 1.0, method_id)
+        expected_row_idx, expected_col_idx = kdtree_match_loop(locs1, locs2, 1.0, method_id)
+        assert np.array_equal(row_idx, [0, 1, 2, 3])
+        assert np.array_equal(col_idx, [2, 1, 4, 5])
+        assert np.array_equal(row_idx, expected_row_idx)
+        assert np.array_equal(col_idx, expected_col_idx)
+
+    # only estimated sources 0 and 6 remain, tied between true sources 0 and 1.
+    row_idx, col_idx = kdtree_match(locs1, locs2[[0, 6, 3]], 1.0, 0)
+    expected_row_idx, expected_col_idx = kdtree_match_loop(locs1, locs2[[0, 6, 3]], 1.0, 0)
+    assert np.array_equal(row_idx, expected_row_idx)
+    assert np.array_equal(col_idx, expected_col_idx)
+    assert len(row_idx) == 2
+
+    # random catalogs, and catalogs without sources.
+    for method_id in (0, 1):
+        for _ in range(3):
+            locs1 = torch.rand(100, 2) * 30
+            locs2 = torch.cat((locs1[:80] + torch.randn(80, 2) * 0.5, torch.rand(20, 2) * 30))
+            row_idx, col_idx = kdtree_match(locs1, locs2, 1.0, method_id)
+            expected_row_idx, expected_col_idx = kdtree_match_loop(locs1, locs2, 1.0, method_id)
+            assert np.array_equal(row_idx, expected_row_idx)
+            assert np.array_equal(col_idx, expected_col_idx)
+        assert len(kdtree_match(locs1, locs2[:0], 1.0, method_id)[0]) == 0
+
+
+def test_scene_match():
+    grid = torch.stack(torch.meshgrid(torch.arange(20), torch.arange(20), indexing="ij"), dim=-1)
+    grid = grid.reshape(-1, 2)[torch.randperm(400)] * 5.0
+    true_plocs = grid[:300] + torch.rand(300, 2)
+    est_plocs = torch.cat((true_plocs[:250] + torch.rand(250, 2) * 0.8, grid[300:340]))
+    catalogs = []
+    for plocs in (true_plocs, est_plocs):
+        n_sources = len(plocs)
+        d = {
+            "plocs": plocs.unsqueeze(0),
+            "n_sources": torch.tensor([n_sources]),
+            "mags": torch.rand(1, n_sources, 1) * 6 + 18,
+            "galaxy_bools": (torch.rand(1, n_sources, 1) > 0.5).float(),
+        }
+        catalogs.append(FullCatalog(100, 100, d))
+    true_params, est_params = catalogs
+
+    mag_bins = np.array([[-np.inf, 20.0], [19.0, 21.0], [21.0, 24.0]])
+    metrics = SceneMatch(true_params, est_params).compute(mag_bins, slacks=(0.5, 1.0))
+    for ii, (mag_min, mag_max) in enumerate(mag_bins):
+        expected = scene_metrics(true_params, est_params, mag_min, mag_max, slack=1.0)
+        for k in ("precision", "recall", "f1", "class_acc"):
+            assert np.isclose(metrics[k][1, ii], expected[k].item())
+        assert metrics["conf_matrix_gal_star"][1, ii] == expected["conf_matrix"][0, 1]
+        for k, v in expected["counts"].items():
+            assert metrics[k][1, ii] == v
+    assert np.all(metrics["recall"][0] <= metrics["recall"][1])
+
+
+def test_scene_match_crowded():
+    # crowded clusters of sources, where matches compete across magnitude bins.
+    centers = torch.rand(20, 2) * 90 + 5
+    true_plocs = centers[torch.randint(20, (200,))] + torch.randn(200, 2) * 0.7
+    est_plocs = centers[torch.randint(20, (180,))] + torch.randn(180, 2) * 0.7
+    catalogs = []
+    for plocs in (true_plocs, est_plocs):
+        n_sources = len(plocs)
+        d = {
+            "plocs": plocs.unsqueeze(0),
+            "n_sources": torch.tensor([n_sources]),
+            "mags": torch.rand(1, n_sources, 1) * 6 + 18,
+            "galaxy_bools": (torch.rand(1, n_sources, 1) > 0.5).float(),
+        }
+        catalogs.append(FullCatalog(100, 100, d))
+    true_params, est_params = catalogs
+
+    mag_bins = np.array([[-np.inf, 20.0], [19.0, 21.0], [20.5, 22.5], [21.0, 24.0]])
+    slacks = (0.5, 1.0, 1.5)
+    metrics = SceneMatch(true_params, est_params, slack=1.5).compute(mag_bins, slacks=slacks)
+    for ii, slack in enumerate(slacks):
+        for jj, (mag_min, mag_max) in enumerate(mag_bins):
+            expected = scene_metrics(true_params, est_params, mag_min, mag_max, slack=slack)
+            for k in ("precision", "recall", "f1", "class_acc", "n_matches"):
+                assert np.isclose(metrics[k][ii, jj], expected[k].item())
+            for kk, k in enumerate(("gal_gal", "gal_star", "star_gal", "star_star")):
+                assert metrics[f"conf_matrix_{k}"][ii, jj] == expected["conf_matrix"].flatten()[kk]
+            for k, v in expected["counts"].items():
+                assert metrics[k][ii, jj] == v
+
+
+def test_detection_stats_by_threshold():
+    n_source_log_probs = torch.rand(1, 10, 10, 1, 1).log()
+    locs = torch.rand(1, 10, 10, 1, 2) * 0.5 + 0.25
+    tile_catalog = TileCatalog(
+        10,
+        {
+            "n_sources": torch.ones(1, 10, 10, dtype=torch.long),
+            "locs": locs,
+            "n_source_log_probs": n_source_log_probs,
+        },
+    )
+    full_catalog = tile_catalog.to_full_params()
+    true_plocs = full_catalog.plocs[:, :60] + torch.rand(1, 60, 2) * 0.5
+    true_catalog = FullCatalog(100, 100, {"plocs": true_plocs, "n_sources": torch.tensor([60])})
+    thresholds = np.linspace(0.01, 0.99, 99)
+    stats = get_detection_stats_by_threshold(true_catalog, tile_catalog, thresholds)
+    expected_stats = get_expected_detection_stats_by_threshold(tile_catalog, thresholds)
+
+    prob_on = n_source_log_probs.exp().reshape(-1)
+    for ii, threshold in enumerate(thresholds):
+        is_on = n_source_log_probs.reshape(-1) >= np.log(threshold)
+        detected = n_source_log_probs.reshape(-1)[:60] >= np.log(threshold)
+        assert stats["tp"][ii] == detected.sum()
+        assert stats["fp"][ii] == is_on.sum() - detected.sum()
+        assert torch.equal(stats["true_matches"][ii], detected)
+        assert np.isclose(expected_stats["tp"][ii], prob_on[is_on].sum())
+        assert np.isclose(expected_stats["fn"][ii], prob_on[~is_on].sum())
+        assert np.isclose(expected_stats["fp"][ii], (1 - prob_on[is_on]).sum())
+        assert np.isclose(expected_stats["tn"][ii], (1 - prob_on[~is_on]).sum())
+    assert stats["n_obj"] == 60
+
+
+def test_match_by_locs_batched():
+    n_sources = torch.tensor([[30, 25], [0, 10], [12, 0], [40, 40]])
+    catalogs = []
+    for ii in range(2):
+        plocs = torch.rand(4, 40, 2) * 50
+        is_on = torch.arange(40) < n_sources[:, ii : ii + 1]
+        plocs = plocs * is_on.unsqueeze(-1)
+        galaxy_bools = (torch.rand(4, 40, 1) > 0.5).float() * is_on.unsqueeze(-1)
+        d = {"plocs": plocs, "n_sources": n_sources[:, ii], "galaxy_bools": galaxy_bools}
+        catalogs.append(FullCatalog(50, 50, d))
+    true_params, est_params = catalogs
+    est_params.plocs[3] = true_params.plocs[3] + torch.randn(40, 2) * 0.5
+    est_params.plocs[3, 0] = 0.0
+
+    batch_indx, row_indx, col_indx, dist_keep, avg_distance = match_by_locs_batched(
+        true_params, est_params, 2.0
+    )
+    for b in (0, 3):
+        tlocs = true_params.plocs[b, : n_sources[b, 0]]
+        elocs = est_params.plocs[b, : n_sources[b, 1]]
+        mtrue, mest, dkeep, avg_dist = match_by_locs(tlocs, elocs, 2.0)
+        in_image = batch_indx == b
+        assert np.array_equal(row_indx[in_image].numpy(), mtrue)
+        assert np.array_equal(col_indx[in_image].numpy(), mest)
+        assert torch.equal(dist_keep[in_image], dkeep)
+        assert torch.isclose(avg_distance[b], avg_dist)
+    assert set(batch_indx.tolist()) == {0, 3}
+
+    # metrics are accumulated over images (and batches) as before.
+    detect = DetectionMetrics(2.0)
+    classify = ClassificationMetrics(2.0)
+    detect(true_params, est_params)
+    classify(true_params, est_params)
+    detection, classification = detect.compute(), classify.compute()
+    tgbool = true_params["galaxy_bools"][batch_indx, row_indx, 0][dist_keep]
+    egbool = est_params["galaxy_bools"][batch_indx, col_indx, 0][dist_keep]
+    expected_conf_matrix = confusion_matrix(tgbool, egbool, labels=[1, 0])
+    assert detection["tp"] == dist_keep.sum()
+    assert detection["fp"] == 65 - dist_keep.sum()
+    assert detection["n_galaxies_detected"] == tgbool.sum()
+    assert torch.isclose(detection["avg_distance"], avg_distance[[0, 3]].mean())
+    assert classification["n_matches"] == dist_keep.sum()
+    assert classification["class_acc"] == tgbool.eq(egbool).float().mean()
+    assert np.array_equal(classification["conf_matrix"].numpy(), expected_conf_matrix)
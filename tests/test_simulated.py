@@ -0,0 +1,157 @@
+import threading
+
+import pytest
+import pytorch_lightning as pl
+import torch
+
+from bliss.datasets.background import ConstantBackground
+from bliss.datasets.simulated import TRAIN_STREAM, VALID_STREAM, SimulatedDataset
+from bliss.models.decoder import ImageDecoder
+from bliss.models.prior import ImagePrior
+
+
+@pytest.fixture
+def get_simulated_dataset(psf_params_file, devices):
+    def _get_simulated_dataset(**kwargs):
+        decoder = ImageDecoder(
+            n_bands=1,
+            tile_slen=4,
+            ptile_slen=12,
+            psf_slen=25,
+            sdss_bands=(2,),
+            psf_params_file=psf_params_file,
+            border_padding=4,
+        )
+        prior = ImagePrior(
+            n_bands=1,
+            min_sources=0,
+            max_sources=2,
+            mean_sources=0.5,
+            f_min=1000.0,
+            f_max=10000.0,
+            alpha=0.5,
+            prob_galaxy=0.0,
+        )
+        return SimulatedDataset(
+            prior,
+            decoder,
+            ConstantBackground((100.0,)),
+            n_tiles_h=3,
+            n_tiles_w=3,
+            n_batches=kwargs.pop("n_batches", 4),
+            batch_size=5,
+            generate_device=kwargs.pop("generate_device", devices.device),
+            **kwargs,
+        )
+
+    return _get_simulated_dataset
+
+
+def test_seeded_batches(get_simulated_dataset):
+    # batches are also simulated in dataloader workers, which need a cpu dataset.
+    dataset = get_simulated_dataset(seed=42, generate_device="cpu")
+    batches = list(dataset.iter_batches(dataset.n_batches, TRAIN_STREAM, epoch=3))
+    assert len(batches) == dataset.n_batches
+
+    # any image can be regenerated on its own.
+    single = dataset.get_batch([7], epoch=3, stream=TRAIN_STREAM)
+    for k, v in single.items():
+        assert torch.allclose(v[0], batches[1][k][2], atol=1e-4)
+
+    # the global RNG state does not matter, but the epoch and stream do.
+    torch.manual_seed(0)
+    again = dataset.get_batch(range(5, 10), epoch=3)
+    assert torch.equal(again["images"], batches[1]["images"])
+    assert not torch.equal(dataset.get_batch(range(5), epoch=4)["images"], batches[0]["images"])
+    valid = dataset.get_batch(range(5), epoch=3, stream=VALID_STREAM)
+    assert not torch.equal(valid["images"], batches[0]["images"])
+
+    # batches are split across dataloader workers, which the dataloader interleaves in order.
+    dataset.num_workers = 2
+    images = torch.cat([batch["images"] for batch in dataset.train_dataloader()])
+    expected = torch.cat(
+        [batch["images"] for batch in dataset.iter_batches(dataset.n_batches, TRAIN_STREAM)]
+    )
+    assert torch.equal(images, expected)
+
+
+def test_prefetched_batches(get_simulated_dataset):
+    dataset = get_simulated_dataset(seed=0, n_producers=3, prefetch_batches=2)
+    expected = [dataset.get_batch(range(5 * i, 5 * (i + 1))) for i in range(dataset.n_batches)]
+    batches = list(dataset)
+    assert len(batches) == len(expected)
+    for batch, expected_batch in zip(batches, expected):
+        assert torch.equal(batch["images"], expected_batch["images"])
+
+    stats = dataset.prefetch_stats.as_dict()
+    assert dataset.prefetch_stats.n_batches == dataset.n_batches
+    assert 0 <= stats["prefetch/queue_depth"] <= 3  # one queue of one batch per producer.
+    assert stats["prefetch/produce_time_per_batch"] > 0
+
+    # without a seed, each producer draws its batches from its own generator.
+    dataset.seed = None
+    torch.manual_seed(0)
+    batches = [batch["images"] for batch in dataset]
+    torch.manual_seed(0)
+    assert all(torch.equal(a, b) for a, b in zip(batches, (batch["images"] for batch in dataset)))
+    assert not torch.equal(batches[0], batches[1])
+    assert not torch.equal(batches[0], batches[3])  # the same producer moves on.
+
+    # stopping early stops the producers.
+    n_threads = threading.active_count()
+    batches = iter(dataset)
+    next(batches)
+    batches.close()
+    assert threading.active_count() == n_threads
+
+
+def test_shared_memory_workers(get_simulated_dataset):
+    # each worker returns more batches than there are slots in the ring.
+    dataset = get_simulated_dataset(seed=1, num_workers=2, n_batches=12, generate_device="cpu")
+    dataset.trainer = pl.Trainer(logger=False, enable_checkpointing=False)
+    dataloader = dataset.train_dataloader()
+    assert all(buffer.is_shared() for buffer in dataset.image_decoder.buffers())
+    assert dataset._ring is not None  # noqa: WPS437
+    assert dataset.n_batches > 2 * dataset._ring.n_slots  # noqa: WPS437
+
+    # batches are returned without copies and stay valid while the next batch is consumed.
+    previous = None
+    n_batches = 0
+    for i, batch in enumerate(dataloader):
+        assert batch["images"].is_shared()
+        for j, held in ((i, batch), (i - 1, previous)):
+            if held is None:
+                continue
+            expected = dataset.get_batch(range(5 * j, 5 * (j + 1)))
+            for k, v in expected.items():
+                assert torch.equal(held[k], v)
+        previous = batch
+        n_batches += 1
+    assert n_batches == dataset.n_batches
+
+    # without a trainer (e.g. in `generate`), batches are not returned through the ring.
+    dataset.trainer = None
+    dataset.train_dataloader()
+    assert dataset._ring is None  # noqa: WPS437
+
+
+def test_cached_validation_set(tmp_path, get_simulated_dataset):
+    kwargs = {"seed": 3, "fix_validation_set": True, "valid_n_batches": 2}
+    dataset = get_simulated_dataset(valid_cache_dir=str(tmp_path / "valid"), **kwargs)
+    key = dataset.get_valid_cache_key()
+    batches = list(dataset.val_dataloader())
+    assert len(batches) == 2
+    assert [p.name for p in (tmp_path / "valid").iterdir()] == [key]
+    assert dataset.get_valid_cache_key() == key  # caches of the decoder are not hashed.
+    expected = dataset.get_batch(range(5, 10), stream=VALID_STREAM)
+    for k, v in expected.items():
+        assert torch.equal(batches[1][k], v.expand_as(batches[1][k]))
+
+    # later runs read the saved set, as long as the configuration is the same.
+    other = get_simulated_dataset(valid_cache_dir=str(tmp_path / "valid"), **kwargs)
+    other.get_batch = None
+    assert other.get_valid_cache_key() == key
+    for batch, other_batch in zip(batches, other.val_dataloader()):
+        assert torch.equal(batch["images"], other_batch["images"])
+    other.image_prior.mean_sources = 0.2
+    assert other.get_valid_cache_key() != key